@@ -1,14 +1,29 @@
 import os
+import shutil
+import tempfile
+import multiprocessing
 import nibabel as nib
 import numpy as np
 from gsd_pipeline.clinical_data.clinical_data_loader import load_clinical_data
-from gsd_pipeline.utils.utils import find_max_shape, rescale_outliers
+from gsd_pipeline.utils.utils import find_max_shape, rescale_outliers, bounding_box, outlier_medians, outlier_channels
+from gsd_pipeline.utils.directory_manifest import load_directory_manifest, list_subdirectories, list_entries
+from gsd_pipeline.dataset_store.store import save_dataset_store, write_subject_shards, DatasetStoreWriter, \
+    save_manifest, ShardedArray, CLINICAL_INPUTS_NAME
+from gsd_pipeline.dataset_store.dataset import GSDDataset, resolve_channels
+from gsd_pipeline.dataset_store.codecs import policy_dtypes, npz_image_members, get_dtype_policy
+from gsd_pipeline.dataset_store.shared_memory_server import attach_dataset
+from gsd_pipeline.dataset_store.views import save_view
+
+# 'npz': single compressed archive, 'store': directory with one memory-mappable shard per subject
+STORE_FORMATS = ['npz', 'store']
 
 # provided a given directory return list of paths to ct_sequences and lesion_maps
-def get_paths_and_ids(data_dir, ct_sequences, ct_label_sequences, mri_sequences, mri_label_sequences, brain_mask_name):
+# with use_manifest, directory listings are taken from the cached directory manifest of data_dir
+def get_paths_and_ids(data_dir, ct_sequences, ct_label_sequences, mri_sequences, mri_label_sequences, brain_mask_name,
+                      use_manifest=False):
 
-    subjects = [o for o in os.listdir(data_dir)
-                    if os.path.isdir(os.path.join(data_dir,o))]
+    directory_manifest = load_directory_manifest(data_dir) if use_manifest else None
+    subjects = list_subdirectories(data_dir, directory_manifest)
 
     ids = []
     ct_lesion_paths = []
@@ -26,13 +41,12 @@ def get_paths_and_ids(data_dir, ct_sequences, ct_label_sequences, mri_sequences,
         brain_mask = []
 
         if os.path.isdir(subject_dir):
-            modalities = [o for o in os.listdir(subject_dir)
-                            if os.path.isdir(os.path.join(subject_dir,o))]
+            modalities = list_subdirectories(subject_dir, directory_manifest)
 
             for modality in modalities:
                 modality_dir = os.path.join(subject_dir, modality)
 
-                studies = os.listdir(modality_dir)
+                studies = list_entries(modality_dir, directory_manifest)
 
                 for study in studies:
                     if study.startswith(tuple(ct_label_sequences)):
@@ -94,149 +108,506 @@ def get_paths_and_ids(data_dir, ct_sequences, ct_label_sequences, mri_sequences,
 
             print('Not all images found for this folder. Skipping.', subject)
 
+    if directory_manifest is not None:
+        directory_manifest.save()
+
     return (ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths)
 
-# Load nifi image maps from paths (first image is used as reference for dimensions)
-# - ct_paths : list of lists of paths of channels
-# - lesion_paths : list of paths of lesions maps
-# - brain_mask_paths : list of paths of ct brain masks
-# - return three lists containing image data for cts (as 4D array), brain masks and lesion_maps
-def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution = False):
-    if len(ct_paths) != len(ct_lesion_paths):
-        raise ValueError('Number of CT and number of lesions maps should be the same.', len(ct_paths), len(ct_lesion_paths))
+def rectify_shape(image_data, max_shape_z=None):
+    # high resolution data has to be padded to have constant dimensions
+    if max_shape_z is not None and image_data.shape[2] < max_shape_z:
+        n_missing_layers = max_shape_z - image_data.shape[2]
+        image_data = np.pad(image_data, ((0, 0), (0, 0), (n_missing_layers, 0)), 'constant', constant_values=0)
+    return image_data
+
+# sanitize lesion data to contain only single class
+def sanitize_lesion(lesion_data, id):
+    lesion_data[lesion_data > 1] = 1
+    if np.isnan(lesion_data).any():
+        print('Lesion label of', id, 'contains NaN. Converting to 0.')
+        lesion_data = np.nan_to_num(lesion_data)
+    return lesion_data
+
+def load_channels(channel_paths, id, modality, image_shape, max_shape_z=None):
+    channels = []
+    for channel_path in channel_paths:
+        image_data = nib.load(channel_path).get_fdata()
+        image_data = rectify_shape(image_data, max_shape_z)
+
+        if image_data.shape != image_shape:
+            raise ValueError('Image does not have correct dimensions.', channel_path)
+
+        if np.isnan(image_data).any():
+            print(modality, 'images of', id, 'contains NaN. Converting to 0.')
+            image_data = np.nan_to_num(image_data)
+        channels.append(image_data)
+    # channels are placed after the spatial dimensions (and before time for 4D images)
+    return np.stack(channels, axis=3)
+
+def load_subject_images(ct_channels, ct_lesion_path, mri_channels, mri_lesion_path, brain_mask_path, id,
+                        ct_image_shape, mri_image_shape=None, max_shape_z=None):
+    """
+    Load and sanitise all images of a single subject
+    :return: ct_input, ct_lesion, mri_input, mri_lesion, brain_mask (MRI images are None if not used)
+    """
+    ct_input = load_channels(ct_channels, id, 'CT', ct_image_shape, max_shape_z)
+
+    mri_input = None
+    if mri_channels:
+        mri_input = load_channels(mri_channels, id, 'MRI', mri_image_shape, max_shape_z)
+
+    # load ct labels
+    ct_lesion_data = np.asanyarray(nib.load(ct_lesion_path).dataobj)
+    ct_lesion = sanitize_lesion(rectify_shape(ct_lesion_data, max_shape_z), id)
+
+    # load MRI labels
+    mri_lesion = None
+    if mri_lesion_path is not None:
+        mri_lesion_data = np.asanyarray(nib.load(mri_lesion_path).dataobj)
+        mri_lesion = sanitize_lesion(rectify_shape(mri_lesion_data, max_shape_z), id)
 
-    # get CT dimensions by extracting first image
-    first_image = nib.load(ct_paths[0][0])
-    first_image_data = first_image.get_data()
-    n_x, n_y, n_z = first_image_data.shape[0:3]
-    if len(first_image_data.shape) == 4: # ie. there is a time dimensions
-        n_t = first_image_data.shape[3]
+    brain_mask_data = np.asanyarray(nib.load(brain_mask_path).dataobj)
+    brain_mask_data = rectify_shape(brain_mask_data, max_shape_z)
+    if np.isnan(brain_mask_data).any():
+        print('Brain mask of', id, 'contains NaN. Converting to 0.')
+        brain_mask_data = np.nan_to_num(brain_mask_data)
+
+    return ct_input, ct_lesion, mri_input, mri_lesion, brain_mask_data
+
+def get_image_array_shapes(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, high_resolution=False, max_shape=None,
+                           use_manifest=False):
+    """
+    Find the shapes of the image arrays of a dataset from the headers of the first subject (the images are not decoded)
+    :param max_shape: for high resolution images, shape to pad to (default: maximal shape found in the data directory)
+    :param use_manifest: use the cached directory manifest to find the maximal shape
+    :return: dict of array shapes (ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks), max_shape_z
+        (max_shape_z is None if images do not have to be padded)
+    """
+    # get CT dimensions from the first image
+    first_image_shape = nib.load(ct_paths[0][0]).shape
+    n_x, n_y, n_z = first_image_shape[0:3]
     ct_n_c = len(ct_paths[0])
     print(ct_n_c, 'CT channels found.')
 
-    ct_inputs = np.empty((len(ct_paths), n_x, n_y, n_z, ct_n_c))
-    if len(first_image_data.shape) == 4:
-        ct_inputs = np.empty((len(ct_paths), n_x, n_y, n_z, ct_n_c, n_t))
-    ct_lesion_outputs = np.empty((len(ct_lesion_paths), n_x, n_y, n_z))
-    brain_masks = np.empty((len(ct_lesion_paths), n_x, n_y, n_z), dtype = bool)
+    max_shape_z = None
+    # for high res images not all images have the same shape
+    if high_resolution:
+        if max_shape is None:
+            data_dir = '/'.join(ct_paths[0][0].split('/')[:-3])
+            max_shape = find_max_shape(data_dir, 'coreg_Tmax', use_manifest)
+        n_x, n_y, max_shape_z = max_shape
+        n_z = max_shape_z
+
+    ct_shape = (len(ct_paths), n_x, n_y, n_z, ct_n_c)
+    if len(first_image_shape) == 4: # ie. there is a time dimensions
+        ct_shape += (first_image_shape[3],)
+    shapes = {
+        'ct_inputs': ct_shape,
+        'ct_lesion_GT': (len(ct_lesion_paths), n_x, n_y, n_z),
+        'brain_masks': (len(ct_lesion_paths), n_x, n_y, n_z)
+    }
 
-    # get MRI dimensions by extracting first image
     if mri_paths[0]:
-        mri_first_image = nib.load(mri_paths[0][0])
-        mri_first_image_data = mri_first_image.get_data()
-        mri_n_x, mri_n_y, mri_n_z = mri_first_image_data.shape
+        mri_n_x, mri_n_y, mri_n_z = nib.load(mri_paths[0][0]).shape
+        if high_resolution:
+            mri_n_x, mri_n_y, mri_n_z = n_x, n_y, n_z
         mri_n_c = len(mri_paths[0])
         print(mri_n_c, 'MRI channels found.')
+        shapes['mri_inputs'] = (len(mri_paths), mri_n_x, mri_n_y, mri_n_z, mri_n_c)
+        shapes['mri_lesion_GT'] = (len(mri_lesion_paths), mri_n_x, mri_n_y, mri_n_z)
+
+    return shapes, max_shape_z
+
+# dtypes of datasets built without a dtype policy (see dataset_store.codecs)
+IMAGE_ARRAY_DTYPES = {'ct_inputs': np.float64, 'ct_lesion_GT': np.float64, 'mri_inputs': np.float64,
+                      'mri_lesion_GT': np.float64, 'brain_masks': bool}
+
+def image_array_dtypes(dtype_policy=None):
+    if dtype_policy is None:
+        return IMAGE_ARRAY_DTYPES
+    return policy_dtypes(dtype_policy)
+
+def allocate_image_arrays(shapes, buffer_dir=None, dtypes=IMAGE_ARRAY_DTYPES):
+    # with a buffer_dir, arrays are memory-mapped .npy files that can be filled by several processes
+    if buffer_dir is None:
+        return {name: np.empty(shape, dtype=dtypes[name]) for name, shape in shapes.items()}
+    return {name: np.lib.format.open_memmap(os.path.join(buffer_dir, name + '.npy'), mode='w+',
+                                            dtype=dtypes[name], shape=shape)
+            for name, shape in shapes.items()}
+
+def subject_loading_arguments(subject, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids,
+                              shapes, max_shape_z):
+    # without shapes, every subject keeps the shape of its own images (read from the headers)
+    mri_channels = mri_paths[subject] if mri_paths[0] else []
+    mri_lesion_path = mri_lesion_paths[subject] if mri_lesion_paths else None
+    if shapes is None:
+        ct_image_shape = nib.load(ct_paths[subject][0]).shape
+        mri_image_shape = nib.load(mri_channels[0]).shape[0:3] if mri_channels else None
+    else:
+        ct_image_shape = shapes['ct_inputs'][1:4] + shapes['ct_inputs'][5:]
+        mri_image_shape = shapes['mri_inputs'][1:4] if mri_channels else None
+    return (ct_paths[subject], ct_lesion_paths[subject], mri_channels, mri_lesion_path, brain_mask_paths[subject],
+            ids[subject], ct_image_shape, mri_image_shape, max_shape_z)
+
+def write_subject_images(outputs, subject, subject_images):
+    ct_input, ct_lesion, mri_input, mri_lesion, brain_mask = subject_images
+    outputs['ct_inputs'][subject] = ct_input
+    outputs['ct_lesion_GT'][subject] = ct_lesion
+    outputs['brain_masks'][subject] = brain_mask
+    if mri_input is not None:
+        outputs['mri_inputs'][subject] = mri_input
+    if mri_lesion is not None:
+        outputs['mri_lesion_GT'][subject] = mri_lesion
+
+# state of the image loading worker processes, set by init_loading_worker
+_worker_outputs = None
+_worker_arguments = None
+
+def init_loading_worker(buffer_dir, array_names, loading_arguments):
+    global _worker_outputs, _worker_arguments
+    _worker_outputs = {name: np.load(os.path.join(buffer_dir, name + '.npy'), mmap_mode='r+') for name in array_names}
+    _worker_arguments = loading_arguments
+
+def load_subject_into_buffers(subject):
+    # decode one subject and write it directly into the shared output buffers
+    subject_images = load_subject_images(*_worker_arguments[subject])
+    write_subject_images(_worker_outputs, subject, subject_images)
+    return subject
+
+# state of the store streaming worker processes, set by init_streaming_worker
+_worker_store_dir = None
+_worker_crop_margin = None
+_worker_dtype_policy = None
+_worker_channel_shards = False
+
+def init_streaming_worker(store_dir, loading_arguments, crop_margin=None, dtype_policy=None, channel_shards=False):
+    global _worker_store_dir, _worker_arguments, _worker_crop_margin, _worker_dtype_policy, _worker_channel_shards
+    _worker_store_dir = store_dir
+    _worker_arguments = loading_arguments
+    _worker_crop_margin = crop_margin
+    _worker_dtype_policy = dtype_policy
+    _worker_channel_shards = channel_shards
+
+def subject_images_to_arrays(subject_images, dtypes=IMAGE_ARRAY_DTYPES):
+    return {array_name: None if image is None else np.asarray(image, dtype=dtypes[array_name])
+            for array_name, image in zip(['ct_inputs', 'ct_lesion_GT', 'mri_inputs', 'mri_lesion_GT', 'brain_masks'],
+                                         subject_images)}
+
+def crop_to_brain(subject_arrays, crop_margin):
+    """
+    Crop the image arrays of a subject to the bounding box of its brain mask
+    Arrays which are not in the space of the brain mask are not cropped.
+    :return: cropped arrays, dict of array name to layout (offset and full_shape of the cropped block)
+    """
+    brain_mask = subject_arrays['brain_masks']
+    box = bounding_box(brain_mask, crop_margin)
+    cropped_arrays, layouts = {}, {}
+    for array_name, subject_data in subject_arrays.items():
+        if subject_data is None:
+            cropped_arrays[array_name] = None
+            continue
+        layouts[array_name] = {'offset': [0, 0, 0], 'full_shape': list(subject_data.shape[0:3])}
+        if subject_data.shape[0:3] != brain_mask.shape[0:3]:
+            cropped_arrays[array_name] = subject_data
+            continue
+        cropped_arrays[array_name] = subject_data[box]
+        layouts[array_name]['offset'] = [int(axis_box.start) for axis_box in box]
+    return cropped_arrays, layouts
+
+def prepare_subject_arrays(loading_arguments, crop_margin=None, dtype_policy=None):
+    subject_arrays = subject_images_to_arrays(load_subject_images(*loading_arguments), image_array_dtypes(dtype_policy))
+    if crop_margin is None:
+        return subject_arrays, None
+    return crop_to_brain(subject_arrays, crop_margin)
+
+def load_subject_into_store(subject):
+    # decode one subject and write its shards, only the array descriptions and layouts are sent back
+    id = _worker_arguments[subject][5]
+    subject_arrays, layouts = prepare_subject_arrays(_worker_arguments[subject], _worker_crop_margin,
+                                                     _worker_dtype_policy)
+    return subject, write_subject_shards(_worker_store_dir, str(id), subject_arrays, _worker_dtype_policy,
+                                         _worker_channel_shards), layouts
+
+def subject_sources(ct_channels, ct_lesion_path, mri_channels, mri_lesion_path, brain_mask_path, *args):
+    # modification times of all source images of a subject (takes the arguments of load_subject_images), by absolute
+    # path so that stores built or updated from a relative main_dir can be compared
+    paths = list(ct_channels) + [ct_lesion_path] + list(mri_channels) + [mri_lesion_path, brain_mask_path]
+    return {os.path.abspath(path): os.path.getmtime(path) for path in paths if path is not None}
+
+def stream_images_to_store(store_writer, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids,
+                           high_resolution = False, n_workers = 1, max_shape = None, use_manifest = False,
+                           crop_margin = None):
+    """
+    Load subjects one at a time and append them to a dataset store
+    At most n_workers subjects are held in memory at any time.
+    :param store_writer: DatasetStoreWriter (finalised by the caller), subjects of ragged stores are not padded
+    :param max_shape: for high resolution images, shape to pad to (default: maximal shape found in the data directory)
+    :param crop_margin: for ragged stores, crop subjects to the bounding box of their brain mask extended by
+        crop_margin voxels (not cropped if None)
+    """
+    if crop_margin is not None and not store_writer.ragged:
+        raise ValueError('Only subjects of ragged stores can be cropped.')
+    if len(ct_paths) != len(ct_lesion_paths):
+        raise ValueError('Number of CT and number of lesions maps should be the same.', len(ct_paths), len(ct_lesion_paths))
 
-        mri_inputs = np.empty((len(mri_paths), mri_n_x, mri_n_y, mri_n_z, mri_n_c))
-        mri_lesion_outputs = np.empty((len(mri_lesion_paths), mri_n_x, mri_n_y, mri_n_z))
+    if store_writer.ragged:
+        shapes, max_shape_z = None, None
+    else:
+        shapes, max_shape_z = get_image_array_shapes(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths,
+                                                     high_resolution, max_shape, use_manifest)
+    loading_arguments = [subject_loading_arguments(subject, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths,
+                                                   brain_mask_paths, ids, shapes, max_shape_z)
+                         for subject in range(len(ct_paths))]
+
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers, initializer=init_streaming_worker,
+                                  initargs=(store_writer.store_dir, loading_arguments, crop_margin,
+                                            store_writer.dtype_policy, store_writer.channel_shards)) as pool:
+            # imap keeps the subject order of the manifest
+            for subject, array_descriptions, layouts in pool.imap(load_subject_into_store, range(len(ct_paths))):
+                store_writer.register_subject(ids[subject], array_descriptions,
+                                              subject_sources(*loading_arguments[subject]), layouts)
+                print('Saved', ids[subject])
+    else:
+        for subject in range(len(ct_paths)):
+            subject_arrays, layouts = prepare_subject_arrays(loading_arguments[subject], crop_margin,
+                                                             store_writer.dtype_policy)
+            store_writer.append(ids[subject], subject_arrays, subject_sources(*loading_arguments[subject]), layouts)
+            print('Saved', ids[subject])
+
+def exclude_subjects(paths_and_ids, clinical_dir, clinical_name, external_memory = False):
+    """
+    Remove subjects with clinical exclusion criteria
+    Unlike npz archives, which keep the ids and clinical data of all subjects next to included_subjects, dataset stores
+    only hold the included subjects: their clinical data is filtered as well, so that its rows stay aligned with the
+    ids of the store (see update_subjects).
+    :param paths_and_ids: (ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths)
+    :return: paths_and_ids of included subjects, clinical data of included subjects
+    """
+    ids = paths_and_ids[0]
+    included_subjects, clinical_data = load_clinical_data(np.array(ids), clinical_dir, clinical_name,
+                                                          external_memory=external_memory)
+    included = [subject for subject in range(len(ids)) if included_subjects[subject]]
+    paths_and_ids = tuple([paths[subject] for subject in included] if len(paths) > 0 else paths
+                          for paths in paths_and_ids)
+    print('Excluded', len(ids) - len(included), 'subjects.')
+    return paths_and_ids, clinical_data[included_subjects]
+
+def stream_nifti_to_store(store_dir, main_dir, params, brain_mask_name, high_resolution = False,
+                          clinical_dir = None, clinical_name = None, external_memory = False, n_workers = 1,
+                          use_manifest = False, ragged = False, crop_margin = None, outlier_scaling = False):
+    """
+    Build a dataset store from the Nifti images of main_dir, subject by subject
+    Subjects with clinical exclusion criteria are not loaded.
+    The build settings and the modification times of the source images are saved to the manifest for later updates.
+    :param ragged: keep every subject at the shape of its images instead of padding them to a common shape
+    :param crop_margin: only save the bounding box of the brain mask of every subject, extended by crop_margin voxels
+        (the store is then ragged and subjects are placed back into their full images on read)
+    :param outlier_scaling: rescale the outlier channels of the subjects once they are all saved (see
+        rescale_store_outliers)
+    :return: path to the store
+    """
+    ragged = ragged or crop_margin is not None
+    paths_and_ids = get_paths_and_ids(main_dir, params['ct_sequences'], params['ct_label_sequences'],
+                                      params['mri_sequences'], params['mri_label_sequences'],
+                                      brain_mask_name, use_manifest)
 
-    # for high res images not all images have the same shape
-    if high_resolution:
-        data_dir = '/'.join(ct_paths[0][0].split('/')[:-3])
-        max_shape_x, max_shape_y, max_shape_z = find_max_shape(data_dir, 'coreg_Tmax')
-        ct_inputs = np.empty((len(ct_paths), max_shape_x, max_shape_y, max_shape_z, ct_n_c))
-        ct_lesion_outputs = np.empty((len(ct_lesion_paths), max_shape_x, max_shape_y, max_shape_z))
-        brain_masks = np.empty((len(ct_lesion_paths), max_shape_x, max_shape_y, max_shape_z), dtype=bool)
-
-        if mri_paths[0]:
-            mri_inputs = np.empty((len(mri_paths), max_shape_x, max_shape_y, max_shape_z))
-            mri_lesion_outputs = np.empty((len(mri_lesion_paths), max_shape_x, max_shape_y, max_shape_z, mri_n_c))
-
-    def rectify_shape(image_data):
-        # high resolution data has to be padded to have constant dimensions
-        if high_resolution and image_data.shape[2] < max_shape_z:
-            n_missing_layers = max_shape_z - image_data.shape[2]
-            image_data = np.pad(image_data, ((0, 0), (0, 0), (n_missing_layers, 0)), 'constant', constant_values=0)
-        return image_data
-
-    for subject in range(len(ct_paths)):
-        ct_channels = ct_paths[subject]
-        for c in range(ct_n_c):
-            image = nib.load(ct_channels[c])
-            image_data = image.get_fdata()
-            image_data = rectify_shape(image_data)
-
-            if ct_inputs[subject, :, :, :, c].shape != image_data.shape:
-                raise ValueError('Image does not have correct dimensions.', ct_channels[c])
-
-            if np.isnan(image_data).any():
-                print('CT images of', ids[subject], 'contains NaN. Converting to 0.')
-                image_data = np.nan_to_num(image_data)
-
-            if len(first_image_data.shape) == 4:
-                ct_inputs[subject, ..., c, :] = image_data
+    clinical_data = np.array([])
+    if clinical_dir is not None:
+        paths_and_ids, clinical_data = exclude_subjects(paths_and_ids, clinical_dir, clinical_name, external_memory)
+    ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths = paths_and_ids
+
+    build_settings = {'main_dir': os.path.abspath(main_dir), 'brain_mask_name': brain_mask_name,
+                      'high_resolution': high_resolution, 'clinical_dir': clinical_dir,
+                      'clinical_name': clinical_name, 'external_memory': external_memory,
+                      'use_manifest': use_manifest, 'ragged': ragged, 'crop_margin': crop_margin,
+                      'outlier_scaling': outlier_scaling}
+
+    print('Saving a total of', len(ids), 'subjects.')
+    store_writer = DatasetStoreWriter(store_dir, params, build_settings, ragged)
+    stream_images_to_store(store_writer, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids,
+                           high_resolution, n_workers, use_manifest=use_manifest, crop_margin=crop_margin)
+    store_writer.finalise(clinical_data)
+    if outlier_scaling:
+        rescale_store_outliers(store_dir)
+    return store_dir
+
+
+def rescale_store_outliers(store_dir, factor=5, scale=10):
+    """
+    Rescale the outlier channels of the subjects of a dataset store (see utils.rescale_outliers)
+    Medians are computed in a single pass over the shards, only the subjects with outliers are rewritten.
+    :return: dict of rescaled subject id to rescaled channels
+    """
+    store_writer = DatasetStoreWriter.open(store_dir)
+    rescaled = {}
+    # the saved blocks of cropped stores are enough to compute medians within the brain masks
+    with GSDDataset(store_dir, uncrop=False) as dataset:
+        subject_medians, cohort_medians = outlier_medians(zip(dataset.iter_subjects('ct_inputs'),
+                                                              dataset.iter_subjects('brain_masks')))
+        outliers = outlier_channels(subject_medians, cohort_medians, factor)
+        for index in np.flatnonzero(np.any(outliers, axis=1)):
+            subject = dataset[int(index)]
+            id = str(subject['id'])
+            # shards of the subject are replaced, arrays are copied out of their memory maps
+            subject_arrays = {key: np.array(subject[key]) for key in dataset.subject_arrays()}
+            for channel in np.flatnonzero(outliers[index]):
+                subject_arrays['ct_inputs'][..., channel] = subject_arrays['ct_inputs'][..., channel] / scale
+            layouts = store_writer.manifest['subject_layouts'][id] if store_writer.ragged else None
+            store_writer.append(id, subject_arrays, layouts=layouts)
+            rescaled[id] = np.flatnonzero(outliers[index]).tolist()
+    print('Rescaled outliers (subject: channels)', rescaled)
+    if len(rescaled) > 0:
+        save_manifest(store_writer.manifest, store_dir)
+    return rescaled
+
+def update_subjects(store_dir, main_dir = None, update_changed = True, n_workers = 1):
+    """
+    Merge new and changed subjects of the working directory into an existing dataset store
+    Subjects are new if their id is not in the store, and changed if the paths or modification times of their
+    Nifti images differ from those recorded when they were saved. Only these subjects are loaded and written,
+    the shards of all other subjects are left untouched.
+    :param store_dir: dataset store built with load_and_save_data(store_format='store')
+    :param main_dir: directory containing images (default: directory the store was built from)
+    :param update_changed: if False, only new subjects are added
+    :param n_workers: number of processes used to load the Nifti images in parallel
+    :return: ids of added subjects, ids of updated subjects
+    """
+    store_writer = DatasetStoreWriter.open(store_dir)
+    manifest = store_writer.manifest
+    if 'build_settings' not in manifest:
+        raise ValueError('Dataset store was not built from Nifti images and can not be updated.', store_dir)
+    build_settings = manifest['build_settings']
+    params = manifest['params']
+    if main_dir is None:
+        main_dir = build_settings['main_dir']
+
+    paths_and_ids = get_paths_and_ids(main_dir, params['ct_sequences'], params['ct_label_sequences'],
+                                      params['mri_sequences'], params['mri_label_sequences'],
+                                      build_settings['brain_mask_name'], build_settings.get('use_manifest', False))
+    ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths = paths_and_ids
+
+    added_ids, updated_ids, selected = [], [], []
+    for subject, id in enumerate(ids):
+        mri_lesion_path = mri_lesion_paths[subject] if mri_lesion_paths else None
+        mri_channels = mri_paths[subject] if mri_paths[0] else []
+        sources = subject_sources(ct_paths[subject], ct_lesion_paths[subject], mri_channels, mri_lesion_path,
+                                  brain_mask_paths[subject])
+        if id not in manifest['ids']:
+            added_ids.append(id)
+            selected.append(subject)
+        elif update_changed and manifest['sources'].get(id) != sources:
+            updated_ids.append(id)
+            selected.append(subject)
+
+    if len(selected) == 0:
+        print('Dataset store is up to date.')
+        return added_ids, updated_ids
+
+    paths_and_ids = tuple([paths[subject] for subject in selected] if len(paths) > 0 else paths
+                          for paths in paths_and_ids)
+
+    clinical_inputs = np.load(os.path.join(store_dir, CLINICAL_INPUTS_NAME), allow_pickle=True)
+    if build_settings['clinical_dir'] is not None:
+        paths_and_ids, clinical_data = exclude_subjects(paths_and_ids, build_settings['clinical_dir'],
+                                                        build_settings['clinical_name'],
+                                                        build_settings['external_memory'])
+        clinical_rows = list(clinical_inputs)
+        for id, subject_clinical_data in zip(paths_and_ids[0], clinical_data):
+            if id in manifest['ids']:
+                clinical_rows[manifest['ids'].index(id)] = subject_clinical_data
             else:
-                ct_inputs[subject, ..., c] = image_data
-
-        # load mri channels
-        if mri_paths[0]:
-            mri_channels = mri_paths[subject]
-            for k in range(mri_n_c):
-                image = nib.load(mri_channels[k])
-                image_data = image.get_fdata()
-                image_data = rectify_shape(image_data)
-
-                if mri_inputs[subject, :, :, :, k].shape != image_data.shape:
-                    raise ValueError('Image does not have correct dimensions.', mri_channels[k])
-
-                if np.isnan(image_data).any():
-                    print('MRI images of', ids[subject], 'contains NaN. Converting to 0.')
-                    image_data = np.nan_to_num(image_data)
-
-                mri_inputs[subject, :, :, :, k] = image_data
-
-        # load ct labels
-        ct_lesion_image = nib.load(ct_lesion_paths[subject])
-        ct_lesion_data = ct_lesion_image.get_data()
-        ct_lesion_data = rectify_shape(ct_lesion_data)
-
-        # load MRI labels
-        if mri_lesion_paths:
-            mri_lesion_image = nib.load(mri_lesion_paths[subject])
-            mri_lesion_data = mri_lesion_image.get_data()
-            mri_lesion_data = rectify_shape(mri_lesion_data)
-
-        # sanitize lesion data to contain only single class
-        def sanitize(lesion_data):
-            lesion_data[lesion_data > 1] = 1
-            if np.isnan(lesion_data).any():
-                print('Lesion label of', ids[subject], 'contains NaN. Converting to 0.')
-                lesion_data = np.nan_to_num(lesion_data)
-            return lesion_data
-
-        ct_lesion_outputs[subject, :, :, :] = sanitize(ct_lesion_data)
-        if mri_lesion_paths:
-            mri_lesion_outputs[subject, :, :, :] = sanitize(mri_lesion_data)
-
-        brain_mask_image = nib.load(brain_mask_paths[subject])
-        brain_mask_data = brain_mask_image.get_data()
-        brain_mask_data = rectify_shape(brain_mask_data)
-
-        if np.isnan(brain_mask_data).any():
-            print('Brain mask of', ids[subject], 'contains NaN. Converting to 0.')
-            brain_mask_data = np.nan_to_num(brain_mask_data)
-        brain_masks[subject, :, :, :] = brain_mask_data
+                clinical_rows.append(subject_clinical_data)
+        clinical_inputs = np.array(clinical_rows)
+        added_ids = [id for id in added_ids if id in paths_and_ids[0]]
+        updated_ids = [id for id in updated_ids if id in paths_and_ids[0]]
+
+    ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths = paths_and_ids
+    if len(ids) > 0:
+        # keep the shape of the saved subjects
+        max_shape = None
+        if build_settings['high_resolution'] and not store_writer.ragged:
+            max_shape = manifest['arrays']['ct_inputs']['subject_shape'][0:3]
+        print('Adding', len(added_ids), 'and updating', len(updated_ids), 'subjects.')
+        stream_images_to_store(store_writer, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths,
+                               ids, build_settings['high_resolution'], n_workers, max_shape,
+                               crop_margin=build_settings.get('crop_margin'))
+    store_writer.finalise(clinical_inputs)
+    if build_settings.get('outlier_scaling', False):
+        # subjects already rescaled are not outliers anymore
+        rescale_store_outliers(store_dir)
+
+    return added_ids, updated_ids
+
+def append_subjects(store_dir, main_dir = None, n_workers = 1):
+    """
+    Add subjects of the working directory that are not yet in the dataset store (see update_subjects)
+    :return: ids of added subjects
+    """
+    added_ids, _ = update_subjects(store_dir, main_dir, update_changed=False, n_workers=n_workers)
+    return added_ids
+
+# Load nifi image maps from paths (first image is used as reference for dimensions)
+# - ct_paths : list of lists of paths of channels
+# - lesion_paths : list of paths of lesions maps
+# - brain_mask_paths : list of paths of ct brain masks
+# - n_workers : number of processes decoding subjects in parallel
+# - buffer_dir : with n_workers > 1, directory of the memory-mapped output buffers (default: temporary directory)
+# - use_manifest : use the cached directory manifest to find the maximal shape of high resolution images
+# - dtype_policy : dtypes of the image arrays (see dataset_store.codecs, default: float64 images and labels)
+# - return three lists containing image data for cts (as 4D array), brain masks and lesion_maps
+def load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution = False,
+                n_workers = 1, buffer_dir = None, use_manifest = False, dtype_policy = None):
+    if len(ct_paths) != len(ct_lesion_paths):
+        raise ValueError('Number of CT and number of lesions maps should be the same.', len(ct_paths), len(ct_lesion_paths))
+
+    shapes, max_shape_z = get_image_array_shapes(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, high_resolution,
+                                                 use_manifest=use_manifest)
+    loading_arguments = [subject_loading_arguments(subject, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths,
+                                                   brain_mask_paths, ids, shapes, max_shape_z)
+                         for subject in range(len(ct_paths))]
+
+    if n_workers > 1:
+        temporary_buffers = buffer_dir is None
+        if temporary_buffers:
+            buffer_dir = tempfile.mkdtemp()
+        outputs = allocate_image_arrays(shapes, buffer_dir, image_array_dtypes(dtype_policy))
+        with multiprocessing.Pool(n_workers, initializer=init_loading_worker,
+                                  initargs=(buffer_dir, list(shapes.keys()), loading_arguments)) as pool:
+            for subject in pool.imap_unordered(load_subject_into_buffers, range(len(ct_paths))):
+                print('Loaded', ids[subject])
+        if temporary_buffers:
+            # the buffers stay mapped in memory after their files have been removed
+            shutil.rmtree(buffer_dir, ignore_errors=True)
+    else:
+        outputs = allocate_image_arrays(shapes, dtypes=image_array_dtypes(dtype_policy))
+        for subject in range(len(ct_paths)):
+            write_subject_images(outputs, subject, load_subject_images(*loading_arguments[subject]))
 
     if not mri_paths[0]:
-        mri_inputs = []
-        mri_lesion_outputs = []
+        outputs['mri_inputs'] = []
+        outputs['mri_lesion_GT'] = []
 
-    return ct_inputs, ct_lesion_outputs, mri_inputs, mri_lesion_outputs, brain_masks
+    return outputs['ct_inputs'], outputs['ct_lesion_GT'], outputs['mri_inputs'], outputs['mri_lesion_GT'], \
+           outputs['brain_masks']
 
 
-def load_nifti(main_dir, ct_sequences, label_sequences, mri_sequences, mri_label_sequences, brain_mask_name, high_resolution = False):
+def load_nifti(main_dir, ct_sequences, label_sequences, mri_sequences, mri_label_sequences, brain_mask_name, high_resolution = False,
+               n_workers = 1, use_manifest = False, dtype_policy = None):
     ids, ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths = get_paths_and_ids(
         main_dir, ct_sequences, label_sequences,
         mri_sequences, mri_label_sequences,
-        brain_mask_name)
-    return (ids, load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution))
+        brain_mask_name, use_manifest)
+    return (ids, load_images(ct_paths, ct_lesion_paths, mri_paths, mri_lesion_paths, brain_mask_paths, ids, high_resolution,
+                             n_workers=n_workers, use_manifest=use_manifest, dtype_policy=dtype_policy))
 
 # Save data as compressed numpy array
 def load_and_save_data(save_dir, main_dir, filename='data_set', clinical_dir = None, clinical_name = None,
                        ct_sequences = [], label_sequences = [], use_mri_sequences = False,
                        external_memory=False, high_resolution = False, enforce_VOI=True,
-                       use_vessels=False, use_angio=False, use_4d_pct=False, use_nc_ct=False):
+                       use_vessels=False, use_angio=False, use_4d_pct=False, use_nc_ct=False, store_format='npz',
+                       n_workers=1, use_directory_manifest=False, ragged=False, crop_margin=None, dtype_policy=None,
+                       compress=True, channel_shards=False, outlier_scaling=False):
     """
     Load data
         - Image data (from preprocessed Nifti)
@@ -256,6 +627,24 @@ def load_and_save_data(save_dir, main_dir, filename='data_set', clinical_dir = N
     :param     use_angio (optional, default False): use angio CT as ct input
     :param     use_4d_pct (optional, default False): use 4D perfusion CT as input
     :param     use_nc_ct (optional, default False): use non contrast CT as additional input
+    :param     store_format (optional, default 'npz'): 'npz' for a single compressed archive,
+                'store' for a directory with one memory-mappable shard per subject (see dataset_store)
+    :param     n_workers (optional, default 1): number of processes used to load the Nifti images in parallel
+    :param     use_directory_manifest (optional, default False): cache the listing of main_dir and the image headers
+                in a manifest file, so that later builds do not have to walk the whole directory again
+    :param     ragged (optional, default False): with store_format='store', keep every subject at its native shape
+                instead of padding all subjects to the maximal shape (high resolution data), see load_saved_data pad_shape
+    :param     crop_margin (optional, default None): with store_format='store', only save the bounding box of the brain
+                mask of every subject extended by crop_margin voxels, with its offset in the image (see load_saved_data uncrop)
+    :param     dtype_policy (optional, default None): dtypes of images and labels and encoding of labels
+                (eg. 'float32', 'float16_packed', see dataset_store.codecs), recorded in params so that
+                datasets saved from this dataset keep it. Default: float64 images and labels
+    :param     compress (optional, default True): with store_format='npz', False saves an uncompressed archive whose
+                arrays are memory-mapped on load instead of being inflated (recorded in params, see save_dataset)
+    :param     channel_shards (optional, default False): with store_format='store', save every channel of the
+                inputs in its own shard, so that single channels are read without the others (see load_saved_data channels)
+    :param     outlier_scaling (optional, default False): rescale CT channels of subjects that are scaled x10 (RAPID maps),
+                see utils.rescale_outliers
 
 
     Returns:
@@ -315,18 +704,43 @@ def load_and_save_data(save_dir, main_dir, filename='data_set', clinical_dir = N
     if high_resolution:
         brain_mask_name = 'hd_brain_mask.nii'
 
+    if store_format not in STORE_FORMATS:
+        raise ValueError('Unknown store format', store_format, 'should be one of', STORE_FORMATS)
+    if (ragged or crop_margin is not None or channel_shards) and store_format != 'store':
+        raise ValueError('Ragged, cropped and channel sharded datasets can only be saved with store_format="store".')
+
     print('Sequences used for CT', ct_sequences, label_sequences)
     print('Sequences used for MRI', mri_sequences, mri_label_sequences)
 
+    params = {'ct_sequences': ct_sequences, 'ct_label_sequences': label_sequences,
+              'mri_sequences': mri_sequences, 'mri_label_sequences': mri_label_sequences}
+    if dtype_policy is not None:
+        get_dtype_policy(dtype_policy)
+        params['dtype_policy'] = dtype_policy
+    if not compress:
+        params['compress'] = False
+    if channel_shards:
+        params['channel_shards'] = True
+
     included_subjects = np.array([])
     clinical_data = np.array([])
 
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
+
+    if store_format == 'store':
+        # subjects are streamed to the store one by one, without holding the whole dataset in memory
+        stream_nifti_to_store(os.path.join(save_dir, filename), main_dir, params, brain_mask_name, high_resolution,
+                              clinical_dir, clinical_name, external_memory, n_workers, use_directory_manifest, ragged,
+                              crop_margin, outlier_scaling)
+        return
+
     ids, (ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks) = load_nifti(main_dir, ct_sequences,
                                                                                         label_sequences, mri_sequences,
                                                                                         mri_label_sequences, brain_mask_name,
-                                                                                        high_resolution)
+                                                                                        high_resolution, n_workers,
+                                                                                        use_directory_manifest,
+                                                                                        dtype_policy)
     ids = np.array(ids)
 
     if clinical_dir is not None:
@@ -337,31 +751,69 @@ def load_and_save_data(save_dir, main_dir, filename='data_set', clinical_dir = N
         ct_lesion_GT = ct_lesion_GT[included_subjects]
         mri_inputs = mri_inputs[included_subjects]
         mri_lesion_GT = mri_lesion_GT[included_subjects]
+        brain_masks = brain_masks[included_subjects]
 
         print('Excluded', ids.shape[0] - ct_inputs.shape[0], 'subjects.')
 
+    if outlier_scaling:
+        ct_inputs = rescale_outliers(ct_inputs, brain_masks)
+
     print('Saving a total of', ct_inputs.shape[0], 'subjects.')
-    np.savez_compressed(os.path.join(save_dir, filename),
-        params = {'ct_sequences': ct_sequences, 'ct_label_sequences': label_sequences,
-                  'mri_sequences': mri_sequences, 'mri_label_sequences': mri_label_sequences},
+    image_members = npz_image_members({'ct_inputs': ct_inputs, 'ct_lesion_GT': ct_lesion_GT, 'mri_inputs': mri_inputs,
+                                       'mri_lesion_GT': mri_lesion_GT, 'brain_masks': brain_masks}, dtype_policy)
+    savez = np.savez_compressed if compress else np.savez
+    savez(os.path.join(save_dir, filename),
+        params = params,
         ids = ids, included_subjects = included_subjects,
-        clinical_inputs = clinical_data, ct_inputs = ct_inputs, ct_lesion_GT = ct_lesion_GT,
-        mri_inputs = mri_inputs, mri_lesion_GT = mri_lesion_GT, brain_masks = brain_masks)
-
-def save_dataset(dataset, outdir, out_file_name='data_set.npz'):
+        clinical_inputs = clinical_data, **image_members)
+
+def save_dataset(dataset, outdir, out_file_name='data_set.npz', store_format='npz', dtype_policy=None, compress=None):
+    '''
+    :param dtype_policy: cast and encode the image arrays following this dtype policy (see dataset_store.codecs),
+        default: the policy recorded in params, if any (arrays are saved as they are otherwise)
+    :param compress: for npz archives, False saves the members uncompressed (ZIP_STORED) so that they are
+        memory-mapped on load. Default: as recorded in params (compressed if not recorded)
+    '''
     (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = dataset
 
     print('Saving a total of', ct_inputs.shape[0], 'subjects.')
-    np.savez_compressed(os.path.join(outdir, out_file_name),
-                        params=params, ids=ids, clinical_inputs=clinical_inputs,
-                        ct_inputs=ct_inputs, ct_lesion_GT=ct_lesion_GT,
-                        mri_inputs=mri_inputs, mri_lesion_GT=mri_lesion_GT, brain_masks=brain_masks)
-
-def get_subset(data_dir, size, in_file_name='data_set.npz', out_file_name=None, outdir=None):
-    if out_file_name is None:
-        out_file_name = f'subset{str(size)}_{in_file_name}'
+    if store_format not in STORE_FORMATS:
+        raise ValueError('Unknown store format', store_format, 'should be one of', STORE_FORMATS)
+    if isinstance(params, np.ndarray):
+        params = params.item()
+    if dtype_policy is not None:
+        get_dtype_policy(dtype_policy)
+        params = dict(params, dtype_policy=dtype_policy)
+    dtype_policy = params.get('dtype_policy')
+    if compress is not None:
+        params = dict(params, compress=compress)
+    compress = params.get('compress', True)
+
+    if store_format == 'store':
+        dataset = (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+        save_dataset_store(dataset, outdir, out_file_name)
+        return
+    image_members = npz_image_members({'ct_inputs': ct_inputs, 'ct_lesion_GT': ct_lesion_GT, 'mri_inputs': mri_inputs,
+                                       'mri_lesion_GT': mri_lesion_GT, 'brain_masks': brain_masks}, dtype_policy)
+    savez = np.savez_compressed if compress else np.savez
+    savez(os.path.join(outdir, out_file_name),
+          params=params, ids=ids, clinical_inputs=clinical_inputs, **image_members)
+
+def get_subset(data_dir, size, in_file_name='data_set.npz', out_file_name=None, outdir=None, view=False):
+    '''
+    Save the first size subjects of a dataset
+    :param view: only save a view referencing the subjects in the dataset (see dataset_store.views) instead of a copy
+    '''
     if outdir is None:
         outdir = data_dir
+    if view:
+        if out_file_name is None:
+            out_file_name = f'subset{str(size)}_{os.path.splitext(os.path.basename(os.path.normpath(in_file_name)))[0]}'
+        with GSDDataset(os.path.join(data_dir, in_file_name)) as dataset:
+            ids = dataset.ids[0:size]
+        return save_view(os.path.join(outdir, out_file_name), os.path.join(data_dir, in_file_name), ids)
+    if out_file_name is None:
+        out_file_name = f'subset{str(size)}_{in_file_name}'
 
     (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = load_saved_data(data_dir, in_file_name)
     if len(clinical_inputs.shape) > 0 and len(clinical_inputs) > size:
@@ -384,66 +836,66 @@ def get_subset(data_dir, size, in_file_name='data_set.npz', out_file_name=None,
 
 
 def rescale_data(data_dir, filename = 'data_set.npz'):
-    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = load_saved_data(data_dir, filename)
+    # outliers are rescaled in place
+    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = \
+        load_saved_data(data_dir, filename, mmap_mode=None)
 
     print('Before outlier scaling', np.mean(ct_inputs[..., 0]), np.std(ct_inputs[..., 0]))
     # correct for outliers that are scaled x10
     rescaled_ct_inputs = rescale_outliers(ct_inputs, brain_masks)
     print('After outlier scaling', np.mean(ct_inputs[..., 0]), np.std(ct_inputs[..., 0]))
 
-    np.savez_compressed(os.path.join(data_dir, 'rescaled_' + filename),
-                        params=params,
-                        ids=ids,
-                        clinical_inputs=clinical_inputs, ct_inputs=rescaled_ct_inputs, ct_lesion_GT=ct_lesion_GT,
-                        mri_inputs=mri_inputs, mri_lesion_GT=mri_lesion_GT, brain_masks=brain_masks)
-
-def load_saved_data(data_dir, filename = 'data_set.npz'):
-    params = np.load(os.path.join(data_dir, filename), allow_pickle=True)['params']
-    ids = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ids']
-    clinical_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['clinical_inputs']
-    ct_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ct_inputs']
-    try:
-        ct_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ct_lesion_GT']
-    except:
-        ct_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['lesion_GT']
-
-    try:
-        mri_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_inputs']
-        mri_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_lesion_GT']
-    except:
-        mri_inputs = []
-        mri_lesion_GT = []
-
-    brain_masks = np.load(os.path.join(data_dir, filename), allow_pickle=True)['brain_masks']
+    dataset = (clinical_inputs, rescaled_ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+    save_dataset(dataset, data_dir, 'rescaled_' + filename)
+
+def load_saved_data(data_dir, filename = 'data_set.npz', mmap_mode='r', attach=False, uncrop=True, pad_shape=None,
+                    channels=None):
+    '''
+    Load a saved dataset, either a npz archive or a dataset store directory
+    The file is opened only once, see dataset_store.dataset.GSDDataset for lazy access to single arrays or subjects
+    :param mmap_mode: for dataset stores, memory-map mode of the per-subject shards (None loads them into memory),
+        arrays of uncompressed npz archives are memory-mapped copy-on-write unless mmap_mode is None
+        The image arrays of dataset stores are returned as lazy, read-only array-likes (store.ShardedArray, see
+        np.asarray), unless mmap_mode is None: they are then loaded into writable arrays, like those of npz archives.
+        Tools modifying the loaded arrays in place should load them with mmap_mode=None.
+    :param attach: map the read-only shared memory copy of the dataset published by a dataset server
+        (see dataset_store.shared_memory_server) instead of reading the file (arrays are read-only)
+    :param uncrop: for dataset stores cropped to the brain, place the saved blocks back into the full images
+    :param pad_shape: for ragged dataset stores, spatial shape to pad all subjects to ('max' for the largest subject)
+    :param channels: indices or names (see params['ct_sequences']) of the CT channels to load (default: all),
+        for stores saved with channel_shards only these channels are read
+    :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params),
+        the ids and clinical inputs of npz archives are those of the included subjects (see included_subjects)
+    '''
+    if attach:
+        (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = \
+            attach_dataset(os.path.join(data_dir, filename))
+        if channels is not None:
+            ct_inputs = np.take(ct_inputs, resolve_channels(channels, params.item()), axis=4)
+        n_excluded = 0
+    else:
+        with GSDDataset(os.path.join(data_dir, filename), mmap_mode=mmap_mode, uncrop=uncrop,
+                        pad_shape=pad_shape, channels=channels) as dataset:
+            (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = \
+                dataset.load()
+            n_excluded = dataset.n_excluded
+            if mmap_mode is None:
+                (ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks) = \
+                    [np.asarray(array) if isinstance(array, ShardedArray) else array
+                     for array in (ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks)]
 
     print('Loading a total of', ct_inputs.shape[0], 'subjects.')
     print('Sequences used:', params)
-    print(ids.shape[0] - ct_inputs.shape[0], 'subjects had been excluded.')
-
-    return (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
-
-def load_saved_data_at_index(index:int, data_dir, filename = 'data_set.npz'):
-    params = np.load(os.path.join(data_dir, filename), allow_pickle=True)['params']
-    ids = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ids'][index]
-    ct_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ct_inputs'][index]
-
-    try:
-        clinical_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['clinical_inputs'][index]
-    except:
-        clinical_inputs = []
-    try:
-        ct_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ct_lesion_GT'][index]
-    except:
-        ct_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['lesion_GT'][index]
-
-    try:
-        mri_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_inputs'][index]
-        mri_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_lesion_GT'][index]
-    except:
-        mri_inputs = []
-        mri_lesion_GT = []
-
-    brain_masks = np.load(os.path.join(data_dir, filename), allow_pickle=True)['brain_masks'][index]
+    print(n_excluded, 'subjects had been excluded.')
 
     return (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
 
+def load_saved_data_at_index(index:int, data_dir, filename = 'data_set.npz', mmap_mode='r', uncrop=True,
+                             pad_shape=None, channels=None):
+    """
+    Load a single subject of a saved dataset without decoding the other subjects
+    :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, id, params)
+    """
+    with GSDDataset(os.path.join(data_dir, filename), mmap_mode=mmap_mode, uncrop=uncrop,
+                    pad_shape=pad_shape, channels=channels) as dataset:
+        return dataset.load_at_index(index)
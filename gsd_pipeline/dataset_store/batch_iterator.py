@@ -0,0 +1,282 @@
+import queue
+import traceback
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.utils.shared_memory import close_shared_memory
+
+# seconds between checks of the worker processes while waiting for a batch
+WORKER_POLL_INTERVAL = 1
+# batch number of idle workers
+NO_BATCH = -1
+
+
+def crop_subject(subject, array_names, crop_shape, rng):
+    # same random spatial crop for all image arrays of a subject
+    spatial_shape = subject[array_names[0]].shape[:3]
+    offsets = [rng.integers(0, spatial_shape[axis] - crop_shape[axis] + 1) for axis in range(3)]
+    crop = tuple(slice(offset, offset + size) for offset, size in zip(offsets, crop_shape))
+    for array_name in array_names:
+        subject[array_name] = subject[array_name][crop]
+    return subject
+
+
+def serve_batches(dataset, slots, array_names, crop_shape, transform, task_queue, result_queue, current_batch=None):
+    '''
+    :param current_batch: shared value set to the batch being assembled by this worker (NO_BATCH when idle)
+    '''
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        epoch, batch_number, slot_index, subject_indices, batch_seed = task
+        if current_batch is not None:
+            current_batch.value = batch_number
+        try:
+            rng = np.random.default_rng(batch_seed)
+            for position, subject_index in enumerate(subject_indices):
+                if crop_shape is None and transform is None:
+                    # subjects are decoded directly into the slot
+                    for array_name in array_names:
+                        dataset.read_into(array_name, subject_index, slots[slot_index][array_name][position])
+                    continue
+                subject = dataset[subject_index]
+                if crop_shape is not None:
+                    subject = crop_subject(subject, array_names, crop_shape, rng)
+                if transform is not None:
+                    subject = transform(subject, rng)
+                for array_name in array_names:
+                    slots[slot_index][array_name][position] = subject[array_name]
+            result_queue.put((epoch, batch_number, slot_index, None))
+        except Exception:
+            result_queue.put((epoch, batch_number, slot_index, traceback.format_exc()))
+        if current_batch is not None:
+            current_batch.value = NO_BATCH
+
+
+def batch_worker(dataset_path, dataset_kwargs, slot_specs, array_names, crop_shape, transform, task_queue, result_queue,
+                 current_batch=None):
+    '''
+    Worker process: decode the subjects of a batch and write them directly into a shared-memory slot
+    '''
+    segments = []
+    try:
+        slots = []
+        for slot_spec in slot_specs:
+            slot = {}
+            for array_name, (segment_name, shape, dtype) in slot_spec.items():
+                # worker processes share the resource tracker of the iterator, which owns the segments
+                segment = shared_memory.SharedMemory(name=segment_name)
+                segments.append(segment)
+                slot[array_name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            slots.append(slot)
+        with GSDDataset(dataset_path, **dataset_kwargs) as dataset:
+            serve_batches(dataset, slots, array_names, crop_shape, transform, task_queue, result_queue, current_batch)
+    finally:
+        # views on the segments have to be released before closing them
+        slots, slot = None, None
+        for segment in segments:
+            close_shared_memory(segment)
+
+
+def check_subject_shapes(dataset, array_names, crop_shape=None):
+    '''
+    Subjects of ragged stores can only be batched if they have a common shape or are cropped to a shape they all
+    contain (the slots of the batches are allocated for the shape of the first subject)
+    '''
+    if not dataset.ragged:
+        return
+    # subjects are read with their full shape (uncropped)
+    shapes = {tuple(dataset.subject_layout(array_name, index)['full_shape'])
+              for array_name in array_names for index in range(len(dataset))}
+    if crop_shape is None and len(shapes) > 1:
+        raise ValueError('Subjects of', dataset.path, 'have different shapes', sorted(shapes),
+                         'give a crop_shape or a pad_shape to batch them.')
+    if crop_shape is not None:
+        too_small = [shape for shape in shapes if any(size < crop_size for size, crop_size in zip(shape, crop_shape))]
+        if len(too_small) > 0:
+            raise ValueError('Subjects of', dataset.path, 'with shapes', sorted(too_small), 'are smaller than the '
+                             'crop_shape', tuple(crop_shape), 'give a pad_shape to batch them.')
+
+
+class BatchIterator(object):
+    '''
+    Iterate over batches of a saved dataset, decoded and assembled ahead of the consumer by worker processes
+    Batches are written by the workers into a fixed pool of prefetch + 1 shared-memory slots. The consumer receives
+    views on these slots (no copy), which stay valid until the next batch is requested.
+
+    :param dataset_path: path to a npz archive or dataset store
+    :param batch_size: number of subjects per batch
+    :param arrays: image arrays to assemble into batches
+    :param channels: CT channels to use (see GSDDataset)
+    :param shuffle: shuffle subjects at every epoch (reproducible with seed)
+    :param seed: seed of the shuffling and of the random crops / transforms
+    :param n_workers: number of worker processes
+    :param prefetch: number of batches prepared in advance
+    :param crop_shape: optional (x, y, z) shape of random crops, the same crop is applied to all arrays of a subject
+    :param pad_shape: spatial shape to pad the subjects of ragged stores to ('max': largest subject shape, see
+        GSDDataset). Subjects of different shapes need a crop_shape or a pad_shape to be batched.
+    :param transform: optional picklable function (subject dict, rng) -> subject dict applied by the workers
+        (eg. augmentation), it must not change the shape of the arrays
+    :param drop_last: drop the last batch if it is smaller than batch_size
+
+    Every batch is a dict of array name to array of shape (n, ...), plus the ids and indices of its subjects.
+    Use as a context manager or call close() to stop the workers and release the shared memory.
+    If a worker process dies (eg. killed when out of memory), the iterator is closed and a RuntimeError is raised
+    while waiting for the next batch.
+    '''
+
+    def __init__(self, dataset_path, batch_size, arrays=('ct_inputs', 'ct_lesion_GT'), channels=None,
+                 shuffle=False, seed=None, n_workers=2, prefetch=2, crop_shape=None, transform=None, drop_last=False,
+                 pad_shape=None):
+        self.dataset_path = dataset_path
+        self.batch_size = batch_size
+        self.array_names = list(arrays)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._closed = True
+
+        dataset_kwargs = {'channels': channels, 'arrays': self.array_names, 'pad_shape': pad_shape}
+        with GSDDataset(dataset_path, **dataset_kwargs) as dataset:
+            if pad_shape is None:
+                check_subject_shapes(dataset, self.array_names, crop_shape)
+            self.ids = np.array(dataset.ids)
+            first_subject = dataset[0]
+        if crop_shape is not None:
+            first_subject = crop_subject(first_subject, self.array_names, crop_shape, np.random.default_rng(0))
+
+        # fixed pool of shared-memory slots
+        self.n_slots = prefetch + 1
+        self._segments = []
+        self._slots = []
+        slot_specs = []
+        for _ in range(self.n_slots):
+            slot, slot_spec = {}, {}
+            for array_name in self.array_names:
+                shape = (batch_size,) + first_subject[array_name].shape
+                dtype = first_subject[array_name].dtype
+                segment = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+                self._segments.append(segment)
+                slot[array_name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+                slot_spec[array_name] = (segment.name, shape, dtype.str)
+            self._slots.append(slot)
+            slot_specs.append(slot_spec)
+        self._closed = False
+
+        self._task_queue = multiprocessing.Queue()
+        self._result_queue = multiprocessing.Queue()
+        self._in_flight = set()
+        self._current_batches = [multiprocessing.Value('i', NO_BATCH, lock=False) for _ in range(n_workers)]
+        self._workers = [multiprocessing.Process(target=batch_worker,
+                                                 args=(dataset_path, dataset_kwargs, slot_specs, self.array_names,
+                                                       crop_shape, transform, self._task_queue, self._result_queue,
+                                                       current_batch),
+                                                 daemon=True)
+                         for current_batch in self._current_batches]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.ids) // self.batch_size
+        return int(np.ceil(len(self.ids) / self.batch_size))
+
+    def subject_order(self, epoch):
+        if not self.shuffle:
+            return np.arange(len(self.ids))
+        return np.random.default_rng([epoch] if self.seed is None else [self.seed, epoch]).permutation(len(self.ids))
+
+    def _check_workers(self):
+        for worker_index, worker in enumerate(self._workers):
+            if not worker.is_alive():
+                batch_number = self._current_batches[worker_index].value
+                self.close()
+                raise RuntimeError('Batch worker ' + str(worker_index) + ' (pid ' + str(worker.pid) + ') died with '
+                                   'exit code ' + str(worker.exitcode) +
+                                   (' while assembling batch ' + str(batch_number) if batch_number != NO_BATCH
+                                    else '') + '.')
+
+    def _receive(self):
+        while True:
+            try:
+                result = self._result_queue.get(timeout=WORKER_POLL_INTERVAL)
+                break
+            except queue.Empty:
+                self._check_workers()
+        epoch, batch_number, slot_index, error = result
+        self._in_flight.discard(slot_index)
+        if error is not None:
+            raise RuntimeError('Batch worker failed on batch ' + str(batch_number) + ':\n' + error)
+        return epoch, batch_number, slot_index
+
+    def __iter__(self):
+        if self._closed:
+            raise RuntimeError('BatchIterator has been closed.')
+        # slots still being written for an interrupted epoch can not be reused before they are done
+        while self._in_flight:
+            self._receive()
+
+        epoch = self.epoch
+        self.epoch += 1
+        order = self.subject_order(epoch)
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        free_slots = deque(range(self.n_slots))
+        ready = {}
+        next_to_submit = 0
+        held_slot = None
+        for batch_number in range(len(batches)):
+            # the views of the previous batch are released as soon as the next batch is requested
+            if held_slot is not None:
+                free_slots.append(held_slot)
+                held_slot = None
+            while free_slots and next_to_submit < len(batches):
+                slot_index = free_slots.popleft()
+                batch_seed = [next_to_submit, epoch] if self.seed is None else [self.seed, next_to_submit, epoch]
+                self._in_flight.add(slot_index)
+                self._task_queue.put((epoch, next_to_submit, slot_index, batches[next_to_submit], batch_seed))
+                next_to_submit += 1
+
+            # batches are yielded in order, whichever worker finishes first
+            while batch_number not in ready:
+                result_epoch, result_batch_number, slot_index = self._receive()
+                if result_epoch == epoch:
+                    ready[result_batch_number] = slot_index
+            held_slot = ready.pop(batch_number)
+
+            subject_indices = batches[batch_number]
+            batch = {array_name: self._slots[held_slot][array_name][:len(subject_indices)]
+                     for array_name in self.array_names}
+            batch['ids'] = self.ids[subject_indices]
+            batch['indices'] = subject_indices
+            yield batch
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self._slots = []
+        for segment in self._segments:
+            close_shared_memory(segment, unlink=True)
+        self._segments = []
@@ -0,0 +1,281 @@
+import numpy as np
+
+# The dtype policy of a dataset sets the dtype of its images (ct_inputs, mri_inputs) and labels (lesion maps,
+# brain masks), and the codecs used to save them. The policy is recorded in the params of the dataset so that
+# tools saving a processed copy of the dataset keep it. Encoded arrays are decoded on read (see GSDDataset).
+
+INPUT_ARRAYS = ['ct_inputs', 'mri_inputs']
+LESION_ARRAYS = ['ct_lesion_GT', 'mri_lesion_GT']
+MASK_ARRAYS = ['brain_masks']
+
+
+def dtype_policy(images, image_codec=None, label_codec=None, mask_codec=None):
+    return {'images': images, 'labels': 'uint8', 'masks': 'bool',
+            'image_codec': image_codec, 'label_codec': label_codec, 'mask_codec': mask_codec}
+
+
+DTYPE_POLICIES = {
+    # dtypes of datasets built without a policy
+    'float64': dict(dtype_policy('float64'), labels='float64'),
+    'float32': dtype_policy('float32'),
+    'float16': dtype_policy('float16'),
+    # labels and masks saved with 1 bit per voxel (np.packbits)
+    'float32_packed': dtype_policy('float32', label_codec='packbits', mask_codec='packbits'),
+    'float16_packed': dtype_policy('float16', label_codec='packbits', mask_codec='packbits'),
+    # lesion labels saved as the flat indices of their voxels, masks with 1 bit per voxel
+    'float32_sparse': dtype_policy('float32', label_codec='sparse', mask_codec='packbits'),
+    'float16_sparse': dtype_policy('float16', label_codec='sparse', mask_codec='packbits'),
+    # images saved as int16 / uint8 with a scale and offset per subject and channel, read as float32
+    'int16_quantized': dtype_policy('float32', image_codec='quantize_int16'),
+    'uint8_quantized': dtype_policy('float32', image_codec='quantize_uint8'),
+    'int16_quantized_packed': dtype_policy('float32', image_codec='quantize_int16', label_codec='packbits',
+                                           mask_codec='packbits'),
+    'uint8_quantized_packed': dtype_policy('float32', image_codec='quantize_uint8', label_codec='packbits',
+                                           mask_codec='packbits'),
+    'int16_quantized_sparse': dtype_policy('float32', image_codec='quantize_int16', label_codec='sparse',
+                                           mask_codec='packbits'),
+    'uint8_quantized_sparse': dtype_policy('float32', image_codec='quantize_uint8', label_codec='sparse',
+                                           mask_codec='packbits'),
+}
+
+QUANTIZED_DTYPES = {'quantize_int16': np.int16, 'quantize_uint8': np.uint8}
+# codecs whose encoded subjects do not have the same size, saved one after the other in npz archives
+VARIABLE_SIZE_CODECS = ['sparse']
+
+# name of the npz member describing the encoded arrays of a npz archive
+ARRAY_CODECS_KEY = 'array_codecs'
+
+
+def get_dtype_policy(dtype_policy):
+    if dtype_policy not in DTYPE_POLICIES:
+        raise ValueError('Unknown dtype policy', dtype_policy, 'should be one of', list(DTYPE_POLICIES.keys()))
+    return DTYPE_POLICIES[dtype_policy]
+
+
+def policy_dtypes(dtype_policy):
+    '''
+    :return: dict of image array name to dtype
+    '''
+    policy = get_dtype_policy(dtype_policy)
+    dtypes = {array_name: np.dtype(policy['images']) for array_name in INPUT_ARRAYS}
+    dtypes.update({array_name: np.dtype(policy['labels']) for array_name in LESION_ARRAYS})
+    dtypes.update({array_name: np.dtype(policy['masks']) for array_name in MASK_ARRAYS})
+    return dtypes
+
+
+def policy_codecs(dtype_policy):
+    '''
+    :return: dict of image array name to codec, for the arrays that are encoded
+    '''
+    policy = get_dtype_policy(dtype_policy)
+    codecs = {}
+    for codec, array_names in ((policy['image_codec'], INPUT_ARRAYS), (policy['label_codec'], LESION_ARRAYS),
+                               (policy['mask_codec'], MASK_ARRAYS)):
+        if codec is not None:
+            codecs.update({array_name: codec for array_name in array_names})
+    return codecs
+
+
+def quantize(subject_data, quantized_dtype):
+    '''
+    Quantize every channel (4th dimension) of a subject with its own scale and offset,
+    so that subject_data ~ quantized_data * scale + offset
+    :return: quantized data, parameters (scale and offset of every channel, maximal absolute reconstruction error)
+    '''
+    info = np.iinfo(quantized_dtype)
+    other_axes = tuple(axis for axis in range(subject_data.ndim) if axis != 3)
+    minimum = np.min(subject_data, axis=other_axes, keepdims=True).astype(np.float64)
+    maximum = np.max(subject_data, axis=other_axes, keepdims=True).astype(np.float64)
+    scale = (maximum - minimum) / (int(info.max) - int(info.min))
+    # constant channels
+    scale[scale == 0] = 1
+    offset = minimum - int(info.min) * scale
+
+    quantized_data = np.round((subject_data - offset) / scale)
+    np.clip(quantized_data, info.min, info.max, out=quantized_data)
+    quantized_data = quantized_data.astype(quantized_dtype)
+
+    parameters = {'scale': scale.ravel().tolist(), 'offset': offset.ravel().tolist()}
+    reconstruction = dequantize(quantized_data, parameters, np.float64)
+    parameters['max_error'] = float(np.max(np.abs(reconstruction - subject_data))) if subject_data.size > 0 else 0.
+    return quantized_data, parameters
+
+
+def dequantize(quantized_data, parameters, dtype):
+    # scale and offset are broadcast along the channel dimension
+    channel_shape = [1] * quantized_data.ndim
+    channel_shape[3] = -1
+    scale = np.reshape(parameters['scale'], channel_shape)
+    offset = np.reshape(parameters['offset'], channel_shape)
+    # float16 data is computed in float32
+    compute_dtype = np.promote_types(dtype, np.float32)
+    subject_data = quantized_data.astype(compute_dtype)
+    subject_data *= scale.astype(compute_dtype)
+    subject_data += offset.astype(compute_dtype)
+    return subject_data.astype(dtype, copy=False)
+
+
+def max_reconstruction_error(subject_parameters):
+    '''
+    Maximal reconstruction error over all subjects of an array encoded with a lossy codec
+    '''
+    errors = [parameters['max_error'] for parameters in subject_parameters
+              if parameters is not None and 'max_error' in parameters]
+    return max(errors) if len(errors) > 0 else 0.
+
+
+def merge_channel_parameters(channel_parameters):
+    '''
+    Parameters of a subject whose channels were quantized one at a time (eg. per-channel shards of a store)
+    '''
+    if all(parameters is None for parameters in channel_parameters):
+        return None
+    return {'scale': [scale for parameters in channel_parameters for scale in parameters['scale']],
+            'offset': [offset for parameters in channel_parameters for offset in parameters['offset']],
+            'max_error': max(parameters['max_error'] for parameters in channel_parameters)}
+
+
+def select_channel_parameters(parameters, channels):
+    # quantization parameters of some channels of a subject
+    if parameters is None or 'scale' not in parameters:
+        return parameters
+    return dict(parameters, scale=[parameters['scale'][channel] for channel in channels],
+                offset=[parameters['offset'][channel] for channel in channels])
+
+
+def check_binary(subject_data, codec):
+    if subject_data.dtype != bool and np.any((subject_data != 0) & (subject_data != 1)):
+        raise ValueError('Only binary arrays can be encoded with', codec)
+
+
+def encode_subject(subject_data, codec):
+    '''
+    :return: encoded data, parameters of the subject needed to decode it (None if there are none)
+    '''
+    subject_data = np.asarray(subject_data)
+    if codec == 'packbits':
+        check_binary(subject_data, codec)
+        return np.packbits(subject_data.ravel() != 0), None
+    if codec == 'sparse':
+        # flat (C order) indices of the nonzero voxels, their number is kept to get lesion volumes without decoding
+        check_binary(subject_data, codec)
+        index_dtype = np.uint32 if subject_data.size < 2 ** 32 else np.int64
+        indices = np.flatnonzero(subject_data).astype(index_dtype)
+        return indices, {'count': int(len(indices))}
+    if codec in QUANTIZED_DTYPES:
+        return quantize(subject_data, QUANTIZED_DTYPES[codec])
+    raise ValueError('Unknown codec', codec)
+
+
+def decode_subject(encoded_data, codec, subject_shape, dtype, parameters=None, out=None):
+    '''
+    :param out: optional preallocated array of subject_shape (eg. an entry of a batch) to decode into
+    '''
+    dtype = np.dtype(dtype)
+    if codec == 'sparse':
+        subject_shape = tuple(subject_shape)
+        if out is None:
+            out = np.zeros(subject_shape, dtype=dtype)
+        else:
+            out[...] = 0
+        indices = np.asarray(encoded_data)
+        if out.flags.c_contiguous:
+            out.reshape(-1)[indices] = 1
+        else:
+            out[np.unravel_index(indices, subject_shape)] = 1
+        return out
+    if out is not None:
+        out[...] = decode_subject(encoded_data, codec, subject_shape, dtype, parameters)
+        return out
+    if codec in QUANTIZED_DTYPES:
+        return dequantize(np.asarray(encoded_data), parameters, dtype)
+    if codec == 'packbits':
+        subject_data = np.unpackbits(np.asarray(encoded_data), count=int(np.prod(subject_shape)))
+        subject_data = subject_data.reshape(subject_shape)
+        # unpacked bits are uint8 (0 or 1), which can be viewed as bool without copy
+        if dtype.kind in 'bu' and dtype.itemsize == 1:
+            return subject_data.view(dtype)
+        return subject_data.astype(dtype)
+    raise ValueError('Unknown codec', codec)
+
+
+def codec_description(codec, subject_shape, dtype):
+    return {'codec': codec, 'subject_shape': [int(size) for size in subject_shape], 'dtype': np.dtype(dtype).str}
+
+
+def encoded_subject(encoded_array, description, index):
+    # encoded data of a subject in an encoded array of all subjects
+    if description['codec'] in VARIABLE_SIZE_CODECS:
+        parameters = description['subject_parameters'][index]
+        return encoded_array[parameters['start']:parameters['start'] + parameters['count']]
+    return encoded_array[index]
+
+
+def decode_array(encoded_array, description):
+    '''
+    Decode an encoded array of all subjects (one row per subject, or subjects one after the other for
+    variable size codecs)
+    '''
+    subject_shape = tuple(description['subject_shape'])
+    if 'subject_parameters' in description:
+        subject_parameters = description['subject_parameters']
+    else:
+        subject_parameters = [None] * len(encoded_array)
+    array = np.empty((len(subject_parameters),) + subject_shape, dtype=description['dtype'])
+    for subj_index in range(len(subject_parameters)):
+        decode_subject(encoded_subject(encoded_array, description, subj_index), description['codec'], subject_shape,
+                       description['dtype'], subject_parameters[subj_index], out=array[subj_index])
+    return array
+
+
+def voxel_counts(subject_parameters):
+    '''
+    Number of nonzero voxels of every subject of a sparse array, without decoding it
+    '''
+    return np.array([parameters['count'] for parameters in subject_parameters])
+
+
+def apply_dtype_policy(image_arrays, dtype_policy):
+    '''
+    Cast the image arrays of a dataset to the dtypes of a policy and encode them with its codecs
+    :param image_arrays: dict of image array name to array of all subjects (empty arrays are left as they are)
+    :return: dict of image array name to array to save, dict of array name to codec description of encoded arrays
+    '''
+    dtypes = policy_dtypes(dtype_policy)
+    codecs = policy_codecs(dtype_policy)
+    saved_arrays, array_codecs = {}, {}
+    for array_name, array in image_arrays.items():
+        if len(np.shape(array)) == 0 or len(array) == 0:
+            saved_arrays[array_name] = array
+            continue
+        array = np.asarray(array).astype(dtypes[array_name], copy=False)
+        if array_name in codecs:
+            array_codecs[array_name] = codec_description(codecs[array_name], array.shape[1:], array.dtype)
+            encoded_subjects = [encode_subject(subject_data, codecs[array_name]) for subject_data in array]
+            subject_parameters = [parameters for _, parameters in encoded_subjects]
+            if codecs[array_name] in VARIABLE_SIZE_CODECS:
+                start = 0
+                for parameters in subject_parameters:
+                    parameters['start'] = start
+                    start += parameters['count']
+                array = np.concatenate([encoded_data for encoded_data, _ in encoded_subjects])
+            else:
+                array = np.stack([encoded_data for encoded_data, _ in encoded_subjects])
+            if any(parameters is not None for parameters in subject_parameters):
+                array_codecs[array_name]['subject_parameters'] = subject_parameters
+                if codecs[array_name] in QUANTIZED_DTYPES:
+                    print('Maximal quantization error of', array_name, max_reconstruction_error(subject_parameters))
+        saved_arrays[array_name] = array
+    return saved_arrays, array_codecs
+
+
+def npz_image_members(image_arrays, dtype_policy=None):
+    '''
+    Members of a npz archive holding the image arrays of a dataset saved with dtype_policy
+    '''
+    if dtype_policy is None:
+        return dict(image_arrays)
+    members, array_codecs = apply_dtype_policy(image_arrays, dtype_policy)
+    if len(array_codecs) > 0:
+        members[ARRAY_CODECS_KEY] = array_codecs
+    return members
@@ -0,0 +1,477 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from gsd_pipeline.dataset_store.npz_archive import NpzArchive
+from gsd_pipeline.dataset_store.store import is_dataset_store, load_manifest, save_manifest, load_store_array, \
+    IMAGE_ARRAYS, CLINICAL_INPUTS_NAME, CHANNEL_STATISTICS_KEY
+from gsd_pipeline.dataset_store.statistics import compute_channel_statistics, DEFAULT_N_BINS
+from gsd_pipeline.dataset_store.views import is_dataset_view, load_view
+from gsd_pipeline.dataset_store.codecs import decode_array, decode_subject, max_reconstruction_error, voxel_counts, \
+    ARRAY_CODECS_KEY, VARIABLE_SIZE_CODECS
+
+
+def resolve_channels(channels, params):
+    '''
+    Indices of CT channels given by index or by name (see params['ct_sequences'])
+    '''
+    sequences = list(params.get('ct_sequences', []))
+    indices = []
+    for channel in channels:
+        if isinstance(channel, str):
+            if channel not in sequences:
+                raise ValueError('Unknown CT channel', channel, 'should be one of', sequences)
+            indices.append(sequences.index(channel))
+        else:
+            indices.append(int(channel))
+    return indices
+
+
+# arrays with one entry per subject
+SUBJECT_KEYS = ['ids', 'clinical_inputs', 'lesion_GT'] + IMAGE_ARRAYS
+# arrays of npz archives saved with clinical data which keep an entry for the excluded subjects (see included_subjects)
+ALL_SUBJECT_KEYS = ['ids', 'clinical_inputs']
+
+
+def included_indices(included_subjects, n_subjects):
+    '''
+    Indices of the included subjects of a npz archive, None if no subject is excluded
+    :param included_subjects: included_subjects member of the archive, a mask over its ids (ids saved in its place,
+        eg. by the ISLES loader, do not exclude any subject)
+    '''
+    included_subjects = np.asarray(included_subjects)
+    if included_subjects.dtype != bool or included_subjects.shape != (n_subjects,) or np.all(included_subjects):
+        return None
+    return np.flatnonzero(included_subjects)
+
+
+class GSDDataset(object):
+    '''
+    Handle on a saved GSD dataset (npz archive, dataset store or view) which is opened only once
+    Arrays are decoded lazily on first access and kept in a LRU cache bounded to cache_size arrays.
+    Single subjects can be read without decoding the rest of the cohort.
+    Arrays encoded by the dtype policy of the dataset (eg. bit-packed labels) are decoded on read.
+    Arrays of uncompressed npz archives are memory-mapped copy-on-write (unless mmap_mode is None): they are
+    writable like arrays read from compressed archives and the archive itself is never modified.
+
+    The dataset can also be used as a random-access sequence of subjects (eg. wrapped by a PyTorch or Keras loader):
+    dataset[i] or dataset[subject_id] returns a dict with the id, clinical inputs and image arrays of this subject only.
+    :param channels: indices or names (see params['ct_sequences']) of the CT channels to read (default: all channels).
+        For stores saved with channel_shards, only the shards of these channels are read.
+    :param arrays: image arrays returned by dataset[i] (default: all arrays present in the dataset)
+    :param uncrop: for stores cropped to the brain, return the full images of the subjects (the saved blocks otherwise,
+        their offsets are given by subject_layout)
+    :param pad_shape: for ragged stores, spatial shape to pad subjects to on read ('max': largest subject shape)
+
+    Views (see views) are opened as their parent dataset restricted to the subjects of the view, in the order of the
+    view. Only the shards of these subjects are read from stores.
+
+    npz archives built with clinical data keep the ids and clinical inputs of all subjects, but the images of the
+    included subjects only: the dataset only holds the included subjects (see included_subjects).
+
+    Random access to a subject (dataset[i], subject_array) of a compressed npz archive inflates the members from their
+    start up to this subject at every call, ie. in O(member size): iterate over the dataset (or use iter_subjects) to
+    read subjects in order, every member is then inflated only once.
+    '''
+
+    def __init__(self, path, cache_size=2, mmap_mode='r', channels=None, arrays=None, uncrop=True, pad_shape=None):
+        self.path = path
+        self.view = load_view(path) if is_dataset_view(path) else None
+        # path of the saved data (parent of views)
+        self.data_path = path if self.view is None else self.view['parent']
+        self.cache_size = cache_size
+        self.mmap_mode = mmap_mode
+        self.arrays = arrays
+        self.uncrop = uncrop
+        self.pad_shape = pad_shape
+        self._cache = OrderedDict()
+        self._id_index = None
+        self._array_codecs = None
+
+        if is_dataset_store(self.data_path):
+            self.manifest = load_manifest(self.data_path)
+            self.archive = None
+        else:
+            self.manifest = None
+            self.archive = NpzArchive(self.data_path)
+
+        # rows of the included subjects in the members of a npz archive which keep the excluded subjects
+        self.included = None
+        if self.archive is not None and 'included_subjects' in self.archive:
+            self.included = included_indices(self.archive.read('included_subjects'), self.archive.shape('ids')[0])
+
+        # indices of the subjects of a view in its parent
+        self.subset = None
+        if self.view is not None:
+            parent_ids = self.manifest['ids'] if self.archive is None else self.archive.read('ids')
+            if self.included is not None:
+                # views index the included subjects, excluded subjects are not found
+                parent_ids = parent_ids[self.included]
+            parent_index = {str(id): index for index, id in enumerate(parent_ids)}
+            missing = [id for id in self.view['ids'] if id not in parent_index]
+            if len(missing) > 0:
+                raise KeyError('Subjects', missing, 'of view', path, 'not found in', self.data_path)
+            self.subset = np.array([parent_index[id] for id in self.view['ids']], dtype=int)
+            if self.manifest is not None:
+                self.manifest = dict(self.manifest, ids=[parent_ids[index] for index in self.subset])
+        self.channels = None if channels is None else resolve_channels(channels, self.params)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._cache.clear()
+        if self.archive is not None:
+            self.archive.close()
+
+    def keys(self):
+        if self.archive is not None:
+            return self.archive.keys()
+        # like in npz archives, image arrays that are not used are returned as empty arrays
+        return ['params', 'ids', 'clinical_inputs'] + IMAGE_ARRAYS
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def resolve_key(self, key):
+        # older datasets saved the CT lesion labels as lesion_GT
+        if key == 'ct_lesion_GT' and key not in self and 'lesion_GT' in self:
+            return 'lesion_GT'
+        return key
+
+    @property
+    def params(self):
+        return self.array('params').item()
+
+    @property
+    def array_codecs(self):
+        # codec descriptions of the encoded arrays of a npz archive
+        if self._array_codecs is None:
+            self._array_codecs = {}
+            if self.archive is not None and ARRAY_CODECS_KEY in self.archive:
+                self._array_codecs = self.archive.read(ARRAY_CODECS_KEY).item()
+        return self._array_codecs
+
+    def codec_parameters(self, key):
+        '''
+        Parameters of every subject needed to decode an encoded array (eg. quantization scale and offset),
+        None if the array does not have per-subject parameters
+        '''
+        key = self.resolve_key(key)
+        if self.archive is not None:
+            subject_parameters = self.array_codecs.get(key, {}).get('subject_parameters')
+            if subject_parameters is None or self.subset is None:
+                return subject_parameters
+            return [subject_parameters[index] for index in self.subset]
+        if key not in self.manifest.get('codec_parameters', {}):
+            return None
+        return [self.manifest['codec_parameters'][key][id] for id in self.manifest['ids']]
+
+    def reconstruction_error(self, key):
+        '''
+        Maximal absolute error of the values of an array saved with a lossy codec (0 for lossless arrays)
+        '''
+        subject_parameters = self.codec_parameters(key)
+        return 0. if subject_parameters is None else max_reconstruction_error(subject_parameters)
+
+    @property
+    def ids(self):
+        return self.array('ids')
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def n_excluded(self):
+        # number of subjects excluded from a npz archive built with clinical data
+        return 0 if self.included is None else self.archive.shape('ids')[0] - len(self.included)
+
+    def index_of(self, subject_id):
+        if self._id_index is None:
+            self._id_index = {str(id): index for index, id in enumerate(self.ids)}
+        try:
+            return self._id_index[str(subject_id)]
+        except KeyError:
+            raise KeyError('Subject', subject_id, 'not found in', self.path)
+
+    def has_array(self, key):
+        key = self.resolve_key(key)
+        if key not in self:
+            return False
+        if self.archive is not None:
+            if 'subject_parameters' in self.array_codecs.get(key, {}):
+                # subjects of variable size codecs are saved one after the other
+                return len(self.array_codecs[key]['subject_parameters']) > 0
+            return len(self.archive.shape(key)) > 0 and self.archive.shape(key)[0] > 0
+        return key not in IMAGE_ARRAYS or key in self.manifest['arrays']
+
+    @property
+    def ragged(self):
+        return self.manifest is not None and 'subject_layouts' in self.manifest
+
+    def subject_layout(self, key, index):
+        '''
+        Layout (shape, offset and full_shape) of the shard of a subject in a ragged store
+        '''
+        return self.manifest['subject_layouts'][self.manifest['ids'][index]][key]
+
+    def subject_arrays(self):
+        if self.arrays is not None:
+            return self.arrays
+        return [key for key in IMAGE_ARRAYS if self.has_array(key)]
+
+    def __getitem__(self, key):
+        '''
+        :param key: index or id of a subject
+        :return: dict with id, clinical_inputs and the selected image arrays of the subject
+        '''
+        if isinstance(key, (int, np.integer)):
+            index = int(key)
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('Index', key, 'out of range for', len(self), 'subjects.')
+        else:
+            index = self.index_of(key)
+
+        subject = {'id': self.subject_array('ids', index)}
+        try:
+            subject['clinical_inputs'] = self.subject_array('clinical_inputs', index)
+        except (KeyError, IndexError):
+            subject['clinical_inputs'] = np.array([])
+        for array_name in self.subject_arrays():
+            subject[array_name] = self.subject_array(array_name, index)
+        return subject
+
+    def __iter__(self):
+        '''
+        Iterate over the subjects in order, streaming through every array once (see iter_subjects)
+        '''
+        clinical_inputs = self.array('clinical_inputs') if 'clinical_inputs' in self else np.array([])
+        arrays = self.subject_arrays()
+        array_iterators = [self.iter_subjects(array_name) for array_name in arrays]
+        for index, subject_id in enumerate(self.ids):
+            subject = {'id': subject_id}
+            subject['clinical_inputs'] = clinical_inputs[index] \
+                if np.ndim(clinical_inputs) > 0 and index < len(clinical_inputs) else np.array([])
+            for array_name, array_iterator in zip(arrays, array_iterators):
+                subject[array_name] = next(array_iterator)
+            yield subject
+
+    def selected_channels(self, key):
+        # channels are the 4th dimension of CT inputs (followed by time for 4D perfusion CT)
+        return self.channels if key == 'ct_inputs' else None
+
+    def _select_channels(self, key, data, channel_axis):
+        channels = self.selected_channels(key)
+        if channels is None or np.ndim(data) <= channel_axis:
+            return data
+        return np.take(data, channels, axis=channel_axis)
+
+    def parent_index(self, index):
+        # index of a subject in the saved data
+        return index if self.subset is None else int(self.subset[index])
+
+    def archive_index(self, key, index):
+        # row of a subject in a npz member (members of ALL_SUBJECT_KEYS also hold the excluded subjects)
+        index = self.parent_index(index)
+        if self.included is not None and key in ALL_SUBJECT_KEYS:
+            return int(self.included[index])
+        return index
+
+    def _select_subjects(self, key, data):
+        if key not in SUBJECT_KEYS or len(np.shape(data)) == 0 or len(data) == 0:
+            return data
+        if self.included is not None and key in ALL_SUBJECT_KEYS:
+            data = data[self.included]
+        return data if self.subset is None else data[self.subset]
+
+    def _decode_member(self, key):
+        if key in self.array_codecs:
+            return decode_array(self.archive.read(key), self.array_codecs[key])
+        if self.mmap_mode is not None and self.archive.supports_memmap(key):
+            return self.archive.memmap(key, mode='c')
+        return self.archive.read(key)
+
+    def _decode(self, key):
+        if self.archive is not None:
+            return self._select_channels(key, self._select_subjects(key, self._decode_member(key)), 4)
+        if key == 'params':
+            return np.array(self.manifest['params'], dtype=object)
+        if key == 'ids':
+            return np.array(self.manifest['ids'])
+        if key == 'clinical_inputs':
+            return self._select_subjects(key, np.load(os.path.join(self.data_path, CLINICAL_INPUTS_NAME),
+                                                      allow_pickle=True))
+        return load_store_array(self.data_path, self.manifest, key, self.mmap_mode, self.uncrop, self.pad_shape,
+                                self.selected_channels(key))
+
+    def array(self, key):
+        '''
+        Full array stored under key (decoded once, then served from the cache)
+        '''
+        key = self.resolve_key(key)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if key not in self:
+            raise KeyError(key, 'not found in', self.path)
+
+        data = self._decode(key)
+        self._cache[key] = data
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    def _subject_range(self, key, index):
+        # entries of a npz member holding a subject (index in the archive)
+        description = self.array_codecs.get(key)
+        if description is not None and description['codec'] in VARIABLE_SIZE_CODECS:
+            parameters = description['subject_parameters'][index]
+            return parameters['start'], parameters['start'] + parameters['count']
+        return index, index + 1
+
+    def _decode_subject(self, key, index, range_data, out=None):
+        # decode a subject (index in the archive) from the entries of its range in a npz member
+        description = self.array_codecs.get(key)
+        if description is None:
+            return range_data[0]
+        parameters = description['subject_parameters'][index] if 'subject_parameters' in description else None
+        encoded_data = range_data if description['codec'] in VARIABLE_SIZE_CODECS else range_data[0]
+        return decode_subject(encoded_data, description['codec'], description['subject_shape'], description['dtype'],
+                              parameters, out=out)
+
+    def _read_encoded_subject(self, key, index, out=None):
+        # decode a single subject (index in the archive) of an encoded member of a npz archive
+        return self._decode_subject(key, index, self.archive.read_range(key, *self._subject_range(key, index)), out=out)
+
+    def _iter_archive_subjects(self, key, indices):
+        # subjects at indices (in the archive) of a npz member, read in a single stream through the member in the
+        # order of the archive and yielded in the order of indices (subjects read ahead are held until their turn)
+        ranges = [self._subject_range(key, index) for index in indices]
+        order = sorted(range(len(indices)), key=lambda position: ranges[position][0])
+        pending, next_position = {}, 0
+        for position, range_data in zip(order, self.archive.iter_ranges(key, [ranges[position] for position in order])):
+            pending[position] = range_data
+            while next_position in pending:
+                index = indices[next_position]
+                yield self._select_channels(key, self._decode_subject(key, index, pending.pop(next_position)), 3)
+                next_position += 1
+
+    def subject_array(self, key, index):
+        '''
+        Entry of the array stored under key for the subject at index, without decoding the other subjects
+        '''
+        key = self.resolve_key(key)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key][index]
+        if key not in self:
+            raise KeyError(key, 'not found in', self.path)
+        if self.archive is not None:
+            if key in self.array_codecs:
+                return self._select_channels(key, self._read_encoded_subject(key, self.parent_index(index)), 3)
+            return self._select_channels(key, self.archive.read_subject(key, self.archive_index(key, index)), 3)
+        if key in IMAGE_ARRAYS:
+            if key not in self.manifest['arrays']:
+                raise KeyError(key, 'is empty in', self.path)
+            return self._decode(key).load_subject(index)
+        return self.array(key)[index]
+
+    def iter_subjects(self, key):
+        '''
+        Iterate over the entries of the array stored under key, subject by subject
+        Members of npz archives are inflated in a single pass, without holding more than one subject in memory
+        (except for views not in the order of their parent, whose subjects read ahead are held until their turn).
+        '''
+        key = self.resolve_key(key)
+        if self.archive is None or key in self._cache or key not in self:
+            for index in range(len(self)):
+                yield self.subject_array(key, index)
+            return
+        yield from self._iter_archive_subjects(key, [self.archive_index(key, index) for index in range(len(self))])
+
+    def read_into(self, key, index, out):
+        '''
+        Write the entry of the array stored under key for the subject at index into a preallocated array
+        (eg. an entry of a batch). Sparse labels are decoded in place, without allocating a dense copy.
+        '''
+        key = self.resolve_key(key)
+        if key not in self._cache and self.archive is not None and key in self.array_codecs and \
+                self.selected_channels(key) is None:
+            return self._read_encoded_subject(key, self.parent_index(index), out=out)
+        if key not in self._cache and self.archive is None and key in self.manifest['arrays']:
+            return self._decode(key).read_subject_into(index, out)
+        out[...] = self.subject_array(key, index)
+        return out
+
+    def voxel_counts(self, key='ct_lesion_GT'):
+        '''
+        Number of nonzero voxels (eg. lesion volume in voxels) of every subject of a label array
+        Arrays saved with the sparse codec are not decoded, the others are read subject by subject.
+        '''
+        subject_parameters = self.codec_parameters(key)
+        if subject_parameters is not None and all('count' in parameters for parameters in subject_parameters):
+            return voxel_counts(subject_parameters)
+        return np.array([np.count_nonzero(subject_data) for subject_data in self.iter_subjects(key)])
+
+    def channel_statistics(self, key='ct_inputs', masked=False, n_bins=DEFAULT_N_BINS):
+        '''
+        Count, mean, std, min, max and histogram of every channel of an image array (see dataset_store.statistics),
+        computed in a single pass over the subjects
+        Statistics of stores are cached in the manifest (until subjects are added to the store).
+        :param masked: only use the voxels within the brain masks
+        :return: dict of lists with an entry per channel (selected channels only, for datasets opened with channels)
+        '''
+        key = self.resolve_key(key)
+        cache_name = key + ('_masked' if masked else '')
+        # statistics of views are computed on their subjects, selected channels are taken from the cached statistics
+        cached = None
+        if self.archive is None and self.view is None:
+            cached = load_manifest(self.data_path).get(CHANNEL_STATISTICS_KEY, {}).get(cache_name)
+        if cached is not None and len(cached['histogram'][0]['counts']) == n_bins:
+            channels = self.selected_channels(key)
+            if channels is None:
+                return cached
+            return {name: [values[channel] for channel in channels] for name, values in cached.items()}
+
+        print('Computing statistics of', key + (' inside brain masks' if masked else ''))
+        statistics = compute_channel_statistics(self.iter_subjects(key),
+                                                self.iter_subjects('brain_masks') if masked else None, n_bins)
+        if self.archive is None and self.view is None and self.selected_channels(key) is None:
+            manifest = load_manifest(self.data_path)
+            manifest.setdefault(CHANNEL_STATISTICS_KEY, {})[cache_name] = statistics
+            save_manifest(manifest, self.data_path)
+        return statistics
+
+    def load(self):
+        '''
+        :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+        '''
+        arrays = {}
+        for key in ['params', 'ids', 'clinical_inputs'] + IMAGE_ARRAYS:
+            key = self.resolve_key(key)
+            arrays[key] = self.array(key) if key in self else []
+
+        # ct_lesion_GT may be stored as lesion_GT in older datasets
+        ct_lesion_GT = arrays[self.resolve_key('ct_lesion_GT')]
+        return (arrays['clinical_inputs'], arrays['ct_inputs'], ct_lesion_GT, arrays['mri_inputs'],
+                arrays['mri_lesion_GT'], arrays['brain_masks'], arrays['ids'], arrays['params'])
+
+    def load_at_index(self, index: int):
+        '''
+        :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, id, params)
+            of a single subject
+        '''
+        subject_data = {}
+        for key in ['clinical_inputs'] + IMAGE_ARRAYS:
+            try:
+                subject_data[key] = self.subject_array(key, index)
+            except (KeyError, IndexError):
+                subject_data[key] = []
+
+        return (subject_data['clinical_inputs'], subject_data['ct_inputs'], subject_data['ct_lesion_GT'],
+                subject_data['mri_inputs'], subject_data['mri_lesion_GT'], subject_data['brain_masks'],
+                self.subject_array('ids', index), self.array('params'))
@@ -0,0 +1,75 @@
+import os
+import argparse
+import numpy as np
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.store import DatasetStoreWriter, write_subject_shards, IMAGE_ARRAYS
+from gsd_pipeline.dataset_store.codecs import get_dtype_policy
+
+
+def migrate_npz(npz_path, store_dir=None, dtype_policy=None, channel_shards=False):
+    '''
+    Convert a npz dataset (eg. standardized_ / comMin_ / padded_ variants of data_set.npz) to a dataset store
+    Every member of the archive is inflated once as a stream and written subject by subject to the shards of the
+    store, so that no member ever has to fit in memory.
+    Older archives with the CT lesion labels saved as lesion_GT are supported.
+    For archives built with clinical data, only the included subjects (see included_subjects) are migrated, with
+    their clinical inputs: like stores built from Nifti images, the store does not keep the excluded subjects.
+    :param store_dir: path of the store (default: path of the archive without .npz)
+    :param dtype_policy: cast and encode the arrays following this dtype policy (see codecs),
+        default: the policy recorded in the params of the archive, if any
+    :param channel_shards: save every channel of the inputs in its own shard (see store)
+    :return: path of the store
+    '''
+    if store_dir is None:
+        store_dir = os.path.splitext(npz_path)[0]
+    if os.path.exists(store_dir):
+        raise FileExistsError('Dataset store already exists:', store_dir)
+
+    with GSDDataset(npz_path, mmap_mode=None) as dataset:
+        params = dataset.params if 'params' in dataset else {}
+        if dtype_policy is not None:
+            get_dtype_policy(dtype_policy)
+            params = dict(params, dtype_policy=dtype_policy)
+        if channel_shards:
+            params = dict(params, channel_shards=True)
+        ids = [str(id) for id in dataset.ids]
+        writer = DatasetStoreWriter(store_dir, params)
+
+        # shards are written member by member, subjects are registered once all their arrays are written
+        array_descriptions = {id: {} for id in ids}
+        for array_name in IMAGE_ARRAYS:
+            if not dataset.has_array(array_name):
+                continue
+            n_subjects = 0
+            for id, subject_data in zip(ids, dataset.iter_subjects(array_name)):
+                array_descriptions[id].update(write_subject_shards(store_dir, id, {array_name: subject_data},
+                                                                   writer.dtype_policy, writer.channel_shards))
+                n_subjects += 1
+            if n_subjects != len(ids):
+                raise ValueError('Number of subjects in', array_name, 'does not match number of ids.',
+                                 n_subjects, len(ids))
+            print('Migrated', array_name, 'of', len(ids), 'subjects.')
+
+        for id in ids:
+            writer.register_subject(id, array_descriptions[id])
+        clinical_inputs = dataset.array('clinical_inputs') if 'clinical_inputs' in dataset else np.array([])
+        return writer.finalise(clinical_inputs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert npz datasets to dataset stores, one subject at a time')
+    parser.add_argument('data_paths', nargs='+')
+    parser.add_argument('-o', '--outdir', help='Directory of the stores (default: next to the archives)',
+                        required=False, default=None)
+    parser.add_argument('-d', '--dtype_policy', help='Dtype policy of the stores (default: policy of the archives)',
+                        required=False, default=None)
+    parser.add_argument('-c', '--channel_shards', action='store_true', default=False, required=False,
+                        help='Save every channel of the inputs in its own shard')
+
+    args = parser.parse_args()
+    for data_path in args.data_paths:
+        store_dir = None
+        if args.outdir is not None:
+            store_dir = os.path.join(args.outdir, os.path.splitext(os.path.basename(data_path))[0])
+        print('Migrating', data_path)
+        print('Saved', migrate_npz(data_path, store_dir, args.dtype_policy, args.channel_shards))
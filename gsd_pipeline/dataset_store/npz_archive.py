@@ -0,0 +1,169 @@
+import struct
+import zipfile
+import numpy as np
+
+# size of the fixed part of a zip local file header, followed by the file name and the extra field
+LOCAL_HEADER_SIZE = 30
+
+
+def read_into(file, out):
+    '''
+    Fill a preallocated array with the next bytes of a (possibly compressed) file stream
+    '''
+    buffer = memoryview(out.reshape(-1)).cast('B')
+    n_read = 0
+    while n_read < len(buffer):
+        chunk = file.read(len(buffer) - n_read)
+        if not chunk:
+            raise ValueError('Unexpected end of archive member.')
+        buffer[n_read:n_read + len(chunk)] = chunk
+        n_read += len(chunk)
+    return out
+
+
+class NpzArchive(object):
+    '''
+    Single-open reader of a (compressed or not) .npz archive
+    The zip directory is parsed once and the .npy header of every member is read without decoding its data,
+    so that single subjects can be read by streaming through a member instead of inflating all of it.
+    Members of uncompressed archives (np.savez) can be memory-mapped directly in the archive file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.zip_file = zipfile.ZipFile(path)
+        self.members = {name[:-len('.npy')]: name for name in self.zip_file.namelist() if name.endswith('.npy')}
+        self._headers = {}
+
+    def keys(self):
+        return list(self.members.keys())
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def close(self):
+        self.zip_file.close()
+
+    def header(self, key):
+        '''
+        :return: (shape, fortran_order, dtype, data_offset) of a member, data_offset being relative to the member start
+        '''
+        if key not in self._headers:
+            with self.zip_file.open(self.members[key]) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                elif version == (2, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format._read_array_header(f, version)
+                self._headers[key] = (shape, fortran_order, dtype, f.tell())
+        return self._headers[key]
+
+    def shape(self, key):
+        return self.header(key)[0]
+
+    def is_stored(self, key):
+        # uncompressed member
+        return self.zip_file.getinfo(self.members[key]).compress_type == zipfile.ZIP_STORED
+
+    def member_offset(self, key):
+        '''
+        :return: offset of the data of a stored member (after its .npy header) in the archive file
+        '''
+        info = self.zip_file.getinfo(self.members[key])
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            local_header = f.read(LOCAL_HEADER_SIZE)
+        if local_header[:4] != b'PK\x03\x04':
+            raise ValueError('Corrupted local header of', key, 'in', self.path)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        return info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length + self.header(key)[3]
+
+    def supports_memmap(self, key):
+        shape, fortran_order, dtype, _ = self.header(key)
+        return self.is_stored(key) and not dtype.hasobject and int(np.prod(shape)) > 0
+
+    def memmap(self, key, mode='c'):
+        '''
+        Memory-map a stored member without reading it. The default copy-on-write mode gives writable arrays
+        without ever modifying the archive.
+        '''
+        if not self.supports_memmap(key):
+            raise ValueError(key, 'is compressed or can not be memory-mapped in', self.path)
+        shape, fortran_order, dtype, _ = self.header(key)
+        return np.memmap(self.path, dtype=dtype, mode=mode, offset=self.member_offset(key), shape=shape,
+                         order='F' if fortran_order else 'C')
+
+    def read(self, key):
+        with self.zip_file.open(self.members[key]) as f:
+            return np.lib.format.read_array(f, allow_pickle=True)
+
+    def supports_subject_access(self, key):
+        shape, fortran_order, dtype, _ = self.header(key)
+        return len(shape) > 0 and not fortran_order and not dtype.hasobject
+
+    def read_subject(self, key, index):
+        '''
+        Read the entry at index along the first axis of a member
+        Data of the preceding subjects is decompressed chunk-wise and discarded, the following subjects are not read
+        (see read_range).
+        '''
+        shape = self.shape(key)
+        if not self.supports_subject_access(key):
+            return self.read(key)[index]
+        if index < 0:
+            index += shape[0]
+        if not 0 <= index < shape[0]:
+            raise IndexError('Index', index, 'out of range for', key, 'with', shape[0], 'subjects.')
+        return self.read_range(key, index, index + 1)[0]
+
+    def iter_subjects(self, key):
+        '''
+        Iterate over the entries along the first axis of a member, inflating the member once as a stream
+        Only the current entry is held in memory.
+        '''
+        shape, fortran_order, dtype, data_offset = self.header(key)
+        if not self.supports_subject_access(key):
+            yield from self.read(key)
+            return
+        with self.zip_file.open(self.members[key]) as f:
+            f.seek(data_offset)
+            for _ in range(shape[0]):
+                yield read_into(f, np.empty(shape[1:], dtype=dtype))
+
+    def iter_ranges(self, key, ranges):
+        '''
+        Iterate over the entries start:stop along the first axis of a member, for every (start, stop) of ranges
+        Compressed members are inflated once as a stream when the ranges are in increasing order: skipped entries are
+        inflated and discarded, going back to a preceding entry inflates the member again from its start.
+        '''
+        shape, fortran_order, dtype, data_offset = self.header(key)
+        if not self.supports_subject_access(key):
+            data = self.read(key)
+            for start, stop in ranges:
+                yield data[start:stop]
+            return
+        if self.supports_memmap(key):
+            data = self.memmap(key, mode='r')
+            for start, stop in ranges:
+                yield np.array(data[start:stop])
+            return
+        entry_size = dtype.itemsize * int(np.prod(shape[1:]))
+        with self.zip_file.open(self.members[key]) as f:
+            for start, stop in ranges:
+                start, stop = max(0, start), min(shape[0], stop)
+                range_data = np.empty((max(0, stop - start),) + tuple(shape[1:]), dtype=dtype)
+                if range_data.size > 0:
+                    f.seek(data_offset + start * entry_size)
+                    read_into(f, range_data)
+                yield range_data
+
+    def read_range(self, key, start, stop):
+        '''
+        Read the entries start:stop along the first axis of a member (eg. the encoded data of a subject saved with a
+        variable size codec), only reading the member up to stop
+        Compressed members are inflated from their start at every call, so that reading all subjects one call at a time
+        is quadratic in the member size: use iter_subjects or iter_ranges to read subjects in order.
+        '''
+        return next(self.iter_ranges(key, [(start, stop)]))
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+from multiprocessing import shared_memory
+import numpy as np
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.store import IMAGE_ARRAYS, json_compatible
+from gsd_pipeline.utils.shared_memory import attach_shared_memory, close_shared_memory
+
+# segments of the datasets attached by this process, kept open as long as the process lives
+_attached_segments = {}
+
+
+def descriptor_path(dataset_path):
+    '''
+    Path of the descriptor published by the server of a dataset, derived from the absolute dataset path
+    '''
+    dataset_key = hashlib.sha1(os.path.abspath(dataset_path).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f'gsd_shm_{dataset_key}.json')
+
+
+class SharedDatasetServer(object):
+    '''
+    Load a dataset once into shared memory segments, so that any number of processes can attach to the same copy
+    (see attach_dataset or data_loader.load_saved_data(..., attach=True)).
+    The descriptor (segment names, shapes, dtypes, ids, params) is published in a small json file: numpy values of the
+    params are served as python numbers and lists.
+    Segments are removed by close(), or when the server process exits.
+    :param pad_shape: spatial shape to pad the subjects of ragged stores to ('max': largest subject shape, see
+        GSDDataset), needed if their subjects do not have a common shape
+    '''
+
+    def __init__(self, dataset_path, pad_shape=None):
+        self.dataset_path = os.path.abspath(dataset_path)
+        self.descriptor_path = descriptor_path(dataset_path)
+        self.clinical_inputs_path = self.descriptor_path[:-len('.json')] + '_clinical_inputs.npy'
+        self.segments = []
+
+        descriptor = {'dataset_path': self.dataset_path, 'arrays': {}}
+        # arrays are decoded one at a time, so that at most one array is held outside of shared memory
+        with GSDDataset(dataset_path, cache_size=0, pad_shape=pad_shape) as dataset:
+            array_names = [array_name for array_name in IMAGE_ARRAYS if dataset.has_array(array_name)]
+            # the dataset is validated before any shared memory is allocated
+            if dataset.ragged and pad_shape is None:
+                ragged_arrays = [array_name for array_name in array_names
+                                 if dataset.array(array_name).subject_shape is None]
+                if len(ragged_arrays) > 0:
+                    raise ValueError('Subjects of', ragged_arrays, 'in', dataset_path, 'do not have a common shape, '
+                                     'give a pad_shape to serve them.')
+            descriptor['ids'] = [str(id) for id in dataset.ids]
+            descriptor['params'] = json_compatible(dataset.params)
+            try:
+                json.dumps(descriptor['params'])
+            except TypeError as error:
+                raise ValueError('Params of', dataset_path, 'can not be saved in the descriptor:', str(error))
+
+            try:
+                np.save(self.clinical_inputs_path, np.asarray(dataset.array('clinical_inputs')), allow_pickle=True)
+                self.serve_arrays(dataset, array_names, descriptor)
+                with open(self.descriptor_path + '.tmp', 'w') as f:
+                    json.dump(descriptor, f, indent=4)
+                os.replace(self.descriptor_path + '.tmp', self.descriptor_path)
+            except BaseException:
+                # segments allocated so far would outlive the failed server
+                self.close()
+                raise
+        print('Dataset served, descriptor:', self.descriptor_path)
+
+    def serve_arrays(self, dataset, array_names, descriptor):
+        '''
+        Copy the image arrays into new shared memory segments, subject by subject
+        '''
+        for array_name in array_names:
+            array = dataset.array(array_name)
+            shape, dtype = tuple(array.shape), np.dtype(array.dtype)
+            segment = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            self.segments.append(segment)
+            shared_array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            for subj_index in range(shape[0]):
+                shared_array[subj_index] = array[subj_index]
+            del shared_array, array
+            descriptor['arrays'][array_name] = {'segment': segment.name, 'shape': list(shape), 'dtype': dtype.str}
+            print('Serving', array_name, shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for path in (self.descriptor_path, self.clinical_inputs_path):
+            if os.path.exists(path):
+                os.remove(path)
+        for segment in self.segments:
+            close_shared_memory(segment, unlink=True)
+        self.segments = []
+
+
+def serve_dataset(dataset_path, pad_shape=None):
+    return SharedDatasetServer(dataset_path, pad_shape)
+
+
+def attach_dataset(dataset_path):
+    '''
+    Map the shared memory copy of a dataset served by a SharedDatasetServer (read-only)
+    :return: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+    '''
+    path = descriptor_path(dataset_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError('Dataset is not served in shared memory. Start a server first with '
+                                'python -m gsd_pipeline.dataset_store.shared_memory_server ' + dataset_path)
+    with open(path) as f:
+        descriptor = json.load(f)
+
+    segments = _attached_segments.setdefault(descriptor['dataset_path'], {})
+    arrays = {}
+    for array_name in IMAGE_ARRAYS:
+        if array_name not in descriptor['arrays']:
+            arrays[array_name] = np.array([])
+            continue
+        array_description = descriptor['arrays'][array_name]
+        segment_name = array_description['segment']
+        if segment_name not in segments:
+            segments[segment_name] = attach_shared_memory(segment_name)
+        array = np.ndarray(array_description['shape'], dtype=array_description['dtype'],
+                           buffer=segments[segment_name].buf)
+        array.flags.writeable = False
+        arrays[array_name] = array
+
+    clinical_inputs = np.load(path[:-len('.json')] + '_clinical_inputs.npy', allow_pickle=True)
+    return (clinical_inputs, arrays['ct_inputs'], arrays['ct_lesion_GT'], arrays['mri_inputs'], arrays['mri_lesion_GT'],
+            arrays['brain_masks'], np.array(descriptor['ids']), np.array(descriptor['params'], dtype=object))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a dataset in shared memory until interrupted')
+    parser.add_argument('data_path')
+    parser.add_argument('-p', '--pad_shape', nargs='+', required=False, default=None,
+                        help='Shape to pad the subjects of ragged stores to (x y z, or max)')
+
+    args = parser.parse_args()
+    pad_shape = args.pad_shape
+    if pad_shape is not None:
+        pad_shape = 'max' if pad_shape == ['max'] else tuple(int(size) for size in pad_shape)
+    with serve_dataset(args.data_path, pad_shape):
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            print('Stopping dataset server.')
@@ -0,0 +1,153 @@
+import os
+import argparse
+import numpy as np
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.views import save_view, view_path, is_dataset_view, VIEW_SUFFIX
+
+
+def quantile_bins(values, n_bins):
+    '''
+    Bin values into n_bins bins holding about the same number of subjects (NaN values get their own bin, -1)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    bins = np.full(len(values), -1)
+    known = ~np.isnan(values)
+    if not np.any(known):
+        return bins
+    edges = np.unique(np.quantile(values[known], np.linspace(0, 1, n_bins + 1)[1:-1]))
+    bins[known] = np.digitize(values[known], edges)
+    return bins
+
+
+def stratification_labels(dataset, label_key='ct_lesion_GT', clinical_columns=(), n_bins=3):
+    '''
+    Stratum of every subject, combining bins of its lesion volume and of the given clinical variables
+    :param clinical_columns: indices of the clinical inputs to stratify on (variables with at most n_bins values
+        are used as they are, others are binned by quantiles)
+    :return: array of stratum index per subject
+    '''
+    strata = []
+    if label_key is not None and dataset.has_array(label_key):
+        strata.append(quantile_bins(dataset.voxel_counts(label_key), n_bins))
+    if len(clinical_columns) > 0:
+        clinical_inputs = np.asarray(dataset.array('clinical_inputs'), dtype=np.float64)
+        for column in clinical_columns:
+            values = clinical_inputs[:, column]
+            if len(np.unique(values[~np.isnan(values)])) <= n_bins:
+                strata.append(np.where(np.isnan(values), -1, values))
+            else:
+                strata.append(quantile_bins(values, n_bins))
+    if len(strata) == 0:
+        return np.zeros(len(dataset), dtype=int)
+    return np.unique(np.stack(strata, axis=1), axis=0, return_inverse=True)[1].ravel()
+
+
+def stratified_folds(strata, n_folds, seed=None):
+    '''
+    Assign every subject to one of n_folds folds, every stratum being spread over all folds
+    :return: array of fold index per subject
+    '''
+    rng = np.random.default_rng(seed)
+    folds = np.empty(len(strata), dtype=int)
+    # the round robin goes on from one stratum to the next, so that small strata do not all start in fold 0
+    position = 0
+    for stratum in np.unique(strata):
+        members = rng.permutation(np.flatnonzero(strata == stratum))
+        folds[members] = (position + np.arange(len(members))) % n_folds
+        position += len(members)
+    return folds
+
+
+def stratified_split(strata, fractions, seed=None):
+    '''
+    Split subjects into len(fractions) parts (eg. train / validation / test), every stratum following the fractions
+    :return: array of part index per subject
+    '''
+    fractions = np.asarray(fractions, dtype=np.float64)
+    bounds = np.cumsum(fractions / np.sum(fractions))
+    rng = np.random.default_rng(seed)
+    parts = np.empty(len(strata), dtype=int)
+    for stratum in np.unique(strata):
+        members = rng.permutation(np.flatnonzero(strata == stratum))
+        # evenly spaced positions in [0, 1) with a random start, so that single subjects are split randomly
+        positions = (np.arange(len(members)) + rng.random()) / len(members)
+        parts[members] = np.minimum(np.searchsorted(bounds, positions, side='right'), len(fractions) - 1)
+    return parts
+
+
+def dataset_name(dataset_path):
+    if is_dataset_view(dataset_path):
+        return os.path.basename(dataset_path)[:-len(VIEW_SUFFIX)]
+    return os.path.splitext(os.path.basename(os.path.normpath(dataset_path)))[0]
+
+
+def create_kfold_views(dataset_path, n_folds=5, outdir=None, label_key='ct_lesion_GT', clinical_columns=(),
+                       n_bins=3, seed=None):
+    '''
+    Save train and validation views of every fold of a stratified k-fold split of a dataset
+    Subjects are stratified by lesion volume and by the given clinical variables (see stratification_labels).
+    :return: list of (train view path, validation view path) per fold
+    '''
+    outdir = os.path.dirname(os.path.abspath(dataset_path)) if outdir is None else outdir
+    with GSDDataset(dataset_path) as dataset:
+        ids = dataset.ids
+        folds = stratified_folds(stratification_labels(dataset, label_key, clinical_columns, n_bins), n_folds, seed)
+
+    view_paths = []
+    for fold in range(n_folds):
+        split = {'fold': fold, 'n_folds': n_folds, 'seed': seed, 'label_key': label_key,
+                 'clinical_columns': list(clinical_columns)}
+        name = f'{dataset_name(dataset_path)}_fold{fold}'
+        train_path = save_view(view_path(outdir, name + '_train'), dataset_path, ids[folds != fold],
+                               dict(split, part='train'))
+        val_path = save_view(view_path(outdir, name + '_val'), dataset_path, ids[folds == fold],
+                             dict(split, part='val'))
+        print('Fold', fold, ':', np.sum(folds != fold), 'training and', np.sum(folds == fold), 'validation subjects.')
+        view_paths.append((train_path, val_path))
+    return view_paths
+
+
+def create_split_views(dataset_path, fractions=(0.7, 0.15, 0.15), part_names=('train', 'val', 'test'), outdir=None,
+                       label_key='ct_lesion_GT', clinical_columns=(), n_bins=3, seed=None):
+    '''
+    Save a view per part of a stratified split of a dataset (default: train / validation / test)
+    :return: list of view paths
+    '''
+    if len(fractions) != len(part_names):
+        raise ValueError('Number of fractions does not match number of parts.', fractions, part_names)
+    outdir = os.path.dirname(os.path.abspath(dataset_path)) if outdir is None else outdir
+    with GSDDataset(dataset_path) as dataset:
+        ids = dataset.ids
+        parts = stratified_split(stratification_labels(dataset, label_key, clinical_columns, n_bins), fractions, seed)
+
+    view_paths = []
+    for part, part_name in enumerate(part_names):
+        split = {'part': part_name, 'fractions': list(fractions), 'seed': seed, 'label_key': label_key,
+                 'clinical_columns': list(clinical_columns)}
+        view_paths.append(save_view(view_path(outdir, f'{dataset_name(dataset_path)}_{part_name}'), dataset_path,
+                                    ids[parts == part], split))
+        print(part_name, ':', np.sum(parts == part), 'subjects.')
+    return view_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save stratified k-fold or train / validation / test views of a dataset')
+    parser.add_argument('data_path')
+    parser.add_argument('-k', '--n_folds', help='Number of folds of a k-fold split', required=False, type=int,
+                        default=None)
+    parser.add_argument('-f', '--fractions', nargs='+', help='Fractions of train / validation / test subjects',
+                        required=False, type=float, default=[0.7, 0.15, 0.15])
+    parser.add_argument('-c', '--clinical_columns', nargs='+', help='Indexes of clinical inputs to stratify on',
+                        required=False, type=int, default=[])
+    parser.add_argument('-s', '--seed', required=False, type=int, default=None)
+    parser.add_argument('-o', '--outdir', required=False, default=None)
+
+    args = parser.parse_args()
+    if args.n_folds is not None:
+        create_kfold_views(args.data_path, args.n_folds, args.outdir, clinical_columns=args.clinical_columns,
+                           seed=args.seed)
+    else:
+        part_names = ('train', 'val', 'test')[:len(args.fractions)] if len(args.fractions) <= 3 else \
+            tuple(f'part{part}' for part in range(len(args.fractions)))
+        create_split_views(args.data_path, args.fractions, part_names, args.outdir,
+                           clinical_columns=args.clinical_columns, seed=args.seed)
@@ -0,0 +1,179 @@
+import numpy as np
+
+# Per-channel statistics of image arrays (eg. ct_inputs) computed in a single pass over the subjects, holding a single
+# subject in memory: mean and variance are merged subject by subject (Chan et al. parallel variant of Welford's
+# algorithm) and percentiles are estimated from a histogram whose range grows with the data.
+
+DEFAULT_N_BINS = 2048
+
+
+class RunningHistogram(object):
+    '''
+    Histogram of n_bins bins of equal width, covering all values added so far
+    When values fall out of the range, the bin width is doubled (merging pairs of bins) until they are covered, so that
+    the histogram does not depend on a range known in advance. Percentiles are exact up to the final bin width.
+    '''
+
+    def __init__(self, n_bins=DEFAULT_N_BINS, low=None, width=None, counts=None):
+        if n_bins % 2 != 0:
+            raise ValueError('Number of bins must be even', n_bins)
+        self.n_bins = n_bins
+        self.low = low
+        self.width = width
+        self.counts = np.zeros(n_bins, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @property
+    def high(self):
+        return self.low + self.width * self.n_bins
+
+    def grow(self, downwards):
+        merged_counts = self.counts.reshape(-1, 2).sum(axis=1)
+        empty_counts = np.zeros(self.n_bins // 2, dtype=np.int64)
+        if downwards:
+            self.low -= self.width * self.n_bins
+            self.counts = np.concatenate((empty_counts, merged_counts))
+        else:
+            self.counts = np.concatenate((merged_counts, empty_counts))
+        self.width *= 2
+
+    def add(self, values, minimum=None, maximum=None):
+        if values.size == 0:
+            return
+        minimum = float(np.min(values)) if minimum is None else float(minimum)
+        maximum = float(np.max(values)) if maximum is None else float(maximum)
+        if self.low is None:
+            self.low = minimum
+            # constant values get a minimal width, that is widened with the range of further values
+            self.width = (maximum - minimum) / self.n_bins if maximum > minimum else \
+                max(abs(minimum), 1) * np.finfo(np.float64).eps
+        while minimum < self.low:
+            self.grow(downwards=True)
+        while maximum > self.high:
+            self.grow(downwards=False)
+        bins = ((values.ravel() - self.low) / self.width).astype(np.int64)
+        np.clip(bins, 0, self.n_bins - 1, out=bins)
+        self.counts += np.bincount(bins, minlength=self.n_bins)
+
+    def percentile(self, q, minimum=None, maximum=None):
+        '''
+        :param q: percentile(s) in [0, 100]
+        :return: value(s) interpolated linearly within the bins (and clipped to the minimum and maximum, if given)
+        '''
+        cumulative_counts = np.cumsum(self.counts)
+        ranks = np.asarray(q, dtype=np.float64) / 100 * cumulative_counts[-1]
+        bins = np.minimum(np.searchsorted(cumulative_counts, ranks, side='left'), self.n_bins - 1)
+        preceding_counts = np.where(bins > 0, cumulative_counts[bins - 1], 0)
+        fractions = (ranks - preceding_counts) / np.maximum(self.counts[bins], 1)
+        values = self.low + (bins + np.clip(fractions, 0, 1)) * self.width
+        if minimum is not None and maximum is not None:
+            values = np.clip(values, minimum, maximum)
+        return values
+
+    def to_dict(self):
+        return {'low': self.low, 'width': self.width, 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, histogram):
+        return cls(len(histogram['counts']), histogram['low'], histogram['width'], histogram['counts'])
+
+
+class ChannelStatistics(object):
+    '''
+    Running count, mean, variance, minimum, maximum and histogram of every channel of an image array
+    Channels are the 4th dimension of the subject arrays (x, y, z, c[, t]), single channel arrays are (x, y, z).
+    '''
+
+    def __init__(self, n_bins=DEFAULT_N_BINS):
+        self.n_bins = n_bins
+        self.channels = None
+
+    def add_channel(self, channel, values):
+        if values.size == 0:
+            return
+        statistics = self.channels[channel]
+        count = values.size
+        mean = np.mean(values, dtype=np.float64)
+        # sum of squared deviations of the subject, in float64
+        deviations = np.subtract(values, mean, dtype=np.float64)
+        m2 = np.dot(deviations.ravel(), deviations.ravel())
+        minimum, maximum = float(np.min(values)), float(np.max(values))
+
+        total_count = statistics['count'] + count
+        delta = mean - statistics['mean']
+        statistics['mean'] += delta * count / total_count
+        statistics['m2'] += m2 + delta ** 2 * statistics['count'] * count / total_count
+        statistics['count'] = total_count
+        statistics['min'] = min(statistics['min'], minimum)
+        statistics['max'] = max(statistics['max'], maximum)
+        statistics['histogram'].add(values, minimum, maximum)
+
+    def init_channels(self, n_channels):
+        if self.channels is None:
+            self.channels = [{'count': 0, 'mean': 0., 'm2': 0., 'min': np.inf, 'max': -np.inf,
+                              'histogram': RunningHistogram(self.n_bins)} for _ in range(n_channels)]
+        if n_channels != len(self.channels):
+            raise ValueError('Subject has', n_channels, 'channels instead of', len(self.channels))
+
+    def add_voxels(self, voxel_values):
+        '''
+        Add voxels already selected from a subject (eg. subject_data[mask])
+        :param voxel_values: (voxels, c[, t]) or (voxels) for single channel arrays
+        '''
+        voxel_values = np.asarray(voxel_values)
+        n_channels = voxel_values.shape[1] if voxel_values.ndim > 1 else 1
+        self.init_channels(n_channels)
+        for channel in range(n_channels):
+            self.add_channel(channel, voxel_values[:, channel] if voxel_values.ndim > 1 else voxel_values)
+
+    def add(self, subject_data, mask=None):
+        '''
+        Add the voxels of a subject (only those within the mask, if given)
+        '''
+        subject_data = np.asarray(subject_data)
+        if mask is not None:
+            self.add_voxels(subject_data[np.asarray(mask) > 0])
+            return
+        n_channels = subject_data.shape[3] if subject_data.ndim > 3 else 1
+        self.init_channels(n_channels)
+        for channel in range(n_channels):
+            self.add_channel(channel, subject_data[:, :, :, channel] if subject_data.ndim > 3 else subject_data)
+
+    def to_dict(self):
+        '''
+        :return: json-serialisable dict of lists (one entry per channel) of count, mean, std, min, max and histogram
+        '''
+        channels = [] if self.channels is None else self.channels
+        return {'count': [statistics['count'] for statistics in channels],
+                'mean': [float(statistics['mean']) for statistics in channels],
+                'std': [float(np.sqrt(statistics['m2'] / statistics['count'])) if statistics['count'] > 0 else 0.
+                        for statistics in channels],
+                'min': [statistics['min'] for statistics in channels],
+                'max': [statistics['max'] for statistics in channels],
+                'histogram': [statistics['histogram'].to_dict() for statistics in channels]}
+
+
+def compute_channel_statistics(subjects_data, subjects_masks=None, n_bins=DEFAULT_N_BINS):
+    '''
+    :param subjects_data: iterable of subject arrays (x, y, z[, c])
+    :param subjects_masks: iterable of masks (x, y, z) restricting the statistics to the voxels within the masks
+    :return: statistics dict (see ChannelStatistics.to_dict)
+    '''
+    statistics = ChannelStatistics(n_bins)
+    if subjects_masks is None:
+        for subject_data in subjects_data:
+            statistics.add(subject_data)
+    else:
+        for subject_data, mask in zip(subjects_data, subjects_masks):
+            statistics.add(subject_data, mask)
+    return statistics.to_dict()
+
+
+def channel_percentiles(statistics, q):
+    '''
+    Percentiles of every channel estimated from the histograms of the statistics
+    :param q: percentile or sequence of percentiles in [0, 100]
+    :return: array (channels[, percentiles])
+    '''
+    return np.array([RunningHistogram.from_dict(histogram).percentile(q, minimum, maximum)
+                     for histogram, minimum, maximum in zip(statistics['histogram'], statistics['min'],
+                                                            statistics['max'])])
@@ -0,0 +1,468 @@
+import os
+import json
+import numpy as np
+from gsd_pipeline.dataset_store.codecs import policy_dtypes, policy_codecs, encode_subject, decode_subject, \
+    max_reconstruction_error, merge_channel_parameters, select_channel_parameters, INPUT_ARRAYS
+
+# A dataset store is a directory holding one .npy shard per subject and per image array
+# (store_dir/<array_name>/<subject_id>.npy), a manifest.json (ids, params, array descriptions)
+# and a clinical_inputs.npy file. Shards are saved uncompressed so that they can be memory-mapped.
+# Shards of arrays encoded by the dtype policy of the dataset (see codecs) are decoded on read, the parameters
+# needed to decode the shard of a subject (eg. quantization scales) are saved under codec_parameters.
+# In ragged stores, every subject keeps its own spatial shape: the manifest then holds the layout of every shard
+# (shape, offset in the full image of the subject and spatial shape of the full image) under subject_layouts.
+# With channel_shards, every channel (4th dimension) of the input arrays is saved in its own shard
+# (store_dir/<array_name>/<subject_id>/<channel>.npy), so that single channels can be read without the others.
+
+STORE_FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+CLINICAL_INPUTS_NAME = 'clinical_inputs.npy'
+IMAGE_ARRAYS = ['ct_inputs', 'ct_lesion_GT', 'mri_inputs', 'mri_lesion_GT', 'brain_masks']
+# manifest entry caching the channel statistics of the image arrays (see GSDDataset.channel_statistics)
+CHANNEL_STATISTICS_KEY = 'channel_statistics'
+
+
+def is_dataset_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def load_manifest(store_dir):
+    with open(os.path.join(store_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, store_dir):
+    # write to a temporary file first, so that an interrupted save never leaves a truncated manifest
+    temp_path = os.path.join(store_dir, MANIFEST_NAME + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(temp_path, os.path.join(store_dir, MANIFEST_NAME))
+
+
+def json_compatible(value):
+    '''
+    Copy of value (eg. params) with numpy scalars and arrays converted to python numbers and lists, so that it can be
+    saved as json
+    '''
+    if isinstance(value, dict):
+        return {key.item() if isinstance(key, np.generic) else key: json_compatible(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_compatible(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return json_compatible(value.tolist())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def shard_path(store_dir, array_name, subject_id):
+    return os.path.join(store_dir, array_name, f'{subject_id}.npy')
+
+
+def channel_shard_path(store_dir, array_name, subject_id, channel):
+    return os.path.join(store_dir, array_name, subject_id, f'{channel}.npy')
+
+
+def subject_shard_paths(store_dir, manifest, array_name, subject_id):
+    '''
+    :return: path of the shard of a subject, or list of the paths of its channel shards
+    '''
+    array_description = manifest['arrays'][array_name]
+    if not array_description.get('channel_shards', False):
+        return shard_path(store_dir, array_name, subject_id)
+    if 'subject_layouts' in manifest:
+        n_channels = manifest['subject_layouts'][subject_id][array_name]['shape'][3]
+    else:
+        n_channels = array_description['subject_shape'][3]
+    return [channel_shard_path(store_dir, array_name, subject_id, channel) for channel in range(n_channels)]
+
+
+def is_empty_array(array):
+    return array is None or len(np.shape(array)) == 0 or len(array) == 0
+
+
+def spatial_shape(layout, uncrop=True):
+    # spatial shape of a subject once read from a ragged store
+    return list(layout['full_shape']) if uncrop else list(layout['shape'][0:3])
+
+
+def max_spatial_shape(layouts, uncrop=True):
+    return [int(size) for size in np.max([spatial_shape(layout, uncrop) for layout in layouts], axis=0)]
+
+
+def pad_subject(subject_data, pad_shape):
+    '''
+    Pad the spatial dimensions of a subject to pad_shape
+    As in data_loader.rectify_shape, missing z layers are prepended, missing x and y voxels are appended.
+    '''
+    missing = [target - size for target, size in zip(pad_shape, subject_data.shape[0:3])]
+    if any(n_missing < 0 for n_missing in missing):
+        raise ValueError('Subject of shape', subject_data.shape, 'is larger than the padding shape', pad_shape)
+    if not any(missing):
+        return subject_data
+    pad_width = ((0, missing[0]), (0, missing[1]), (missing[2], 0)) + ((0, 0),) * (subject_data.ndim - 3)
+    return np.pad(subject_data, pad_width, 'constant', constant_values=0)
+
+
+def uncrop_subject(subject_data, layout):
+    '''
+    Place the block saved for a subject back at its offset in the full image (zeros outside of the block)
+    '''
+    if list(subject_data.shape[0:3]) == list(layout['full_shape']):
+        return subject_data
+    full_data = np.zeros(tuple(layout['full_shape']) + subject_data.shape[3:], dtype=subject_data.dtype)
+    full_data[tuple(slice(offset, offset + size) for offset, size in zip(layout['offset'], subject_data.shape[0:3]))] \
+        = subject_data
+    return full_data
+
+
+class ShardedArray(object):
+    '''
+    Read-only array-like view over the per-subject shards of one image array of a dataset store.
+    Indexing along the first (subject) axis only maps the shards of the requested subjects,
+    every other index is applied to the memory-mapped shard of each subject.
+    Use np.asarray() to materialise the whole array in memory.
+
+    For ragged stores, layouts gives the layout of every shard. Cropped shards are placed back into the full image
+    of the subject (uncrop) and subjects can be padded to a common pad_shape on read. If subjects do not have a common shape, subject_shape is None, the array only has a
+    subject axis and slicing returns a list of subjects.
+    Only the given channels (4th dimension) are returned. If the channels of every subject are saved in their
+    own shards (paths are then lists of channel shard paths), only the shards of these channels are read.
+    '''
+
+    def __init__(self, paths, subject_shape, dtype, mmap_mode='r', layouts=None, uncrop=True, pad_shape=None,
+                 codec=None, codec_parameters=None, channels=None):
+        self.paths = list(paths)
+        self.channels = None if channels is None else list(channels)
+        # shape of the subjects with all their channels
+        self.saved_subject_shape = None if subject_shape is None else tuple(subject_shape)
+        self.subject_shape = self.saved_subject_shape
+        if self.subject_shape is not None and self.channels is not None:
+            self.subject_shape = self.subject_shape[0:3] + (len(self.channels),) + self.subject_shape[4:]
+        self.dtype = np.dtype(dtype)
+        self.mmap_mode = mmap_mode
+        self.layouts = layouts
+        self.uncrop = uncrop
+        self.pad_shape = pad_shape
+        self.codec = codec
+        self.codec_parameters = codec_parameters
+
+    @property
+    def shape(self):
+        if self.subject_shape is None:
+            return (len(self.paths),)
+        return (len(self.paths),) + self.subject_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.load_subject(index)
+
+    def load_shard(self, path, shard_shape, parameters):
+        shard_data = np.load(path, mmap_mode=self.mmap_mode)
+        if self.codec is not None:
+            shard_data = decode_subject(shard_data, self.codec, shard_shape, self.dtype, parameters)
+        return shard_data
+
+    def load_saved_subject(self, index):
+        # selected channels of the subject as saved (before uncropping and padding)
+        saved_shape = self.saved_subject_shape if self.layouts is None else tuple(self.layouts[index]['shape'])
+        parameters = None if self.codec_parameters is None else self.codec_parameters[index]
+        if not isinstance(self.paths[index], list):
+            subject_data = self.load_shard(self.paths[index], saved_shape, parameters)
+            if self.channels is not None:
+                subject_data = np.take(subject_data, self.channels, axis=3)
+            return subject_data
+
+        channels = range(len(self.paths[index])) if self.channels is None else self.channels
+        shard_shape = saved_shape[0:3] + (1,) + saved_shape[4:]
+        channel_data = [self.load_shard(self.paths[index][channel], shard_shape,
+                                        select_channel_parameters(parameters, [channel]))
+                        for channel in channels]
+        # a single channel is returned as mapped
+        return channel_data[0] if len(channel_data) == 1 else np.concatenate(channel_data, axis=3)
+
+    def load_subject(self, index):
+        subject_data = self.load_saved_subject(index)
+        if self.uncrop and self.layouts is not None:
+            subject_data = uncrop_subject(subject_data, self.layouts[index])
+        if self.pad_shape is not None:
+            subject_data = pad_subject(subject_data, self.pad_shape)
+        return subject_data
+
+    def read_subject_into(self, index, out):
+        '''
+        Decode the subject at index directly into a preallocated array (eg. an entry of a batch)
+        '''
+        if self.codec is None or self.layouts is not None or self.pad_shape is not None or self.channels is not None \
+                or isinstance(self.paths[index], list):
+            out[...] = self.load_subject(index)
+            return out
+        parameters = None if self.codec_parameters is None else self.codec_parameters[index]
+        return decode_subject(np.load(self.paths[index], mmap_mode=self.mmap_mode), self.codec, self.subject_shape,
+                              self.dtype, parameters, out=out)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 0 and key[0] is Ellipsis:
+            # the ellipsis also covers the subject axis
+            subject_key, subject_rest = slice(None), key
+        else:
+            subject_key, subject_rest = key[0], key[1:]
+
+        if isinstance(subject_key, (int, np.integer)):
+            return self.load_subject(subject_key)[subject_rest]
+
+        indices = np.arange(len(self))[subject_key]
+        if self.subject_shape is None:
+            return [self.load_subject(index)[subject_rest] for index in indices]
+        if len(indices) == 0:
+            return np.empty((0,) + self.subject_shape, dtype=self.dtype)[subject_rest]
+        return np.stack([self.load_subject(index)[subject_rest] for index in indices])
+
+    def __setitem__(self, key, value):
+        raise TypeError('Arrays of dataset stores are read-only, load them with mmap_mode=None (see load_saved_data) '
+                        'or np.asarray to modify them.')
+
+    def __array__(self, dtype=None, copy=None):
+        if self.subject_shape is None:
+            raise ValueError('Subjects of a ragged array do not have a common shape, load it with a pad_shape.')
+        array = np.empty(self.shape, dtype=self.dtype)
+        for index in range(len(self)):
+            array[index] = self.load_subject(index)
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
+
+
+def write_shard(path, shard_data):
+    # shards of existing subjects may be overwritten on update, thus they are replaced only once fully written
+    temp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(temp_path, shard_data)
+    os.replace(temp_path, path)
+
+
+def write_subject_shards(store_dir, subject_id, subject_arrays, dtype_policy=None, channel_shards=False):
+    '''
+    Write the shards of a single subject (can be called from worker processes)
+    :param subject_arrays: dict of image array name to subject data (None entries are skipped)
+    :param dtype_policy: cast and encode the arrays following this dtype policy (see codecs)
+    :param channel_shards: save every channel of the input arrays in its own shard
+    :return: dict of array name to array description (dtype, subject_shape, and codec and codec_parameters
+        of the subject for encoded arrays)
+    '''
+    dtypes = policy_dtypes(dtype_policy) if dtype_policy is not None else {}
+    codecs = policy_codecs(dtype_policy) if dtype_policy is not None else {}
+    array_descriptions = {}
+    for array_name, subject_data in subject_arrays.items():
+        if subject_data is None:
+            continue
+        subject_data = np.asarray(subject_data)
+        if array_name in dtypes:
+            subject_data = subject_data.astype(dtypes[array_name], copy=False)
+        array_description = {'dtype': subject_data.dtype.str, 'subject_shape': list(subject_data.shape)}
+        if channel_shards and array_name in INPUT_ARRAYS and subject_data.ndim > 3:
+            array_description['channel_shards'] = True
+            # channels keep their dimension, so that shards are encoded and decoded like subjects with one channel
+            shards = [(channel_shard_path(store_dir, array_name, subject_id, channel),
+                       subject_data[:, :, :, channel:channel + 1]) for channel in range(subject_data.shape[3])]
+            os.makedirs(os.path.join(store_dir, array_name, subject_id), exist_ok=True)
+        else:
+            shards = [(shard_path(store_dir, array_name, subject_id), subject_data)]
+            os.makedirs(os.path.join(store_dir, array_name), exist_ok=True)
+        if array_name in codecs:
+            array_description['codec'] = codecs[array_name]
+            encoded_shards = [encode_subject(shard_data, codecs[array_name]) for _, shard_data in shards]
+            shards = [(path, encoded_data) for (path, _), (encoded_data, _) in zip(shards, encoded_shards)]
+            codec_parameters = merge_channel_parameters([parameters for _, parameters in encoded_shards]) \
+                if len(encoded_shards) > 1 else encoded_shards[0][1]
+            if codec_parameters is not None:
+                array_description['codec_parameters'] = codec_parameters
+        for path, shard_data in shards:
+            write_shard(path, shard_data)
+        array_descriptions[array_name] = array_description
+    return array_descriptions
+
+
+class DatasetStoreWriter(object):
+    '''
+    Write a dataset store one subject at a time
+    Subjects are written to their shards as soon as they are appended, so that only the current subject
+    has to be held in memory. The manifest is only written by finalise().
+    Subjects appended with an id already present in the store replace the existing subject.
+    With ragged, subjects are not required to have the same spatial shape and the layout of every subject is saved.
+    Arrays are cast and encoded following the dtype policy recorded in params (if any).
+    '''
+
+    def __init__(self, store_dir, params, build_settings=None, ragged=False):
+        if isinstance(params, np.ndarray):
+            params = params.item()
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.manifest = {
+            'format_version': STORE_FORMAT_VERSION,
+            'ids': [],
+            'params': params,
+            'arrays': {}
+        }
+        if build_settings is not None:
+            # settings and source images used to build the store from Nifti images, needed to update it
+            self.manifest['build_settings'] = build_settings
+            self.manifest['sources'] = {}
+        if ragged:
+            self.manifest['subject_layouts'] = {}
+
+    @property
+    def dtype_policy(self):
+        return self.manifest['params'].get('dtype_policy')
+
+    @property
+    def ragged(self):
+        return 'subject_layouts' in self.manifest
+
+    @property
+    def channel_shards(self):
+        return self.manifest['params'].get('channel_shards', False)
+
+    @classmethod
+    def open(cls, store_dir):
+        '''
+        Writer adding subjects to an existing store
+        '''
+        writer = cls.__new__(cls)
+        writer.store_dir = store_dir
+        writer.manifest = load_manifest(store_dir)
+        return writer
+
+    def register_subject(self, subject_id, array_descriptions, sources=None, layouts=None):
+        '''
+        Add a subject whose shards have already been written (eg. by write_subject_shards in a worker process)
+        :param sources: dict of source image path to modification time
+        :param layouts: for ragged stores, dict of array name to offset and full_shape of the shard in the full image
+            of the subject (default: the shard is the full image)
+        '''
+        subject_id = str(subject_id)
+        # parameters of the subject are saved apart from the description of the arrays
+        subject_codec_parameters = {}
+        array_descriptions = dict(array_descriptions)
+        for array_name, array_description in array_descriptions.items():
+            if 'codec_parameters' in array_description:
+                array_description = dict(array_description)
+                subject_codec_parameters[array_name] = array_description.pop('codec_parameters')
+                array_descriptions[array_name] = array_description
+
+        if self.ragged:
+            subject_layouts = {}
+            for array_name, array_description in array_descriptions.items():
+                shape = array_description['subject_shape']
+                layout = {'shape': shape, 'offset': [0, 0, 0], 'full_shape': shape[0:3]}
+                if layouts is not None and array_name in layouts:
+                    layout.update(layouts[array_name])
+                subject_layouts[array_name] = layout
+            # only the dimensions following the spatial dimensions (channels, time) have to match
+            array_descriptions = {array_name: dict(array_description, subject_shape=None,
+                                                   trailing_shape=array_description['subject_shape'][3:])
+                                  for array_name, array_description in array_descriptions.items()}
+
+        for array_name, array_description in array_descriptions.items():
+            if array_name not in self.manifest['arrays']:
+                if len(self.manifest['ids']) > 0:
+                    raise ValueError(array_name, 'is missing for the subjects preceding', subject_id)
+                self.manifest['arrays'][array_name] = array_description
+            elif self.manifest['arrays'][array_name] != array_description:
+                raise ValueError('Subject', subject_id, 'does not match the', array_name, 'of the dataset.',
+                                 array_description, self.manifest['arrays'][array_name])
+        if set(array_descriptions.keys()) != set(self.manifest['arrays'].keys()):
+            raise ValueError('Subject', subject_id, 'does not have the same arrays as the dataset.',
+                             list(array_descriptions.keys()))
+        if subject_id not in self.manifest['ids']:
+            self.manifest['ids'].append(subject_id)
+        # cached statistics do not hold for the updated subjects
+        self.manifest.pop(CHANNEL_STATISTICS_KEY, None)
+        if self.ragged:
+            self.manifest['subject_layouts'][subject_id] = subject_layouts
+        for array_name, codec_parameters in subject_codec_parameters.items():
+            self.manifest.setdefault('codec_parameters', {}).setdefault(array_name, {})[subject_id] = codec_parameters
+        if sources is not None and 'sources' in self.manifest:
+            self.manifest['sources'][subject_id] = sources
+
+    def append(self, subject_id, subject_arrays, sources=None, layouts=None):
+        array_descriptions = write_subject_shards(self.store_dir, str(subject_id), subject_arrays, self.dtype_policy,
+                                                  self.channel_shards)
+        self.register_subject(subject_id, array_descriptions, sources, layouts)
+
+    def finalise(self, clinical_inputs=np.array([])):
+        for array_name, codec_parameters in self.manifest.get('codec_parameters', {}).items():
+            subject_parameters = [codec_parameters[id] for id in self.manifest['ids'] if id in codec_parameters]
+            if any('max_error' in parameters for parameters in subject_parameters):
+                print('Maximal reconstruction error of', array_name, max_reconstruction_error(subject_parameters))
+        np.save(os.path.join(self.store_dir, CLINICAL_INPUTS_NAME), np.asarray(clinical_inputs), allow_pickle=True)
+        save_manifest(self.manifest, self.store_dir)
+        return self.store_dir
+
+
+def save_dataset_store(dataset, outdir, out_store_name='data_set'):
+    '''
+    Save dataset as a directory store with one uncompressed .npy shard per subject and per image array
+    :param dataset: (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params)
+    :param outdir: directory in which the store is created
+    :param out_store_name: name of the store directory
+    :return: path to the store
+    '''
+    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = dataset
+
+    image_arrays = dict(zip(IMAGE_ARRAYS, (ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks)))
+    image_arrays = {array_name: array for array_name, array in image_arrays.items() if not is_empty_array(array)}
+    for array_name, array in image_arrays.items():
+        if len(array) != len(ids):
+            raise ValueError('Number of subjects in', array_name, 'does not match number of ids.', len(array), len(ids))
+
+    writer = DatasetStoreWriter(os.path.join(outdir, out_store_name), params)
+    for subj_index, id in enumerate(ids):
+        writer.append(id, {array_name: array[subj_index] for array_name, array in image_arrays.items()})
+
+    return writer.finalise(clinical_inputs)
+
+
+def load_store_array(store_dir, manifest, array_name, mmap_mode='r', uncrop=True, pad_shape=None, channels=None):
+    '''
+    :param uncrop: for cropped stores, return the full images of the subjects instead of the saved blocks
+    :param pad_shape: for ragged stores, spatial shape to pad all subjects to ('max' for the largest subject shape)
+    :param channels: indices of the channels (4th dimension) to read (default: all channels)
+    '''
+    if array_name not in manifest['arrays']:
+        return np.array([])
+    array_description = manifest['arrays'][array_name]
+    paths = [subject_shard_paths(store_dir, manifest, array_name, id) for id in manifest['ids']]
+    codec_parameters = None
+    if array_name in manifest.get('codec_parameters', {}):
+        codec_parameters = [manifest['codec_parameters'][array_name][id] for id in manifest['ids']]
+    if 'subject_layouts' not in manifest:
+        return ShardedArray(paths, array_description['subject_shape'], array_description['dtype'], mmap_mode=mmap_mode,
+                            codec=array_description.get('codec'), codec_parameters=codec_parameters,
+                            channels=channels)
+
+    layouts = [manifest['subject_layouts'][id][array_name] for id in manifest['ids']]
+    if isinstance(pad_shape, str) and pad_shape == 'max':
+        pad_shape = max_spatial_shape(layouts, uncrop) if len(layouts) > 0 else None
+    subject_shape = None
+    if pad_shape is not None:
+        subject_shape = list(pad_shape)[0:3] + array_description['trailing_shape']
+    elif len(layouts) > 0 and all(spatial_shape(layout, uncrop) == spatial_shape(layouts[0], uncrop)
+                                  for layout in layouts):
+        subject_shape = spatial_shape(layouts[0], uncrop) + array_description['trailing_shape']
+    return ShardedArray(paths, subject_shape, array_description['dtype'], mmap_mode=mmap_mode, layouts=layouts,
+                        uncrop=uncrop, pad_shape=pad_shape, codec=array_description.get('codec'),
+                        codec_parameters=codec_parameters, channels=channels)
@@ -0,0 +1,49 @@
+import os
+import json
+
+# A dataset view is a small json file (<name>.gsdview.json) referencing a parent dataset (npz archive or store) and
+# the ids of the subjects it holds. Views are opened like datasets (see GSDDataset, load_saved_data) and only read the
+# referenced subjects from the parent, so that subsets and splits do not have to be saved as copies of the dataset.
+
+VIEW_FORMAT_VERSION = 1
+VIEW_SUFFIX = '.gsdview.json'
+
+
+def is_dataset_view(path):
+    return path.endswith(VIEW_SUFFIX) and os.path.isfile(path)
+
+
+def view_path(outdir, name):
+    return os.path.join(outdir, name + VIEW_SUFFIX)
+
+
+def load_view(path):
+    '''
+    :return: view dict (parent: absolute path of the parent dataset, ids: ids of the subjects, and split details)
+    '''
+    with open(path) as f:
+        view = json.load(f)
+    # the parent is saved relative to the view, so that views can be moved with their dataset
+    view['parent'] = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), view['parent']))
+    return view
+
+
+def save_view(path, parent_path, ids, split=None):
+    '''
+    Save a view on the subjects ids of a parent dataset
+    Views on views reference the dataset of the parent view directly.
+    :param split: optional description of how the subjects were selected (eg. fold and seed)
+    :return: path of the view
+    '''
+    if is_dataset_view(parent_path):
+        parent_path = load_view(parent_path)['parent']
+    if not path.endswith(VIEW_SUFFIX):
+        path += VIEW_SUFFIX
+    view = {'format_version': VIEW_FORMAT_VERSION,
+            'parent': os.path.relpath(os.path.abspath(parent_path), os.path.dirname(os.path.abspath(path))),
+            'ids': [str(id) for id in ids]}
+    if split is not None:
+        view['split'] = split
+    with open(path, 'w') as f:
+        json.dump(view, f, indent=4)
+    return path
@@ -1,7 +1,9 @@
 import os
 import numpy as np
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from gsd_pipeline import data_loader as dl
+from gsd_pipeline.dataset_tools.transforms import Transform, replace_arrays, image_arrays
 from gsprep.utils.smoothing import gaussian_smoothing
 from gsprep.tools.perfusion_maps_tools.normalisation import normalise_by_contralateral_median
 from gsprep.tools.segmentation.ct_brain_extraction import ct_brain_extraction
@@ -9,72 +11,111 @@ import scipy.ndimage.morphology as ndimage
 from skimage.morphology import ball, disk
 
 
-def add_core_map(ct_dataset:[str, np.ndarray], masks = None, cbf_channel = 1, ncct_channel = 4, outfile = None, one_hot_encode_core=False, dilation_dimension=3):
+def core_sequences(one_hot_encode_core=False):
+    # names of the channels added to the CT inputs
+    if one_hot_encode_core:
+        return ['core_rCBF_0.38_class0', 'core_rCBF_0.38_class1']
+    return ['core_rCBF_0.38']
 
-    if int(dilation_dimension) == 2:
-        dilation_structure = dilation_structure_2d
-    elif int(dilation_dimension) == 3:
-        dilation_structure = dilation_structure_3d
-    else:
-        raise NotImplementedError
 
-    if isinstance(ct_dataset, str):
-        data_dir = os.path.dirname(ct_dataset)
-        file_name = os.path.basename(ct_dataset)
-        data = dl.load_saved_data(data_dir, file_name)
-        clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, masks, ids, params = data
-        if masks.size <= 1:
-            masks = None
-    else:
-        ct_inputs = ct_dataset
+def csf_threshold(ncct):
+    # 5th percentile of the non contrast CT values in (0, 100)
+    low_bounded_ncct = ncct[ncct > 0]
+    up_and_low_bounded_ncct = low_bounded_ncct[low_bounded_ncct < 100]
+    # threshold = 20
+    return np.percentile(up_and_low_bounded_ncct, 5)
 
-    n_subj, n_x, n_y, n_z, n_c = ct_inputs.shape
+
+def vessel_threshold(cbf):
+    return np.percentile(cbf, 99)
+
+
+def subject_core_map(subject_ct_inputs, csf_threshold, vessel_threshold, mask=None, cbf_channel=1, ncct_channel=4,
+                     one_hot_encode_core=False, dilation_dimension=3):
+    '''
+    Core (rCBF < 0.38 excluding CSF, major vessels and skull) of a single subject
+    :param subject_ct_inputs: (x, y, z, c)
+    :param csf_threshold, vessel_threshold: thresholds of the cohort (see csf_threshold and vessel_threshold)
+    :return: core map (x, y, z, 1), or (x, y, z, 2) if one hot encoded, in the dtype of the inputs
+    '''
+    dilation_structure = get_dilation_structure(dilation_dimension)
+    ncct = subject_ct_inputs[None, ..., ncct_channel, None]
 
     # Create CSF mask
-    low_bounded_ncct = ct_inputs[..., ncct_channel][ct_inputs[..., ncct_channel] > 0]
-    up_and_low_bounded_ncct = low_bounded_ncct[low_bounded_ncct < 100]
-    # threshold = 20
-    threshold = np.percentile(up_and_low_bounded_ncct, 5)
-    csf_mask = gaussian_smoothing(ct_inputs[..., ncct_channel, None], kernel_width=3) < threshold
-    enlarged_csf_mask = np.array(
-        [ndimage.binary_dilation(csf_mask[idx, ..., 0], structure=dilation_structure(2)) for idx in range(csf_mask.shape[0])])
+    csf_mask = gaussian_smoothing(ncct, kernel_width=3)[0, ..., 0] < csf_threshold
+    enlarged_csf_mask = ndimage.binary_dilation(csf_mask, structure=dilation_structure(2))
     inv_csf_mask = -1 * enlarged_csf_mask + 1
 
     # Create Skull mask
-    brain_mask = np.array([ct_brain_extraction(ct_inputs[subj, ..., ncct_channel], fsl_path='/usr/local/fsl/bin')[0]
-                           for subj in range(n_subj)])
+    brain_mask = ct_brain_extraction(subject_ct_inputs[..., ncct_channel], fsl_path='/usr/local/fsl/bin')[0]
     not_brain_mask = 1 - brain_mask
     # enlargen slighlty
-    enlarged_not_brain_mask = np.array(
-        [ndimage.binary_dilation(not_brain_mask[subj], dilation_structure(3)) for subj in range(n_subj)])
+    enlarged_not_brain_mask = ndimage.binary_dilation(not_brain_mask, dilation_structure(3))
     inv_skull_mask = 1 - enlarged_not_brain_mask
 
     ## Create major vessel mask
-    threshold = np.percentile(ct_inputs[..., cbf_channel], 99)
-    vessel_mask = ct_inputs[..., cbf_channel] > threshold
-    enlarged_vessel_mask = np.array(
-        [ndimage.binary_dilation(vessel_mask[idx], structure=dilation_structure(2)) for idx in range(vessel_mask.shape[0])])
-    vessel_mask = enlarged_vessel_mask
-    inv_vessel_mask = -1 * vessel_mask + 1
+    vessel_mask = subject_ct_inputs[..., cbf_channel] > vessel_threshold
+    enlarged_vessel_mask = ndimage.binary_dilation(vessel_mask, structure=dilation_structure(2))
+    inv_vessel_mask = -1 * enlarged_vessel_mask + 1
 
     ## Create Core mask
-    smooth_rCBF = normalise_by_contralateral_median(gaussian_smoothing(ct_inputs[..., 1, None], kernel_width=2))
-    smooth_core_masks = smooth_rCBF < 0.38
-    corr_csf_core_masks = smooth_core_masks * inv_csf_mask[..., None]
-    corr_vx_core_masks = corr_csf_core_masks * inv_vessel_mask[..., None]
-    corr_skull_core_masks = corr_vx_core_masks * inv_skull_mask[..., None]
-
-    if masks is not None:
+    # the smoothed CBF is a new array, normalised in place
+    smooth_rCBF = normalise_by_contralateral_median(
+        gaussian_smoothing(subject_ct_inputs[None, ..., 1, None], kernel_width=2), in_place=True)[0]
+    smooth_core_mask = smooth_rCBF < 0.38
+    corr_csf_core_mask = smooth_core_mask * inv_csf_mask[..., None]
+    corr_vx_core_mask = corr_csf_core_mask * inv_vessel_mask[..., None]
+    corr_skull_core_mask = corr_vx_core_mask * inv_skull_mask[..., None]
+
+    if mask is not None:
         # Restrict to defined prior mask
-        restr_core = corr_skull_core_masks * masks[..., None]
+        restr_core = corr_skull_core_mask * np.asarray(mask)[..., None]
     else:
-        restr_core = corr_skull_core_masks
+        restr_core = corr_skull_core_mask
 
     if one_hot_encode_core:
-        class_0_core = 1 - restr_core
-        class_1_core = restr_core
-        restr_core = np.concatenate((class_0_core, class_1_core), axis=-1)
+        restr_core = np.concatenate((1 - restr_core, restr_core), axis=-1)
 
+    # masks are computed as integers, keep the dtype of the inputs
+    return restr_core.astype(subject_ct_inputs.dtype)
+
+
+def add_core_map(ct_dataset:[str, np.ndarray], masks = None, cbf_channel = 1, ncct_channel = 4, outfile = None, one_hot_encode_core=False, dilation_dimension=3,
+                 n_workers=1):
+    '''
+    :param n_workers: number of threads computing the core maps of the subjects (brain extraction runs FSL in a
+        subprocess per subject)
+    '''
+    get_dilation_structure(dilation_dimension)
+
+    if isinstance(ct_dataset, str):
+        data_dir = os.path.dirname(ct_dataset)
+        file_name = os.path.basename(ct_dataset)
+        data = dl.load_saved_data(data_dir, file_name)
+        clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, masks, ids, params = data
+        if masks.size <= 1:
+            masks = None
+    else:
+        ct_inputs = ct_dataset
+
+    n_subj, n_x, n_y, n_z, n_c = ct_inputs.shape
+
+    # thresholds are computed over the whole cohort
+    cohort_csf_threshold = csf_threshold(ct_inputs[..., ncct_channel])
+    cohort_vessel_threshold = vessel_threshold(ct_inputs[..., cbf_channel])
+    restr_core = np.empty((n_subj, n_x, n_y, n_z, len(core_sequences(one_hot_encode_core))), dtype=ct_inputs.dtype)
+
+    def add_subject_core_map(subj):
+        restr_core[subj] = subject_core_map(ct_inputs[subj], cohort_csf_threshold, cohort_vessel_threshold,
+                                            None if masks is None else masks[subj], cbf_channel, ncct_channel,
+                                            one_hot_encode_core, dilation_dimension)
+
+    if n_workers <= 1:
+        for subj in range(n_subj):
+            add_subject_core_map(subj)
+    else:
+        with ThreadPoolExecutor(n_workers) as executor:
+            list(executor.map(add_subject_core_map, range(n_subj)))
     ct_inputs = np.concatenate((ct_inputs, restr_core), axis=-1)
 
     if isinstance(ct_dataset, str):
@@ -84,16 +125,62 @@ def add_core_map(ct_dataset:[str, np.ndarray], masks = None, cbf_channel = 1, nc
             else:
                 outfile = os.path.basename(ct_dataset).split('.')[0] + '_with_core.npz'
         params = params.item()
-        if one_hot_encode_core:
-            params['ct_sequences'].append('core_rCBF_0.38_class0')
-            params['ct_sequences'].append('core_rCBF_0.38_class1')
-        else:
-            params['ct_sequences'].append('core_rCBF_0.38')
+        params['ct_sequences'].extend(core_sequences(one_hot_encode_core))
         dataset = (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, masks, ids, params)
         dl.save_dataset(dataset, os.path.dirname(ct_dataset), out_file_name=outfile)
 
     return ct_inputs, restr_core
 
+
+class AddCoreMap(Transform):
+    '''
+    Add the core (see subject_core_map) as a CT channel, the CSF and vessel thresholds being computed over the cohort
+    '''
+    name = 'add_core_map'
+    needs_fit = True
+
+    def __init__(self, cbf_channel=1, ncct_channel=4, one_hot_encode_core=False, dilation_dimension=3):
+        get_dilation_structure(dilation_dimension)
+        self.cbf_channel = int(cbf_channel)
+        self.ncct_channel = int(ncct_channel)
+        self.one_hot_encode_core = one_hot_encode_core
+        self.dilation_dimension = int(dilation_dimension)
+        self.csf_threshold = None
+        self.vessel_threshold = None
+
+    def settings(self):
+        return {'cbf_channel': self.cbf_channel, 'ncct_channel': self.ncct_channel,
+                'one_hot_encode_core': self.one_hot_encode_core, 'dilation_dimension': self.dilation_dimension,
+                'csf_threshold': self.csf_threshold, 'vessel_threshold': self.vessel_threshold}
+
+    def fit(self, subjects):
+        # only the non contrast CT and CBF channels of the cohort are held in memory
+        ncct, cbf = [], []
+        for subject in subjects:
+            ct_inputs = np.asarray(subject['ct_inputs'])
+            ncct.append(ct_inputs[..., self.ncct_channel].ravel())
+            cbf.append(ct_inputs[..., self.cbf_channel].ravel())
+        self.csf_threshold = float(csf_threshold(np.concatenate(ncct)))
+        self.vessel_threshold = float(vessel_threshold(np.concatenate(cbf)))
+
+    def __call__(self, subject):
+        ct_inputs = np.asarray(subject['ct_inputs'])
+        mask = subject['brain_masks'] if 'brain_masks' in image_arrays(subject) else None
+        core_map = subject_core_map(ct_inputs, self.csf_threshold, self.vessel_threshold, mask, self.cbf_channel,
+                                    self.ncct_channel, self.one_hot_encode_core, self.dilation_dimension)
+        return replace_arrays(subject, {'ct_inputs': np.concatenate((ct_inputs, core_map), axis=-1)})
+
+    def update_params(self, params):
+        return dict(params, ct_sequences=list(params['ct_sequences']) + core_sequences(self.one_hot_encode_core))
+
+
+def get_dilation_structure(dilation_dimension):
+    if int(dilation_dimension) == 2:
+        return dilation_structure_2d
+    elif int(dilation_dimension) == 3:
+        return dilation_structure_3d
+    raise NotImplementedError
+
 def dilation_structure_3d(radius):
     return ball(radius)
 
@@ -108,8 +195,9 @@ if __name__ == '__main__':
     parser.add_argument('-nc', '--ncct_channel',  help='Non contrast CT Channel in dataset', required=False, default=4)
     parser.add_argument('-oh', '--one_hot_encode', action='store_true', default=False, required=False)
     parser.add_argument('-d', '--dilation_dimension', help='Dimension to perform dilations over (for thin datasets, 2 is preferred)', required=False, default=3)
+    parser.add_argument('-w', '--n_workers', help='Number of threads computing core maps', type=int, required=False, default=1)
 
 
     args = parser.parse_args()
-    add_core_map(args.data_path, outfile=args.outfile, cbf_channel=args.cbf_channel, ncct_channel=args.ncct_channel, one_hot_encode_core=args.one_hot_encode, dilation_dimension=args.dilation_dimension)
+    add_core_map(args.data_path, outfile=args.outfile, cbf_channel=args.cbf_channel, ncct_channel=args.ncct_channel, one_hot_encode_core=args.one_hot_encode, dilation_dimension=args.dilation_dimension, n_workers=args.n_workers)
 
@@ -9,7 +9,8 @@ def add_noise_to_channel(ct_dataset:[str, np.ndarray], channel_index=5, outfile=
     if isinstance(ct_dataset, str):
         data_dir = os.path.dirname(ct_dataset)
         file_name = os.path.basename(ct_dataset)
-        data = dl.load_saved_data(data_dir, file_name)
+        # noise is added in place
+        data = dl.load_saved_data(data_dir, file_name, mmap_mode=None)
         clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, masks, ids, params = data
         if masks.size <= 1:
             masks = None
@@ -4,6 +4,30 @@ import argparse
 from gsd_pipeline import data_loader as dl
 
 
+def penumbra_sequences(one_hot_encode=False):
+    # names of the channels added to the CT inputs
+    if one_hot_encode:
+        return ['penumbra_Tmax_6_class0', 'penumbra_Tmax_6_class1']
+    return ['penumbra_Tmax_6']
+
+
+def subject_penumbra_map(subject_ct_inputs, mask=None, tmax_channel=0, one_hot_encode=False):
+    '''
+    Penumbra (Tmax > 6s) of a single subject
+    :param subject_ct_inputs: (x, y, z, c)
+    :return: penumbra map (x, y, z, 1), or (x, y, z, 2) if one hot encoded, in the dtype of the inputs
+    '''
+    penumbra_mask = np.zeros(subject_ct_inputs.shape[0:3], dtype=subject_ct_inputs.dtype)
+    penumbra_mask[subject_ct_inputs[..., tmax_channel] > 6] = 1
+    if mask is not None:
+        # Restrict to defined prior mask
+        penumbra_mask = penumbra_mask * mask
+    penumbra_mask = np.expand_dims(penumbra_mask, axis=-1)
+    if one_hot_encode:
+        penumbra_mask = np.concatenate((1 - penumbra_mask, penumbra_mask), axis=-1)
+    return penumbra_mask
+
+
 def add_penumbra_map(ct_dataset:[str, np.ndarray], masks = None, tmax_channel = 0, outfile = None, one_hot_encode=False):
 
     if isinstance(ct_dataset, str):
@@ -18,7 +42,7 @@ def add_penumbra_map(ct_dataset:[str, np.ndarray], masks = None, tmax_channel =
 
     n_subj, n_x, n_y, n_z, n_c = ct_inputs.shape
 
-    penumbra_mask = np.zeros((n_subj, n_x, n_y, n_z))
+    penumbra_mask = np.zeros((n_subj, n_x, n_y, n_z), dtype=ct_inputs.dtype)
     penumbra_mask[ct_inputs[..., tmax_channel] > 6] = 1
 
     if masks is not None:
@@ -43,11 +67,7 @@ def add_penumbra_map(ct_dataset:[str, np.ndarray], masks = None, tmax_channel =
             else:
                 outfile = os.path.basename(ct_dataset).split('.')[0] + '_with_penumbra.npz'
         params = params.item()
-        if one_hot_encode:
-            params['ct_sequences'].append('penumbra_Tmax_6_class0')
-            params['ct_sequences'].append('penumbra_Tmax_6_class1')
-        else:
-            params['ct_sequences'].append('penumbra_Tmax_6')
+        params['ct_sequences'].extend(penumbra_sequences(one_hot_encode))
         dataset = (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, masks, ids, params)
         dl.save_dataset(dataset, os.path.dirname(ct_dataset), out_file_name=outfile)
 
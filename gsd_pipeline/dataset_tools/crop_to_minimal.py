@@ -1,110 +1,81 @@
 import os
-import shutil
-import tempfile
-
+import argparse
 import numpy as np
-import nibabel as nib
-from gsd_pipeline.data_loader import save_dataset, load_saved_data
-from gsd_pipeline.utils.utils import pad_to_shape
-import nilearn.image as nilimg
-
-def find_minimal_common_shape(data_dir, filename = 'data_set.npz'):
-    brain_masks = np.load(os.path.join(data_dir, filename), allow_pickle=True)['brain_masks']
-
-    cropped_brain_masks = []
-    crop_offsets = []
-    max_x, max_y, max_z = 0, 0, 0
-    for mask in brain_masks:
-        dummy_affine = np.eye(4)
-        mask_img = nib.Nifti1Image(mask.astype(int), affine=dummy_affine)
-        # crop to minimal non zero
-        cropped_mask, crop_offset = nilimg.image.crop_img(mask_img, return_offset=True)
-        cropped_mask_data = cropped_mask.get_fdata()
-        cropped_brain_masks.append(cropped_mask_data)
-        crop_offsets.append(crop_offset)
-        # find maximum shape for padding later
-        if cropped_mask_data.shape[0] > max_x: max_x = cropped_mask_data.shape[0]
-        if cropped_mask_data.shape[1] > max_y: max_y = cropped_mask_data.shape[1]
-        if cropped_mask_data.shape[2] > max_z: max_z = cropped_mask_data.shape[2]
-
-    minimal_common_shape = (max_x, max_y, max_z)
+from gsd_pipeline.data_loader import save_dataset
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_tools.transforms import CropToMinimal
+from gsd_pipeline.dataset_tools.transform_pipeline import run_pipeline
+from gsd_pipeline.utils.utils import bounding_box, crop_and_pad
+
+def find_minimal_common_shape(data_dir, filename = 'data_set.npz', margin=1):
+    '''
+    :param margin: voxels kept around the brain masks (1 like the crop of nilearn, within the image)
+    :return: minimal common shape (largest bounding box of the brain masks along every axis),
+        bounding box (tuple of slices) of every subject
+    '''
+    # masks are read one subject at a time
+    with GSDDataset(os.path.join(data_dir, filename)) as dataset:
+        crop_boxes = [bounding_box(mask, margin) for mask in dataset.iter_subjects('brain_masks')]
+
+    box_shapes = np.array([[box.stop - box.start for box in crop_box] for crop_box in crop_boxes])
+    minimal_common_shape = tuple(int(size) for size in np.max(box_shapes, axis=0))
     print('Found minimal common shape', minimal_common_shape)
-    return minimal_common_shape, crop_offsets
-
-def group_to_file(minimal_common_shape, data_dir, temp_dir, filename = 'data_set.npz', n_c = 4):
-    ids = np.load(os.path.join(data_dir, filename), allow_pickle=True)['ids']
-    clinical_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['clinical_inputs']
-    params = np.load(os.path.join(data_dir, filename), allow_pickle=True)['params']
-    mri_inputs = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_inputs']
-    mri_lesion_GT = np.load(os.path.join(data_dir, filename), allow_pickle=True)['mri_lesion_GT']
-
-    n_x, n_y, n_z = minimal_common_shape
-    final_ct_inputs = np.empty((len(ids), n_x, n_y, n_z, n_c))
-    final_ct_lesion_GT = np.empty((len(ids), n_x, n_y, n_z))
-    final_brain_masks = np.empty((len(ids), n_x, n_y, n_z), dtype=bool)
-
-    for subj_index, id in enumerate(ids):
-        print('Loading', subj_index, id)
-
-        load_padded_ct_input = nib.load(os.path.join(temp_dir, f'{id}_padded_ct_input.nii')).get_fdata()
-        load_padded_ct_lesion = nib.load(os.path.join(temp_dir, f'{id}_padded_ct_lesion.nii')).get_fdata()
-        load_padded_brain_mask = nib.load(os.path.join(temp_dir, f'{id}_padded_brain_mask.nii')).get_fdata()
-
-        final_ct_inputs[subj_index] = load_padded_ct_input
-        final_ct_lesion_GT[subj_index] = load_padded_ct_lesion
-        final_brain_masks[subj_index] = load_padded_brain_mask
-
-    dataset = (clinical_inputs, np.array(final_ct_inputs), np.array(final_ct_lesion_GT),
-               mri_inputs, mri_lesion_GT,
-               np.array(final_brain_masks), ids, params)
+    return minimal_common_shape, crop_boxes
 
-    save_dataset(dataset, data_dir, 'comMin_' + filename)
-
-def crop_to_minimal(data_dir, filename = 'data_set.npz', n_c=4):
+def crop_to_minimal(data_dir, filename = 'data_set.npz', n_c=None, margin=1):
     """
-    Crop all images of dataset to a common minimal shape and saves new dataset
+    Crop all images of dataset (CT, MRI, lesions and brain masks) to a common minimal shape and saves new dataset
+    with "comMin_" prefix
+    Every subject is cropped to the bounding box of its brain mask and padded to the largest bounding box. For npz
+    archives, every member is read in a single stream and its subjects are cropped directly into the preallocated
+    arrays of the new dataset, stores are cropped subject by subject into a new store.
     :param data_dir: dir containing dataset file
     :param filename: dataset filename
-    :param n_c: number of channels in CT image
+    :param n_c: not used anymore, the channels are those of the dataset
+    :param margin: voxels kept around the brain masks
     :return:
     """
 
     print('Cropping to Minimal Common shape')
-    print('WARNING: MRI files are not cropped for now.')
-
-    minimal_common_shape, crop_offsets = find_minimal_common_shape(data_dir, filename)
-
-    temp_dir = tempfile.mkdtemp()
-    print('Using temporary dir', temp_dir)
-
-    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = load_saved_data(data_dir, filename)
+    dataset_path = os.path.join(data_dir, filename)
+    minimal_common_shape, crop_boxes = find_minimal_common_shape(data_dir, filename, margin)
+    transform = CropToMinimal(margin, minimal_common_shape)
+
+    with GSDDataset(dataset_path) as dataset:
+        if dataset.archive is None:
+            run_pipeline(dataset_path, [transform], 'comMin_' + filename, data_dir)
+            return
+
+        # ids and clinical inputs of the included subjects only (see GSDDataset), aligned with the image arrays
+        ids = dataset.ids
+        if len(crop_boxes) != len(ids):
+            raise ValueError('Number of brain masks does not match number of ids.', len(crop_boxes), len(ids))
+        arrays = {}
+        for key in dataset.subject_arrays():
+            # every member is read in a single stream
+            for subj_index, (subject_data, crop_box) in enumerate(zip(dataset.iter_subjects(key), crop_boxes)):
+                if key not in arrays:
+                    # binary masks are kept as bool
+                    dtype = bool if key == 'brain_masks' else subject_data.dtype
+                    arrays[key] = np.zeros((len(ids),) + minimal_common_shape + subject_data.shape[3:],
+                                           dtype=dtype)
+                crop_and_pad(subject_data, crop_box, minimal_common_shape, out=arrays[key][subj_index])
+
+        params = dict(dataset.params)
+        params['transforms'] = list(params.get('transforms', [])) + [transform.description()]
+        empty = np.array([])
+        dataset = (dataset.array('clinical_inputs'), arrays.get('ct_inputs', empty), arrays.get('ct_lesion_GT', empty),
+                   arrays.get('mri_inputs', empty), arrays.get('mri_lesion_GT', empty),
+                   arrays.get('brain_masks', empty), ids, params)
 
-    for subj_index, id in enumerate(ids):
-        print('Processing', subj_index, id)
-
-        # Crop to minimal zero shape found above
-        ct_input_img = nib.Nifti1Image(ct_inputs[subj_index], np.eye(4))
-        cropped_ct_input_img = nilimg.image._crop_img_to(ct_input_img, crop_offsets[subj_index])
-        ct_lesion_img = nib.Nifti1Image(ct_lesion_GT[subj_index], np.eye(4))
-        cropped_ct_lesion_img = nilimg.image._crop_img_to(ct_lesion_img, crop_offsets[subj_index])
-        mask_img = nib.Nifti1Image(brain_masks[subj_index].astype(int), np.eye(4))
-        cropped_mask_img = nilimg.image._crop_img_to(mask_img, crop_offsets[subj_index])
-
-        # pad minimal common shape (found from max shapes of individual subjects)
-        padded_ct_input = pad_to_shape(cropped_ct_input_img.get_fdata(), minimal_common_shape)
-        padded_ct_lesion = pad_to_shape(cropped_ct_lesion_img.get_fdata(), minimal_common_shape)
-        padded_brain_mask = pad_to_shape(cropped_mask_img.get_fdata(), minimal_common_shape)
-
-        padded_ct_input_img = nib.Nifti1Image(padded_ct_input, np.eye(4))
-        padded_ct_lesion_img = nib.Nifti1Image(padded_ct_lesion, np.eye(4))
-        padded_brain_mask_img = nib.Nifti1Image(padded_brain_mask, np.eye(4))
-
-        nib.save(padded_ct_input_img, os.path.join(temp_dir, f'{id}_padded_ct_input.nii'))
-        nib.save(padded_ct_lesion_img, os.path.join(temp_dir, f'{id}_padded_ct_lesion.nii'))
-        nib.save(padded_brain_mask_img, os.path.join(temp_dir, f'{id}_padded_brain_mask.nii'))
+    save_dataset(dataset, data_dir, 'comMin_' + filename)
 
-    print('Processing done. Now loading files.')
 
-    group_to_file(minimal_common_shape, data_dir, temp_dir, filename, n_c)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crop dataset to the minimal shape common to all brain masks')
+    parser.add_argument('data_path')
+    parser.add_argument('-m', '--margin', help='Voxels kept around the brain masks', required=False, type=int,
+                        default=1)
 
-    shutil.rmtree(temp_dir)
+    args = parser.parse_args()
+    crop_to_minimal(os.path.dirname(args.data_path), os.path.basename(args.data_path), margin=args.margin)
@@ -1,48 +1,71 @@
-from skimage.transform import rescale, resize
+import os
+import argparse
 import numpy as np
-from gsd_pipeline.data_loader import load_saved_data, save_dataset
+from gsd_pipeline.utils.resampling import IMAGE_INTERPOLATIONS, LABEL_INTERPOLATIONS
+from gsd_pipeline.dataset_tools.transforms import Resample
+from gsd_pipeline.dataset_tools.transform_pipeline import run_pipeline
 
 
-def downsample_dataset(data_dir, scale_factor: float, filename = 'data_set.npz'):
+def downsample_dataset(data_dir, scale_factor: float, filename = 'data_set.npz', n_workers = 1,
+                       image_interpolation = 'linear', label_interpolation = 'majority'):
+    '''
+    Rescale all images of a dataset by scale_factor (single factor or factor along x, y and z)
+    Subjects are resampled in n_workers threads and saved with a "scale<factor>_" prefix.
+    '''
+    run_pipeline(os.path.join(data_dir, filename),
+                 [Resample(scale_factor=scale_factor, image_interpolation=image_interpolation,
+                           label_interpolation=label_interpolation)],
+                 f'scale{scale_factor}_' + filename, data_dir, n_workers=n_workers)
 
-    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = \
-        load_saved_data(data_dir, filename)
 
-    final_ct_inputs = []
-    final_ct_lesion_GT = []
-    final_brain_masks = []
+def downsample_dataset_to_shape(data_dir, target_shape: tuple, filename = 'data_set.npz', n_c_ct = 4, n_workers = 1,
+                                image_interpolation = 'linear', label_interpolation = 'majority'):
+    '''
+    Resize all images of a dataset to target_shape (x, y, z), n_c_ct is not used anymore
+    '''
+    run_pipeline(os.path.join(data_dir, filename),
+                 [Resample(target_shape=target_shape, image_interpolation=image_interpolation,
+                           label_interpolation=label_interpolation)],
+                 f'shape{target_shape[0]}x{target_shape[1]}x{target_shape[2]}_' + filename, data_dir,
+                 n_workers=n_workers)
 
-    for subj_idx, id, in enumerate(ids):
-        print('Scaling', subj_idx, id)
-        final_ct_inputs.append(rescale(ct_inputs[subj_idx], (scale_factor, scale_factor, scale_factor, 1)))
-        final_ct_lesion_GT.append(rescale(ct_lesion_GT[subj_idx], (scale_factor, scale_factor, scale_factor)))
-        final_brain_masks.append(rescale(brain_masks[subj_idx], (scale_factor, scale_factor, scale_factor)))
 
-    dataset = (clinical_inputs, np.array(final_ct_inputs), np.array(final_ct_lesion_GT),
-               mri_inputs, mri_lesion_GT,
-               np.array(final_brain_masks), ids, params)
+def downsample_dataset_to_spacing(data_dir, target_spacing: tuple, spacing: tuple = None, filename = 'data_set.npz',
+                                  n_workers = 1, image_interpolation = 'linear', label_interpolation = 'majority'):
+    '''
+    Resample all images of a dataset to an (anisotropic) voxel spacing
+    :param spacing: voxel spacing of the dataset (default: params['voxel_spacing'])
+    '''
+    run_pipeline(os.path.join(data_dir, filename),
+                 [Resample(target_spacing=target_spacing, spacing=spacing, image_interpolation=image_interpolation,
+                           label_interpolation=label_interpolation)],
+                 'spacing{}x{}x{}_'.format(*np.broadcast_to(target_spacing, 3)) + filename, data_dir,
+                 n_workers=n_workers)
 
-    save_dataset(dataset, data_dir, f'scale{scale_factor}_' + filename)
-
-
-def downsample_dataset_to_shape(data_dir, target_shape: tuple, filename = 'data_set.npz', n_c_ct = 4):
-    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = \
-        load_saved_data(data_dir, filename)
-
-    final_ct_inputs = []
-    final_ct_lesion_GT = []
-    final_brain_masks = []
-
-    for subj_idx, id, in enumerate(ids):
-        print('Scaling', subj_idx, id)
-        final_ct_inputs.append(resize(ct_inputs[subj_idx], target_shape + (n_c_ct,)))
-        final_ct_lesion_GT.append(resize(ct_lesion_GT[subj_idx], target_shape))
-        final_brain_masks.append(resize(brain_masks[subj_idx], target_shape))
-
-    dataset = (clinical_inputs, np.array(final_ct_inputs), np.array(final_ct_lesion_GT),
-               mri_inputs, mri_lesion_GT,
-               np.array(final_brain_masks), ids, params)
-
-    save_dataset(dataset, data_dir, f'shape{target_shape[0]}x{target_shape[1]}x{target_shape[2]}_' + filename)
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resample dataset by a scale factor, to a shape or to a voxel spacing')
+    parser.add_argument('data_path')
+    parser.add_argument('-s', '--scale_factor', nargs='+', type=float, required=False, default=None,
+                        help='Scale factor (single or along x, y and z)')
+    parser.add_argument('-t', '--target_shape', nargs=3, type=int, required=False, default=None)
+    parser.add_argument('-v', '--target_spacing', nargs='+', type=float, required=False, default=None)
+    parser.add_argument('-p', '--spacing', nargs='+', type=float, required=False, default=None,
+                        help='Voxel spacing of the dataset (default: from params)')
+    parser.add_argument('-i', '--image_interpolation', choices=IMAGE_INTERPOLATIONS, default='linear')
+    parser.add_argument('-l', '--label_interpolation', choices=LABEL_INTERPOLATIONS, default='majority')
+    parser.add_argument('-w', '--n_workers', type=int, required=False, default=1)
 
+    args = parser.parse_args()
+    data_dir, file_name = os.path.dirname(args.data_path), os.path.basename(args.data_path)
+    interpolations = {'image_interpolation': args.image_interpolation,
+                      'label_interpolation': args.label_interpolation}
+    if args.target_shape is not None:
+        downsample_dataset_to_shape(data_dir, tuple(args.target_shape), file_name, n_workers=args.n_workers,
+                                    **interpolations)
+    elif args.target_spacing is not None:
+        downsample_dataset_to_spacing(data_dir, args.target_spacing, args.spacing, file_name, args.n_workers,
+                                      **interpolations)
+    else:
+        scale_factor = args.scale_factor[0] if len(args.scale_factor) == 1 else args.scale_factor
+        downsample_dataset(data_dir, scale_factor, file_name, args.n_workers, **interpolations)
@@ -1,7 +1,6 @@
 import os, argparse
-from gsd_pipeline.data_loader import save_dataset, load_saved_data
-from gsd_pipeline.utils.utils import pad_to_shape
-import numpy as np
+from gsd_pipeline.dataset_tools.transforms import PadToShape
+from gsd_pipeline.dataset_tools.transform_pipeline import run_pipeline
 
 def pad_dataset_to_shape(dataset_path: str, shape: tuple):
     """
@@ -12,27 +11,8 @@ def pad_dataset_to_shape(dataset_path: str, shape: tuple):
     """
     data_dir = os.path.dirname(dataset_path)
     filename = os.path.basename(dataset_path)
-    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = \
-        load_saved_data(data_dir, filename)
-
-    padded_ct_inputs = np.array([pad_to_shape(ct_input, shape) for ct_input in ct_inputs])
-    padded_ct_lesion_GT = np.array([pad_to_shape(lesion_GT, shape) for lesion_GT in ct_lesion_GT])
-    padded_brain_masks = np.array([pad_to_shape(brain_mask, shape) for brain_mask in brain_masks])
-
-    if len(mri_inputs) == 0:
-        padded_mri_inputs = []
-    else:
-        padded_mri_inputs = np.array([pad_to_shape(mri_input, shape) for mri_input in mri_inputs])
-    if len(mri_lesion_GT) == 0:
-        padded_mri_lesion_GT = []
-    else:
-        padded_mri_lesion_GT = np.array([pad_to_shape(lesion_GT, shape) for lesion_GT in mri_lesion_GT])
-
-    dataset = (clinical_inputs, padded_ct_inputs, padded_ct_lesion_GT,
-               padded_mri_inputs, padded_mri_lesion_GT,
-               padded_brain_masks, ids, params)
-
-    save_dataset(dataset, data_dir, 'padded_' + filename)
+    # subjects are padded one at a time
+    run_pipeline(dataset_path, [PadToShape(shape)], 'padded_' + filename, data_dir)
 
 
 if __name__ == '__main__':
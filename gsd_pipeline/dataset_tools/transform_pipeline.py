@@ -0,0 +1,194 @@
+import os
+import copy
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from gsd_pipeline.data_loader import save_dataset, STORE_FORMATS
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.store import DatasetStoreWriter, IMAGE_ARRAYS
+from gsd_pipeline.dataset_store.splits import dataset_name
+from gsd_pipeline.dataset_tools.transforms import PadToShape, BinarizeMasks, CropToMinimal, RescaleOutliers, \
+    Standardise, AddPenumbraMap, Resample
+
+
+def add_core_map_transform(**kwargs):
+    # imported on use, as the core map depends on FSL brain extraction
+    from gsd_pipeline.dataset_tools.add_core_map import AddCoreMap
+    return AddCoreMap(**kwargs)
+
+
+TRANSFORMS = {
+    'pad_to_shape': PadToShape,
+    'binarize_masks': BinarizeMasks,
+    'crop_to_minimal': CropToMinimal,
+    'rescale_outliers': RescaleOutliers,
+    'standardise': Standardise,
+    'add_penumbra_map': AddPenumbraMap,
+    'resample': Resample,
+    'add_core_map': add_core_map_transform,
+}
+
+
+def apply_transforms(subject, transforms):
+    for transform in transforms:
+        subject = transform(subject)
+    return subject
+
+
+def map_subjects(function, subjects, n_workers=1):
+    '''
+    Apply function to every subject in n_workers threads, yielding the results in the order of the subjects
+    Subjects are read by the calling thread, at most 2 * n_workers ahead of the results being consumed.
+    '''
+    if n_workers <= 1:
+        for subject in subjects:
+            yield function(subject)
+        return
+    with ThreadPoolExecutor(n_workers) as executor:
+        pending = deque()
+        for subject in subjects:
+            pending.append(executor.submit(function, subject))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def fit_transforms(dataset, transforms):
+    '''
+    Compute the cohort statistics of the transforms needing them, in order
+    Every fit reads the dataset once (streaming through the members of npz archives, see GSDDataset.__iter__) and sees
+    the subjects as output by the preceding transforms.
+    '''
+    for step, transform in enumerate(transforms):
+        if transform.needs_fit:
+            print('Fitting', transform.name)
+            transform.fit(apply_transforms(subject, transforms[:step]) for subject in dataset)
+
+
+def save_subjects(subjects, n_subjects, params, outdir, out_file_name, store_format='npz', ragged=False):
+    '''
+    Save subjects (iterable of subject dicts) as a dataset, holding only one subject in memory for dataset stores
+    :param n_subjects: number of subjects (eg. len of the GSDDataset they are read from), to allocate npz arrays
+    '''
+    if store_format == 'store':
+        writer = DatasetStoreWriter(os.path.join(outdir, out_file_name), params, ragged=ragged)
+        clinical_inputs = []
+        for subject in subjects:
+            writer.append(subject['id'], {key: subject[key] for key in IMAGE_ARRAYS
+                                          if key in subject and np.size(subject[key]) > 0})
+            clinical_inputs.append(subject['clinical_inputs'])
+        clinical_inputs = np.array(clinical_inputs) if any(np.size(inputs) > 0 for inputs in clinical_inputs) \
+            else np.array([])
+        writer.finalise(clinical_inputs)
+        return
+
+    # arrays are allocated when the shapes of the transformed subjects are known
+    arrays = None
+    ids, clinical_inputs = [], []
+    for index, subject in enumerate(subjects):
+        if arrays is None:
+            arrays = {key: np.empty((n_subjects,) + np.shape(subject[key]), dtype=np.asarray(subject[key]).dtype)
+                      for key in IMAGE_ARRAYS if key in subject and np.size(subject[key]) > 0}
+        for key, array in arrays.items():
+            if np.shape(subject[key]) != array.shape[1:]:
+                raise ValueError('Subject', subject['id'], 'does not have the', key, 'shape of the dataset',
+                                 np.shape(subject[key]), 'use store_format="store" with ragged for subjects of '
+                                                         'different shapes.')
+            array[index] = subject[key]
+        ids.append(subject['id'])
+        clinical_inputs.append(subject['clinical_inputs'])
+    if len(ids) != n_subjects:
+        raise ValueError('Expected', n_subjects, 'subjects, got', len(ids))
+    arrays = {} if arrays is None else arrays
+    clinical_inputs = np.array(clinical_inputs) if any(np.size(inputs) > 0 for inputs in clinical_inputs) \
+        else np.array([])
+    dataset = (clinical_inputs, arrays.get('ct_inputs', np.array([])), arrays.get('ct_lesion_GT', np.array([])),
+               arrays.get('mri_inputs', np.array([])), arrays.get('mri_lesion_GT', np.array([])),
+               arrays.get('brain_masks', np.array([])), np.array(ids), params)
+    save_dataset(dataset, outdir, out_file_name)
+
+
+def run_pipeline(dataset_path, transforms, out_file_name=None, outdir=None, store_format=None, ragged=False,
+                 n_workers=1):
+    '''
+    Apply a chain of transforms to every subject of a dataset and save the result once
+    Cohort statistics are computed first (see fit_transforms), then every subject is read, passed through all
+    transforms and written, without saving intermediate datasets. Subjects are read in order, so that every member of
+    a compressed npz archive is inflated once per pass.
+    The descriptions of the transforms (with their fitted statistics) are appended to params['transforms'].
+    :param dataset_path: npz archive, dataset store or view
+    :param transforms: list of Transform (see transforms)
+    :param store_format: 'npz' or 'store' (default: format of the input dataset)
+    :param ragged: for stores, subjects may have different shapes after the transforms
+    :param n_workers: number of threads transforming subjects (eg. resampling), subjects are read and written in order
+    :return: path of the saved dataset
+    '''
+    data_dir = os.path.dirname(os.path.abspath(dataset_path))
+    outdir = data_dir if outdir is None else outdir
+    with GSDDataset(dataset_path) as dataset:
+        if store_format is None:
+            store_format = 'npz' if dataset.archive is not None else 'store'
+        if store_format not in STORE_FORMATS:
+            raise ValueError('Unknown store format', store_format, 'should be one of', STORE_FORMATS)
+        if out_file_name is None:
+            out_file_name = 'transformed_' + dataset_name(dataset_path) + ('.npz' if store_format == 'npz' else '')
+
+        fit_transforms(dataset, transforms)
+
+        params = copy.deepcopy(dataset.params)
+        for transform in transforms:
+            params = transform.update_params(params)
+        params['transforms'] = list(params.get('transforms', [])) + [transform.description() for transform in transforms]
+
+        print('Transforming', len(dataset), 'subjects with', [transform.name for transform in transforms])
+        subjects = map_subjects(lambda subject: apply_transforms(subject, transforms), dataset, n_workers)
+        save_subjects(subjects, len(dataset), params, outdir, out_file_name, store_format, ragged)
+    return os.path.join(outdir, out_file_name)
+
+
+def parse_value(value):
+    if '+' in value:
+        return [parse_value(element) for element in value.split('+')]
+    if value.lower() in ['true', 'false']:
+        return value.lower() == 'true'
+    for value_type in [int, float]:
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_transform(transform_spec):
+    '''
+    :param transform_spec: name[:argument=value[,argument=value]], sequences are separated by + (eg. shape=64+64+32)
+    :return: Transform
+    '''
+    name, _, arguments = transform_spec.partition(':')
+    if name not in TRANSFORMS:
+        raise ValueError('Unknown transform', name, 'should be one of', list(TRANSFORMS.keys()))
+    kwargs = {}
+    for argument in filter(None, arguments.split(',')):
+        key, _, value = argument.partition('=')
+        kwargs[key] = parse_value(value)
+    return TRANSFORMS[name](**kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply a chain of transforms to a dataset in a single pass')
+    parser.add_argument('data_path')
+    parser.add_argument('-t', '--transforms', nargs='+', required=True,
+                        help='Transforms in order, as name[:argument=value,...] (eg. rescale_outliers standardise:'
+                             'channels_to_leave_out=4 pad_to_shape:shape=256+256+100), one of '
+                             + ', '.join(TRANSFORMS.keys()))
+    parser.add_argument('-o', '--outfile', help='Name of output file', required=False, default=None)
+    parser.add_argument('-d', '--outdir', required=False, default=None)
+    parser.add_argument('-f', '--store_format', choices=STORE_FORMATS, required=False, default=None)
+    parser.add_argument('-r', '--ragged', action='store_true', default=False, required=False)
+    parser.add_argument('-w', '--n_workers', type=int, required=False, default=1)
+
+    args = parser.parse_args()
+    run_pipeline(args.data_path, [parse_transform(spec) for spec in args.transforms], args.outfile, args.outdir,
+                 args.store_format, args.ragged, args.n_workers)
@@ -0,0 +1,324 @@
+import numpy as np
+from gsd_pipeline.utils.utils import pad_to_shape, bounding_box, crop_and_pad, outlier_medians, outlier_channels
+from gsd_pipeline.dataset_store.store import IMAGE_ARRAYS
+from gsd_pipeline.utils.resampling import resample, scaled_shape, IMAGE_INTERPOLATIONS, LABEL_INTERPOLATIONS
+from gsd_pipeline.dataset_store.statistics import ChannelStatistics, channel_percentiles
+from gsd_pipeline.dataset_tools.add_penumbra_map import subject_penumbra_map, penumbra_sequences
+
+# Transforms of the dataset tools applied to one subject at a time, so that they can be chained by run_pipeline
+# (see transform_pipeline) in a single pass over the dataset.
+# A subject is a dict as returned by GSDDataset: id, clinical_inputs and the image arrays (x, y, z[, c]) of the subject.
+
+LABEL_ARRAYS = ['ct_lesion_GT', 'mri_lesion_GT', 'brain_masks']
+
+
+class Transform(object):
+    '''
+    Step of a transform pipeline
+    Transforms depending on statistics of the whole cohort (eg. standardisation) compute them in fit(), from the
+    subjects as output by the preceding steps of the pipeline, before any subject is transformed.
+    Transforms never modify the arrays of the subject they are given (these can be read-only memory maps).
+    '''
+    name = 'transform'
+    needs_fit = False
+
+    def settings(self):
+        # arguments of the transform, recorded in params['transforms']
+        return {}
+
+    def fit(self, subjects):
+        '''
+        :param subjects: iterable of subject dicts
+        '''
+        pass
+
+    def __call__(self, subject):
+        '''
+        :return: transformed subject dict
+        '''
+        return subject
+
+    def update_params(self, params):
+        '''
+        :return: params of the transformed dataset (eg. with added CT sequences)
+        '''
+        return params
+
+    def description(self):
+        return dict(self.settings(), name=self.name)
+
+
+def replace_arrays(subject, arrays):
+    return dict(subject, **arrays)
+
+
+def image_arrays(subject):
+    return [key for key in IMAGE_ARRAYS if key in subject and np.size(subject[key]) > 0]
+
+
+class PadToShape(Transform):
+    '''
+    Pad all images to a given spatial shape (equal padding on both sides)
+    '''
+    name = 'pad_to_shape'
+
+    def __init__(self, shape):
+        self.shape = tuple(int(size) for size in shape)
+
+    def settings(self):
+        return {'shape': list(self.shape)}
+
+    def __call__(self, subject):
+        return replace_arrays(subject, {key: pad_to_shape(np.asarray(subject[key]), self.shape)
+                                        for key in image_arrays(subject)})
+
+
+class BinarizeMasks(Transform):
+    '''
+    Binarize brain masks by thresholding, binary masks are kept as bool
+    '''
+    name = 'binarize_masks'
+
+    def __init__(self, threshold=0.1):
+        self.threshold = threshold
+
+    def settings(self):
+        return {'threshold': self.threshold}
+
+    def __call__(self, subject):
+        if 'brain_masks' not in image_arrays(subject):
+            return subject
+        return replace_arrays(subject, {'brain_masks': np.asarray(subject['brain_masks']) >= self.threshold})
+
+
+class CropToMinimal(Transform):
+    '''
+    Crop all images to the bounding box of the brain mask and pad them to the minimal shape common to all subjects
+    :param margin: voxels kept around the brain mask (1 like the crop of nilearn, within the image)
+    :param minimal_common_shape: common shape, if known (eg. from crop_to_minimal.find_minimal_common_shape)
+    '''
+    name = 'crop_to_minimal'
+
+    def __init__(self, margin=1, minimal_common_shape=None):
+        self.margin = int(margin)
+        self.minimal_common_shape = None if minimal_common_shape is None else \
+            tuple(int(size) for size in minimal_common_shape)
+        self.needs_fit = minimal_common_shape is None
+
+    def settings(self):
+        return {'margin': self.margin,
+                'minimal_common_shape': None if self.minimal_common_shape is None else list(self.minimal_common_shape)}
+
+    def fit(self, subjects):
+        shapes = []
+        for subject in subjects:
+            if 'brain_masks' not in image_arrays(subject):
+                raise ValueError('Brain masks are needed to crop subject', subject['id'])
+            shapes.append([box.stop - box.start for box in bounding_box(subject['brain_masks'], self.margin)])
+        self.minimal_common_shape = tuple(int(size) for size in np.max(shapes, axis=0))
+        print('Found minimal common shape', self.minimal_common_shape)
+
+    def __call__(self, subject):
+        box = bounding_box(subject['brain_masks'], self.margin)
+        return replace_arrays(subject, {key: crop_and_pad(subject[key], box, self.minimal_common_shape)
+                                        for key in image_arrays(subject)})
+
+
+class RescaleOutliers(Transform):
+    '''
+    Rescale outliers as some images from RAPID seem to be scaled x10 (see utils.rescale_outliers)
+    The median of every channel of every subject within its brain mask and the cohort median are computed in a single
+    pass by fit, outlier channels are then divided by scale when the subject is transformed
+    '''
+    name = 'rescale_outliers'
+    needs_fit = True
+
+    def __init__(self, factor=5, scale=10):
+        self.factor = factor
+        self.scale = scale
+        self.cohort_medians = None
+        self.outliers = {}
+
+    def settings(self):
+        return {'factor': self.factor, 'scale': self.scale,
+                'cohort_medians': None if self.cohort_medians is None else list(self.cohort_medians),
+                'outliers': self.outliers}
+
+    def fit(self, subjects):
+        ids = []
+
+        def masked_subjects():
+            for subject in subjects:
+                ids.append(str(subject['id']))
+                yield subject['ct_inputs'], subject['brain_masks']
+
+        subject_medians, cohort_medians = outlier_medians(masked_subjects())
+        self.cohort_medians = [float(median) for median in cohort_medians]
+        outliers = outlier_channels(subject_medians, cohort_medians, self.factor)
+        self.outliers = {id: np.flatnonzero(subject_outliers).tolist() for id, subject_outliers in zip(ids, outliers)
+                         if np.any(subject_outliers)}
+        print('Outliers (subject: channels)', self.outliers)
+
+    def __call__(self, subject):
+        outliers = self.outliers.get(str(subject['id']), [])
+        if len(outliers) == 0:
+            return subject
+        ct_inputs = np.array(subject['ct_inputs'])
+        for channel in outliers:
+            ct_inputs[..., channel] = ct_inputs[..., channel] / self.scale
+        return replace_arrays(subject, {'ct_inputs': ct_inputs})
+
+
+class Standardise(Transform):
+    '''
+    Standardise every CT and MRI channel with the mean and standard deviation of the cohort
+    CT channels are then scaled to [0, 1] with the minimum and maximum of the cohort (if min_max_scaling), or with
+    the given percentiles of the cohort (eg. (1, 99), values beyond them fall out of [0, 1]).
+    The statistics are computed in a single streaming pass (see dataset_store.statistics), unless they are given
+    (eg. cached statistics of the dataset, see GSDDataset.channel_statistics).
+    :param masked: compute the statistics within the brain masks only (they are applied to all voxels)
+    :param statistics: dict of array name (ct_inputs, mri_inputs) to statistics of this array
+    '''
+    name = 'standardise'
+
+    def __init__(self, channels_to_leave_out=(), min_max_scaling=True, masked=False, statistics=None,
+                 scaling_percentiles=None):
+        self.channels_to_leave_out = [int(channel) for channel in np.atleast_1d(channels_to_leave_out)]
+        self.min_max_scaling = min_max_scaling
+        self.masked = masked
+        self.scaling_percentiles = None if scaling_percentiles is None else [float(q) for q in scaling_percentiles]
+        self.statistics = {} if statistics is None else statistics
+        self.needs_fit = statistics is None
+
+    def settings(self):
+        # histograms are not recorded in params
+        return {'channels_to_leave_out': self.channels_to_leave_out, 'min_max_scaling': self.min_max_scaling,
+                'masked': self.masked, 'scaling_percentiles': self.scaling_percentiles,
+                'statistics': {key: {name: statistics[name] for name in ['mean', 'std', 'min', 'max']}
+                               for key, statistics in self.statistics.items()}}
+
+    def fit(self, subjects):
+        accumulators = {}
+        for subject in subjects:
+            mask = subject['brain_masks'] if self.masked else None
+            for key in ['ct_inputs', 'mri_inputs']:
+                if key in image_arrays(subject):
+                    accumulators.setdefault(key, ChannelStatistics()).add(subject[key], mask)
+        self.statistics = {key: accumulator.to_dict() for key, accumulator in accumulators.items()}
+
+    def scaling_range(self, statistics):
+        if self.scaling_percentiles is None:
+            return np.asarray(statistics['min']), np.asarray(statistics['max'])
+        percentiles = channel_percentiles(statistics, self.scaling_percentiles)
+        return percentiles[:, 0], percentiles[:, 1]
+
+    def __call__(self, subject):
+        arrays = {}
+        for key, statistics in self.statistics.items():
+            if key not in image_arrays(subject):
+                continue
+            # a single copy of the subject is standardised in place, channel by channel
+            data = np.asarray(subject[key])
+            standardised = np.array(data, dtype=data.dtype if data.dtype.kind == 'f' else np.float32)
+            scale_to_range = key == 'ct_inputs' and self.min_max_scaling
+            if scale_to_range:
+                low, high = self.scaling_range(statistics)
+            for channel, (mean, std) in enumerate(zip(statistics['mean'], statistics['std'])):
+                if key == 'ct_inputs' and channel in self.channels_to_leave_out:
+                    continue
+                channel_data = standardised[:, :, :, channel] if standardised.ndim > 3 else standardised
+                channel_data -= mean
+                channel_data /= std
+                if scale_to_range:
+                    # range of the standardised cohort
+                    standardised_low, standardised_high = (low[channel] - mean) / std, (high[channel] - mean) / std
+                    channel_data -= standardised_low
+                    channel_data /= standardised_high - standardised_low
+            arrays[key] = standardised
+        return replace_arrays(subject, arrays)
+
+
+class AddPenumbraMap(Transform):
+    '''
+    Add the penumbra (Tmax > 6s, restricted to the brain mask) as a CT channel
+    '''
+    name = 'add_penumbra_map'
+
+    def __init__(self, tmax_channel=0, one_hot_encode=False):
+        self.tmax_channel = int(tmax_channel)
+        self.one_hot_encode = one_hot_encode
+
+    def settings(self):
+        return {'tmax_channel': self.tmax_channel, 'one_hot_encode': self.one_hot_encode}
+
+    def __call__(self, subject):
+        ct_inputs = np.asarray(subject['ct_inputs'])
+        mask = subject['brain_masks'] if 'brain_masks' in image_arrays(subject) else None
+        penumbra_map = subject_penumbra_map(ct_inputs, mask, self.tmax_channel, self.one_hot_encode)
+        return replace_arrays(subject, {'ct_inputs': np.concatenate((ct_inputs, penumbra_map), axis=-1)})
+
+    def update_params(self, params):
+        return dict(params, ct_sequences=list(params['ct_sequences']) + penumbra_sequences(self.one_hot_encode))
+
+
+class Resample(Transform):
+    '''
+    Resample all images of a subject (see utils.resampling), by a scale factor, to a target shape or to a target voxel spacing
+    :param scale_factor: single factor or factor along x, y and z
+    :param target_shape: spatial shape (x, y, z)
+    :param target_spacing: voxel spacing (x, y, z), the voxel spacing of the dataset must then be given by spacing
+        or params['voxel_spacing']
+    :param image_interpolation: interpolation of CT and MRI inputs, one of IMAGE_INTERPOLATIONS
+    :param label_interpolation: interpolation of lesions and brain masks, one of LABEL_INTERPOLATIONS
+    '''
+    name = 'resample'
+
+    def __init__(self, scale_factor=None, target_shape=None, target_spacing=None, spacing=None,
+                 image_interpolation='linear', label_interpolation='majority'):
+        if sum(argument is not None for argument in [scale_factor, target_shape, target_spacing]) != 1:
+            raise ValueError('Exactly one of scale_factor, target_shape and target_spacing should be given.')
+        if image_interpolation not in IMAGE_INTERPOLATIONS:
+            raise ValueError('Unknown image interpolation', image_interpolation, 'should be one of',
+                             IMAGE_INTERPOLATIONS)
+        if label_interpolation not in LABEL_INTERPOLATIONS:
+            raise ValueError('Unknown label interpolation', label_interpolation, 'should be one of',
+                             LABEL_INTERPOLATIONS)
+        to_list = lambda values: None if values is None else [float(value) for value in np.broadcast_to(values, 3)]
+        self.scale_factor = to_list(scale_factor)
+        self.target_shape = None if target_shape is None else [int(size) for size in target_shape]
+        self.target_spacing = to_list(target_spacing)
+        self.spacing = to_list(spacing)
+        self.image_interpolation = image_interpolation
+        self.label_interpolation = label_interpolation
+
+    def settings(self):
+        return {'scale_factor': self.scale_factor, 'target_shape': self.target_shape,
+                'target_spacing': self.target_spacing, 'spacing': self.spacing,
+                'image_interpolation': self.image_interpolation, 'label_interpolation': self.label_interpolation}
+
+    def update_params(self, params):
+        if self.spacing is None and 'voxel_spacing' in params:
+            self.spacing = [float(size) for size in params['voxel_spacing']]
+        if self.target_spacing is not None:
+            if self.spacing is None:
+                raise ValueError('The voxel spacing of the dataset is needed to resample to a target spacing.')
+            return dict(params, voxel_spacing=self.target_spacing)
+        if self.scale_factor is not None and self.spacing is not None:
+            return dict(params, voxel_spacing=[size / factor for size, factor in zip(self.spacing, self.scale_factor)])
+        # the spacing after resampling to a shape depends on the shape of the subjects
+        return params
+
+    def out_shape(self, shape):
+        if self.target_shape is not None:
+            return tuple(self.target_shape)
+        if self.target_spacing is not None:
+            return scaled_shape(shape, np.asarray(self.spacing) / np.asarray(self.target_spacing))
+        return scaled_shape(shape, self.scale_factor)
+
+    def __call__(self, subject):
+        arrays = {}
+        for key in image_arrays(subject):
+            out_shape = self.out_shape(np.shape(subject[key]))
+            interpolation = self.label_interpolation if key in LABEL_ARRAYS else self.image_interpolation
+            arrays[key] = resample(subject[key], out_shape, interpolation)
+        return replace_arrays(subject, arrays)
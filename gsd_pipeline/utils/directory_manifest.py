@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+
+# manifests are saved outside of the directories they index: saving a manifest in its data directory would change the
+# mtime of this directory, and invalidate its own listing
+DIRECTORY_MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gsd_pipeline', 'directory_manifests')
+
+# manifests already loaded in this process, by data directory
+_loaded_manifests = {}
+
+
+def directory_manifest_path(data_dir):
+    '''
+    Default path of the manifest of a data directory, in DIRECTORY_MANIFEST_DIR
+    '''
+    data_dir = os.path.abspath(data_dir)
+    name = os.path.basename(data_dir) + '_' + hashlib.sha1(data_dir.encode('utf-8')).hexdigest()[:16] + '.json'
+    return os.path.join(DIRECTORY_MANIFEST_DIR, name)
+
+
+class DirectoryManifest(object):
+    '''
+    Persistent cache of the listing of a working directory and of the headers of its Nifti images
+    Directories are listed with os.scandir and their listing is reused as long as their mtime does not change.
+    Image headers (shape, dtype, affine, zooms) are read without decoding the image data and are reused
+    as long as the size and mtime of the image file do not change.
+    :param cache_path: path of the saved manifest (default: see directory_manifest_path), outside of data_dir
+    '''
+
+    def __init__(self, data_dir, cache_path=None):
+        self.data_dir = os.path.abspath(data_dir)
+        if cache_path is None:
+            cache_path = directory_manifest_path(self.data_dir)
+        self.cache_path = cache_path
+        self.directories = {}
+        self.modified = False
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path) as f:
+                    saved_manifest = json.load(f)
+                # listings are relative to the data directory
+                if saved_manifest['data_dir'] == self.data_dir:
+                    self.directories = saved_manifest['directories']
+            except (ValueError, KeyError):
+                print('Directory manifest is corrupted and will be rebuilt.', cache_path)
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), self.data_dir)
+
+    def _scan(self, directory):
+        relative_directory = self._relative(directory)
+        directory_mtime = os.stat(directory).st_mtime
+        cached_listing = self.directories.get(relative_directory)
+        if cached_listing is not None and cached_listing['mtime'] == directory_mtime:
+            return cached_listing
+
+        cached_files = cached_listing['files'] if cached_listing is not None else {}
+        listing = {'mtime': directory_mtime, 'subdirectories': [], 'files': {}}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    listing['subdirectories'].append(entry.name)
+                    continue
+                file_stat = entry.stat()
+                file_entry = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+                cached_file = cached_files.get(entry.name)
+                if cached_file is not None and 'header' in cached_file \
+                        and (cached_file['size'], cached_file['mtime']) == (file_entry['size'], file_entry['mtime']):
+                    file_entry['header'] = cached_file['header']
+                listing['files'][entry.name] = file_entry
+
+        self.directories[relative_directory] = listing
+        self.modified = True
+        return listing
+
+    def subdirectories(self, directory):
+        return list(self._scan(directory)['subdirectories'])
+
+    def files(self, directory):
+        return list(self._scan(directory)['files'].keys())
+
+    def entries(self, directory):
+        # equivalent of os.listdir
+        listing = self._scan(directory)
+        return listing['subdirectories'] + list(listing['files'].keys())
+
+    def file_info(self, path):
+        '''
+        :return: dict with size and mtime of the file (and its image header if it has already been read)
+        '''
+        return self._scan(os.path.dirname(path))['files'][os.path.basename(path)]
+
+    def image_header(self, path):
+        '''
+        Header of a Nifti image, read without decoding the image data
+        :return: dict with shape, dtype, affine and zooms
+        '''
+        file_entry = self.file_info(path)
+        # a file can be rewritten without changing the mtime of its directory
+        file_stat = os.stat(path)
+        if (file_stat.st_size, file_stat.st_mtime) != (file_entry['size'], file_entry['mtime']):
+            file_entry.update({'size': file_stat.st_size, 'mtime': file_stat.st_mtime})
+            file_entry.pop('header', None)
+
+        if 'header' not in file_entry:
+            image = nib.load(path)
+            file_entry['header'] = {
+                'shape': list(image.shape),
+                'dtype': np.dtype(image.get_data_dtype()).str,
+                'affine': np.asarray(image.affine).tolist(),
+                'zooms': [float(zoom) for zoom in image.header.get_zooms()]
+            }
+            self.modified = True
+        return file_entry['header']
+
+    def save(self):
+        if not self.modified:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            temp_path = self.cache_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({'data_dir': self.data_dir, 'directories': self.directories}, f)
+            os.replace(temp_path, self.cache_path)
+            self.modified = False
+        except OSError as e:
+            # the cache is only an optimisation, eg. read-only home directories are still usable
+            print('Directory manifest could not be saved.', self.cache_path, e)
+
+
+def load_directory_manifest(data_dir, cache_path=None):
+    '''
+    Directory manifest of data_dir, shared by all functions of this process
+    '''
+    key = (os.path.abspath(data_dir), cache_path)
+    if key not in _loaded_manifests:
+        _loaded_manifests[key] = DirectoryManifest(data_dir, cache_path)
+    return _loaded_manifests[key]
+
+
+def list_subdirectories(directory, directory_manifest=None):
+    if directory_manifest is not None:
+        return directory_manifest.subdirectories(directory)
+    return [o for o in os.listdir(directory) if os.path.isdir(os.path.join(directory, o))]
+
+
+def list_files(directory, directory_manifest=None):
+    if directory_manifest is not None:
+        return directory_manifest.files(directory)
+    return [o for o in os.listdir(directory) if os.path.isfile(os.path.join(directory, o))]
+
+
+def list_entries(directory, directory_manifest=None):
+    if directory_manifest is not None:
+        return directory_manifest.entries(directory)
+    return os.listdir(directory)
+
+
+def image_shape(path, directory_manifest=None):
+    if directory_manifest is not None:
+        return tuple(directory_manifest.image_header(path)['shape'])
+    # only the header is read
+    return nib.load(path).shape
@@ -0,0 +1,89 @@
+import numpy as np
+from skimage.transform import resize
+from gsd_pipeline.utils.utils import cast_to_dtype
+
+# Interpolations of the resampling engine:
+# - images: 'linear' (skimage resize, anti-aliased when downsampling) or 'area' (mean of the input voxels covered by
+#   every output voxel, weighted by their overlap)
+# - labels: 'nearest' or 'majority' (label covering most of every output voxel), so that labels stay labels
+# Area and majority are block means for integer factors and separable overlap weights otherwise.
+IMAGE_INTERPOLATIONS = ['linear', 'area']
+LABEL_INTERPOLATIONS = ['nearest', 'majority']
+
+
+def as_float(subject_data):
+    # interpolation is done in floating point (float64 data stays float64)
+    subject_data = np.asarray(subject_data)
+    return subject_data.astype(np.promote_types(subject_data.dtype, np.float32), copy=False)
+
+
+def scaled_shape(shape, scale_factor):
+    '''
+    :param scale_factor: single factor or factor along x, y and z
+    '''
+    return tuple(int(round(size * factor)) for size, factor in zip(shape[0:3], np.broadcast_to(scale_factor, 3)))
+
+
+def area_weights(n_in, n_out, dtype=np.float64):
+    '''
+    (n_out, n_in) matrix of the overlap of every output voxel with the input voxels, normalised by output voxel
+    '''
+    edges_in = np.arange(n_in + 1)
+    edges_out = np.linspace(0, n_in, n_out + 1)
+    overlap = np.minimum(edges_out[1:, None], edges_in[None, 1:]) - np.maximum(edges_out[:-1, None], edges_in[None, :-1])
+    overlap = np.maximum(overlap, 0)
+    return (overlap / overlap.sum(axis=1, keepdims=True)).astype(dtype)
+
+
+def area_resample(subject_data, out_shape):
+    data = as_float(subject_data)
+    for axis, n_out in enumerate(out_shape):
+        n_in = data.shape[axis]
+        if n_in == n_out:
+            continue
+        if n_in % n_out == 0:
+            # block mean for integer factors
+            factor = n_in // n_out
+            data = data.reshape(data.shape[:axis] + (n_out, factor) + data.shape[axis + 1:]).mean(axis=axis + 1)
+        else:
+            data = np.moveaxis(np.tensordot(area_weights(n_in, n_out, data.dtype), data, axes=(1, axis)), 0, axis)
+    return data
+
+
+def nearest_resample(subject_data, out_shape):
+    # input voxel at the centre of every output voxel
+    indices = [np.minimum(((np.arange(n_out) + 0.5) * n_in / n_out).astype(int), n_in - 1)
+               for n_in, n_out in zip(subject_data.shape[0:3], out_shape)]
+    return np.asarray(subject_data)[np.ix_(*indices)]
+
+
+def majority_resample(subject_data, out_shape):
+    subject_data = np.asarray(subject_data)
+    values = np.array([False, True]) if subject_data.dtype == bool else np.unique(subject_data)
+    if len(values) <= 2:
+        # binary labels: foreground where it covers at least half of the output voxel
+        fractions = area_resample(subject_data == values[-1], out_shape)
+        return np.where(fractions >= 0.5, values[-1], values[0])
+    fractions = np.stack([area_resample(subject_data == value, out_shape) for value in values])
+    return values[np.argmax(fractions, axis=0)]
+
+
+def linear_resample(subject_data, out_shape):
+    return resize(as_float(subject_data), tuple(out_shape) + np.shape(subject_data)[3:])
+
+
+RESAMPLING_FUNCTIONS = {'linear': linear_resample, 'area': area_resample, 'nearest': nearest_resample,
+                        'majority': majority_resample}
+
+
+def resample(subject_data, out_shape, interpolation='linear'):
+    '''
+    Resample the spatial dimensions of a subject array (x, y, z[, c]) to out_shape
+    :return: resampled array, cast back to the dtype of the input
+    '''
+    if interpolation not in RESAMPLING_FUNCTIONS:
+        raise ValueError('Unknown interpolation', interpolation, 'should be one of', list(RESAMPLING_FUNCTIONS.keys()))
+    subject_data = np.asarray(subject_data)
+    if tuple(subject_data.shape[0:3]) == tuple(out_shape):
+        return subject_data
+    return cast_to_dtype(RESAMPLING_FUNCTIONS[interpolation](subject_data, out_shape), subject_data.dtype)
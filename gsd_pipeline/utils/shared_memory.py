@@ -0,0 +1,25 @@
+import sys
+from multiprocessing import shared_memory, resource_tracker
+
+
+def attach_shared_memory(name):
+    '''
+    Attach to a segment owned by another (independent) process
+    Before python 3.13, attached segments are registered with the resource tracker of the attaching process,
+    which would unlink them when this process exits.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def close_shared_memory(segment, unlink=False):
+    try:
+        segment.close()
+    except BufferError:
+        # arrays still reference the segment, its memory is released once they are garbage collected
+        pass
+    if unlink:
+        segment.unlink()
@@ -1,56 +1,102 @@
 import os
 import numpy as np
-import nibabel as nib
 from sklearn.preprocessing import StandardScaler
+from gsd_pipeline.dataset_store.statistics import ChannelStatistics, channel_percentiles, DEFAULT_N_BINS
+from gsd_pipeline.utils.directory_manifest import load_directory_manifest, list_subdirectories, list_files, \
+    image_shape
 
 
-def find_max_shape(data_dir, file_name):
+def find_max_shape(data_dir, file_name, use_manifest=False):
     '''
     Given a directory and a filename, find the biggest dimension along x, y and z
+    Only image headers are read.
     :param data_dir:
     :param file_name: in which file to look for dimensions
+    :param use_manifest: use the cached directory manifest of data_dir (see directory_manifest)
     :return:
     '''
     max_x = 0; max_y = 0; max_z = 0;
-    subjects = [o for o in os.listdir(data_dir)
-                if os.path.isdir(os.path.join(data_dir, o))]
+    directory_manifest = load_directory_manifest(data_dir) if use_manifest else None
+    subjects = list_subdirectories(data_dir, directory_manifest)
 
     for subject in subjects:
         print(subject)
         subject_dir = os.path.join(data_dir, subject)
-        modalities = [o for o in os.listdir(subject_dir)
-                      if os.path.isdir(os.path.join(subject_dir, o))]
+        modalities = list_subdirectories(subject_dir, directory_manifest)
 
         for modality in modalities:
             modality_dir = os.path.join(subject_dir, modality)
-            studies = [o for o in os.listdir(modality_dir)
-                       if os.path.isfile(os.path.join(modality_dir, o))]
+            studies = list_files(modality_dir, directory_manifest)
 
             for study in studies:
                 study_path = os.path.join(modality_dir, study)
                 if study.startswith(file_name):
-                    img = nib.load(study_path)
-                    data = img.get_data()
-                    if data.shape[0] > max_x: max_x = data.shape[0]
-                    if data.shape[1] > max_y: max_y = data.shape[1]
-                    if data.shape[2] > max_z: max_z = data.shape[2]
+                    shape = image_shape(study_path, directory_manifest)
+                    if shape[0] > max_x: max_x = shape[0]
+                    if shape[1] > max_y: max_y = shape[1]
+                    if shape[2] > max_z: max_z = shape[2]
+
+    if directory_manifest is not None:
+        directory_manifest.save()
 
     return (max_x, max_y, max_z)
 
 
-def rescale_outliers(imgX, MASKS):
+def bounding_box(mask, margin=0):
+    '''
+    Bounding box of the nonzero voxels of a mask, extended by margin voxels on every side (within the image)
+    :param mask: (x, y, z) array
+    :return: tuple of slices along x, y and z (the whole image if the mask is empty)
+    '''
+    mask = np.asarray(mask) != 0
+    box = []
+    for axis in range(3):
+        # projection of the mask on this axis
+        nonzero = np.flatnonzero(mask.any(axis=tuple(other for other in range(mask.ndim) if other != axis)))
+        if len(nonzero) == 0:
+            return tuple(slice(0, size) for size in mask.shape[0:3])
+        box.append(slice(max(0, nonzero[0] - margin), min(mask.shape[axis], nonzero[-1] + 1 + margin)))
+    return tuple(box)
+
+
+def outlier_medians(subjects, n_bins=DEFAULT_N_BINS):
+    '''
+    Median within the brain mask of every channel, for every subject and for the whole cohort, in a single pass over
+    the subjects (holding one subject in memory)
+    The cohort median is estimated from a histogram of the masked voxels (exact up to its bin width, see
+    dataset_store.statistics), the subject medians are exact.
+    :param subjects: iterable of (subject image (x, y, z, c), subject mask (x, y, z))
+    :return: subject_medians (n, c), cohort_medians (c)
+    '''
+    statistics = ChannelStatistics(n_bins)
+    subject_medians = []
+    for subject_data, mask in subjects:
+        # the masked voxels of the subject are selected once, for its medians and the cohort histogram
+        masked_values = np.asarray(subject_data)[np.asarray(mask) > 0]
+        statistics.add_voxels(masked_values)
+        subject_medians.append(np.median(masked_values, axis=0))
+    return np.array(subject_medians), channel_percentiles(statistics.to_dict(), 50)
+
+
+def outlier_channels(subject_medians, cohort_medians, factor=5):
+    '''
+    :return: (n, c) boolean array, True for the channels of subjects whose median exceeds factor times the cohort median
+    '''
+    return np.asarray(subject_medians) > factor * np.asarray(cohort_medians)
+
+
+def rescale_outliers(imgX, MASKS, factor=5, scale=10):
     '''
     Rescale outliers as some images from RAPID seem to be scaled x10
-    Outliers are detected if their median exceeds 5 times the global median and are rescaled by dividing through 10
-    :param imgX: image data (n, x, y, z, c)
+    Channels of a subject are outliers if their median within the brain mask exceeds 5 times the median of the channel
+    within the brain masks of the cohort, and are rescaled by dividing through 10
+    :param imgX: image data (n, x, y, z, c), rescaled in place (channel by channel)
     :return: rescaled_imgX
     '''
-
-    for i in range(imgX.shape[0]):
-        for channel in range(imgX.shape[-1]):
-            median_channel = np.median(imgX[..., channel][MASKS])
-            if np.median(imgX[i, ..., 0][MASKS[i]]) > 5 * median_channel:
-                imgX[i, ..., 0] = imgX[i, ..., channel] / 10
+    subject_medians, cohort_medians = outlier_medians(zip(imgX, MASKS))
+    for i, channel in zip(*np.nonzero(outlier_channels(subject_medians, cohort_medians, factor))):
+        print('Rescaling channel', channel, 'of subject', i)
+        imgX[i, ..., channel] = imgX[i, ..., channel] / scale
 
     return imgX
 
@@ -67,6 +113,46 @@ def standardise(imgX, clinX):
     return rescaled_imgX, rescaled_clinX
 
 
+def cast_to_dtype(data, dtype):
+    '''
+    Cast data computed in floating point (eg. by interpolation) back to dtype
+    Binary and integer arrays are thresholded / rounded instead of being truncated.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return data.astype(dtype, copy=False)
+    if dtype.kind == 'b':
+        return data >= 0.5
+    return np.round(data).astype(dtype)
+
+
+def padding_offsets(array_shape, shape):
+    # offsets of an array padded to shape by pad_to_shape (odd paddings put the extra voxel after the array along x
+    # and y, before it along z)
+    return (int(np.floor((shape[0] - array_shape[0]) / 2)), int(np.floor((shape[1] - array_shape[1]) / 2)),
+            int(np.ceil((shape[2] - array_shape[2]) / 2)))
+
+
+def crop_and_pad(array, box, shape, out=None):
+    '''
+    Crop an array to a box and pad it to a spatial shape (placed like pad_to_shape), copying the box only once
+    :param array: (x, y, z[, ...]) array
+    :param box: tuple of slices along x, y and z (eg. from bounding_box)
+    :param shape: spatial shape (x, y, z) of the output
+    :param out: preallocated output (shape + trailing dimensions of array), filled with zeros (eg. an entry of an
+        array created with np.zeros)
+    :return: out
+    '''
+    block = array[box]
+    if out is None:
+        out = np.zeros(tuple(shape) + block.shape[3:], dtype=block.dtype)
+    if any(size > max_size for size, max_size in zip(block.shape, shape)):
+        raise ValueError('Box', block.shape[0:3], 'does not fit in shape', shape)
+    offsets = padding_offsets(block.shape, shape)
+    out[tuple(slice(offset, offset + size) for offset, size in zip(offsets, block.shape[0:3]))] = block
+    return out
+
+
 def pad_to_shape(array: np.ndarray, shape: tuple, constant_values=0):
     new_shape_greater_than_old_shape = np.all(tuple(i >= j for i, j in zip(shape, array.shape)))
     assert new_shape_greater_than_old_shape, 'New shape must be bigger than old shape.'
@@ -1,43 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from scipy.ndimage import map_coordinates
 
-def normalise_by_contralateral_median(data):
+
+def nonzero_median(values):
+    '''
+    Median of the non zero values, selected with a partial sort
+    :param values: array of values (modified)
+    '''
+    values = values[values != 0]
+    if values.size == 0:
+        return np.nan
+    middle = values.size // 2
+    if values.size % 2 != 0:
+        values.partition(middle)
+        return values[middle]
+    values.partition([middle - 1, middle])
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def nonzero_mean(values):
+    values = values[values != 0]
+    return np.mean(values) if values.size > 0 else np.nan
+
+
+def midline_distances(shape, angle=0, shift=0):
+    '''
+    Signed distance (in voxels) of every x, y position to the mid-sagittal plane
+    The plane goes through the center of the x, y plane shifted by shift voxels along its normal, its normal is the x
+    axis rotated by angle (degrees) towards y. With angle = shift = 0 the plane separates x < shape[0] / 2 from
+    x >= shape[0] / 2 (or passes through the middle voxel line if shape[0] is uneven).
+    :param shape: (x, y)
+    :return: distances (x, y), negative on the low x side
+    '''
+    angle = np.deg2rad(angle)
+    x, y = np.meshgrid(np.arange(shape[0]) - (shape[0] - 1) / 2, np.arange(shape[1]) - (shape[1] - 1) / 2,
+                       indexing='ij')
+    return x * np.cos(angle) + y * np.sin(angle) - shift
+
+
+def symmetry_score(image, angle, shift):
+    # correlation of the image with its reflection through the plane, within the union of both
+    distances = midline_distances(image.shape, angle, shift)
+    normal = np.array([np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))])
+    coordinates = np.indices(image.shape) - 2 * distances[None] * normal[:, None, None]
+    mirrored_image = map_coordinates(image, coordinates, order=1, cval=0)
+    union = (image != 0) | (mirrored_image != 0)
+    if np.count_nonzero(union) < 2:
+        return -np.inf
+    return np.corrcoef(image[union], mirrored_image[union])[0, 1]
+
+
+def find_midline(subject_data, max_angle=10, angle_step=2, max_shift=10):
+    '''
+    Estimate the mid-sagittal plane of a subject as the plane of best symmetry of its axial projection
+    Reflections through planes tilted up to max_angle degrees (by angle_step) and shifted up to max_shift voxels (by 1)
+    are scored by the correlation of the projection with its reflection, the best plane is then refined by half a
+    step in both angle and shift.
+    :param subject_data: image of a subject (x, y[, z, c])
+    :return: angle (degrees), shift (voxels) (see midline_distances)
+    '''
+    image = np.asarray(subject_data, dtype=np.float64).reshape(subject_data.shape[:2] + (-1,)).mean(axis=2)
+    candidates = [(angle, shift) for angle in np.arange(-max_angle, max_angle + angle_step / 2, angle_step)
+                  for shift in np.arange(-max_shift, max_shift + 0.5)]
+    best_angle, best_shift = max(candidates, key=lambda candidate: symmetry_score(image, *candidate))
+    candidates = [(best_angle + angle, best_shift + shift) for angle in (-angle_step / 2, 0, angle_step / 2)
+                  for shift in (-0.5, 0, 0.5)]
+    return max(candidates, key=lambda candidate: symmetry_score(image, *candidate))
+
+
+def contralateral_divisors(subject_data, distances):
+    '''
+    :return: (x, y) median non zero value of the contralateral side of every position, voxels on the midline are
+        divided by the mean of the mean non zero values of the adjacent voxel lines
+    '''
+    low_side, high_side = distances < 0, distances > 0
+    divisors = np.empty(distances.shape)
+    divisors[low_side] = nonzero_median(subject_data[high_side])
+    divisors[high_side] = nonzero_median(subject_data[low_side])
+    midline = distances == 0
+    if np.any(midline):
+        divisors[midline] = np.mean([nonzero_mean(subject_data[low_side & (distances >= -1)]),
+                                     nonzero_mean(subject_data[high_side & (distances <= 1)])])
+    return divisors
+
+
+def normalise_by_contralateral_median(data, detect_midline=False, in_place=False, n_workers=1):
     '''
     Normalise an image by dividing every voxel by the median voxel value of the contralateral side
     :param data: image input data for all subjects in form of an np array [n_subj, x, y, z, c]
+    :param detect_midline, default False: separate the sides by the estimated mid-sagittal plane of every subject
+        (see find_midline) instead of the middle of the x axis
+    :param in_place, default False: normalise data in place (data must be a floating point array)
+    :param n_workers: number of threads normalising subjects
     :return: normalised array
     '''
+    if in_place and not np.issubdtype(data.dtype, np.floating):
+        raise ValueError('Only floating point data can be normalised in place, not', data.dtype)
 
-    normalised_data = np.empty(data.shape)
+    normalised_data = data if in_place else np.empty(data.shape)
 
-    for subj in range(data.shape[0]):
+    def normalise_subject(subj):
         subj_data = data[subj]
-        subj_normalised_data = subj_data.copy()
-        x_center = subj_data.shape[0] // 2
-        left_side_set_off = x_center
-        if subj_data.shape[0] % 2 == 0:
-            # if number voxels along x is even, split in the middle
-            right_side_set_off = x_center
-        else:
-            # if number voxels along x is uneven leave out the middle voxel line
-            right_side_set_off = x_center + 1
-
-        # normalise left side
-        right_side = subj_data[right_side_set_off:]
-        right_side_median = np.median(right_side[np.nonzero(right_side)])
-        subj_normalised_data[:left_side_set_off] = np.divide(subj_data[:left_side_set_off], right_side_median)
-
-        # normalise right side
-        left_side = subj_data[:left_side_set_off]
-        left_side_median = np.median(left_side[np.nonzero(left_side)])
-        subj_normalised_data[right_side_set_off:] = np.divide(subj_data[right_side_set_off:], left_side_median)
-
-        if subj_data.shape[0] % 2 != 0:
-            x_para_median_slices_mean = np.mean([
-                                            np.mean(subj_data[x_center - 1][np.nonzero(subj_data[x_center - 1])]),
-                                            np.mean(subj_data[x_center + 1][np.nonzero(subj_data[x_center + 1])])
-                                        ])
-            subj_normalised_data[x_center] = np.divide(subj_data[x_center], x_para_median_slices_mean)
-
-        normalised_data[subj] = subj_normalised_data
+        angle, shift = find_midline(subj_data) if detect_midline else (0, 0)
+        divisors = contralateral_divisors(subj_data, midline_distances(subj_data.shape[:2], angle, shift))
+        np.divide(subj_data, divisors.reshape(divisors.shape + (1,) * (subj_data.ndim - 2)),
+                  out=normalised_data[subj])
+
+    if n_workers <= 1 or data.shape[0] <= 1:
+        for subj in range(data.shape[0]):
+            normalise_subject(subj)
+    else:
+        with ThreadPoolExecutor(n_workers) as executor:
+            list(executor.map(normalise_subject, range(data.shape[0])))
 
     return normalised_data
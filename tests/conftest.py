@@ -0,0 +1,146 @@
+import os
+import zipfile
+import numpy as np
+import nibabel as nib
+import pytest
+from gsd_pipeline.data_loader import save_dataset, load_saved_data
+from gsd_pipeline.dataset_store.store import DatasetStoreWriter
+from gsd_pipeline.utils import directory_manifest
+
+CT_SEQUENCES = ['wcoreg_Tmax', 'wcoreg_CBF', 'wcoreg_MTT', 'wcoreg_CBV']
+
+
+def synthetic_dataset(n_subjects=6, shape=(8, 9, 7), seed=0):
+    '''
+    :return: dataset tuple (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids,
+        params) of random images, with brain masks of different bounding boxes
+    '''
+    rng = np.random.default_rng(seed)
+    ct_inputs = (rng.random((n_subjects,) + shape + (len(CT_SEQUENCES),)) * 10).astype(np.float32)
+    ct_lesion_GT = (rng.random((n_subjects,) + shape) > 0.8).astype(np.uint8)
+    brain_masks = np.zeros((n_subjects,) + shape, dtype=bool)
+    for subject in range(n_subjects):
+        start = rng.integers(0, 3, size=3)
+        stop = np.array(shape) - rng.integers(0, 3, size=3)
+        brain_masks[subject, start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] = True
+    ids = np.array(['subj%d' % subject for subject in range(n_subjects)])
+    params = {'ct_sequences': CT_SEQUENCES, 'ct_label_sequences': ['masked_wcoreg_VOI'], 'mri_sequences': [],
+              'mri_label_sequences': []}
+    return (rng.random((n_subjects, 3)), ct_inputs, ct_lesion_GT, np.array([]), np.array([]), brain_masks, ids, params)
+
+
+def save_ragged_store(path):
+    '''
+    Save a ragged dataset store of synthetic subjects of two different shapes
+    '''
+    writer = DatasetStoreWriter(path, synthetic_dataset()[7], ragged=True)
+    for index, shape in enumerate([(8, 9, 7), (10, 9, 8), (8, 9, 7), (10, 9, 8), (10, 9, 8), (8, 9, 7)]):
+        subject = synthetic_dataset(n_subjects=1, shape=shape, seed=index)
+        writer.append('subj%d' % index, {'ct_inputs': subject[1][0], 'ct_lesion_GT': subject[2][0],
+                                         'brain_masks': subject[5][0]})
+    writer.finalise()
+    return path
+
+
+# subjects kept in the archives saved with exclusions
+INCLUDED_SUBJECTS = np.array([True, False, True, True, False, True])
+
+
+def included_dataset(dataset, included_subjects=INCLUDED_SUBJECTS):
+    '''
+    :return: dataset tuple of the included subjects only
+    '''
+    (clinical_inputs, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, ids, params) = dataset
+    return (clinical_inputs[included_subjects], ct_inputs[included_subjects], ct_lesion_GT[included_subjects],
+            mri_inputs, mri_lesion_GT, brain_masks[included_subjects], ids[included_subjects], params)
+
+
+def save_archive_with_exclusions(path, dataset=None, included_subjects=INCLUDED_SUBJECTS):
+    '''
+    Save a npz archive laid out like those built by load_and_save_data with clinical data: the ids and clinical inputs
+    of all subjects are kept next to included_subjects, the image arrays only hold the included subjects
+    '''
+    dataset = synthetic_dataset() if dataset is None else dataset
+    (_, ct_inputs, ct_lesion_GT, mri_inputs, mri_lesion_GT, brain_masks, _, _) = included_dataset(dataset,
+                                                                                                 included_subjects)
+    np.savez_compressed(path, params=dataset[7], ids=dataset[6], included_subjects=included_subjects,
+                        clinical_inputs=dataset[0], ct_inputs=ct_inputs, ct_lesion_GT=ct_lesion_GT,
+                        mri_inputs=mri_inputs, mri_lesion_GT=mri_lesion_GT, brain_masks=brain_masks)
+    return path
+
+
+def save_nifti_subjects(main_dir, shapes, seed=0):
+    '''
+    Save the Nifti images of synthetic subjects (subj0, subj1, ...) of the given shapes in main_dir,
+    with the layout expected by load_and_save_data
+    :return: dict of subject id to (ct_input, ct_lesion, brain_mask)
+    '''
+    rng = np.random.default_rng(seed)
+    subjects = {}
+    for index, shape in enumerate(shapes):
+        subject_dir = os.path.join(main_dir, 'subj%d' % index, 'pCT')
+        os.makedirs(subject_dir)
+        ct_input = rng.random(tuple(shape) + (len(CT_SEQUENCES),)) * 10
+        for channel, sequence in enumerate(CT_SEQUENCES):
+            nib.save(nib.Nifti1Image(ct_input[..., channel], np.eye(4)),
+                     os.path.join(subject_dir, sequence + '_subj%d.nii' % index))
+        ct_lesion = (rng.random(shape) > 0.8).astype(np.uint8)
+        nib.save(nib.Nifti1Image(ct_lesion, np.eye(4)),
+                 os.path.join(subject_dir, 'masked_wcoreg_VOI_subj%d.nii.gz' % index))
+        brain_mask = np.zeros(shape, dtype=np.uint8)
+        brain_mask[1:-1, 2:, 1:-2] = 1
+        nib.save(nib.Nifti1Image(brain_mask, np.eye(4)), os.path.join(subject_dir, 'brain_mask.nii'))
+        subjects['subj%d' % index] = (ct_input, ct_lesion, brain_mask.astype(bool))
+    return subjects
+
+
+@pytest.fixture(autouse=True)
+def directory_manifest_dir(tmp_path_factory, monkeypatch):
+    '''
+    Save the directory manifests of the tests in a temporary directory instead of the home directory
+    '''
+    manifest_dir = str(tmp_path_factory.mktemp('directory_manifests'))
+    monkeypatch.setattr(directory_manifest, 'DIRECTORY_MANIFEST_DIR', manifest_dir)
+    return manifest_dir
+
+
+@pytest.fixture
+def dataset_tuple():
+    return synthetic_dataset()
+
+
+@pytest.fixture
+def save_synthetic(tmp_path):
+    '''
+    Save a synthetic dataset with save_dataset, returning its path
+    '''
+    def save(name='data_set.npz', dataset=None, **kwargs):
+        save_dataset(synthetic_dataset() if dataset is None else dataset, str(tmp_path), name, **kwargs)
+        return os.path.join(str(tmp_path), name)
+    return save
+
+
+def load(path, **kwargs):
+    return load_saved_data(os.path.dirname(path), os.path.basename(path), **kwargs)
+
+
+@pytest.fixture
+def inflated_bytes(monkeypatch):
+    '''
+    Count the bytes read from (and inflated out of) npz archive members, including those skipped by seeking
+    '''
+    counter = {'bytes': 0}
+    read = zipfile.ZipExtFile.read
+
+    def counting_read(self, n=-1):
+        data = read(self, n)
+        counter['bytes'] += len(data)
+        return data
+
+    monkeypatch.setattr(zipfile.ZipExtFile, 'read', counting_read)
+    return counter
+
+
+def member_bytes(path):
+    with zipfile.ZipFile(path) as zip_file:
+        return sum(info.file_size for info in zip_file.infolist())
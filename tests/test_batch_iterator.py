@@ -0,0 +1,39 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.batch_iterator import BatchIterator
+from conftest import save_ragged_store
+
+
+def exit_worker(subject, rng):
+    # simulates a worker killed while assembling a batch (eg. out of memory)
+    os._exit(3)
+
+
+def test_batches_follow_subject_order(save_synthetic, dataset_tuple):
+    path = save_synthetic()
+    with BatchIterator(path, batch_size=4, arrays=('ct_inputs', 'brain_masks'), n_workers=2) as batches:
+        for epoch in range(2):
+            received = [(np.array(batch['ct_inputs']), np.array(batch['brain_masks'])) for batch in batches]
+            assert np.array_equal(np.concatenate([ct_inputs for ct_inputs, _ in received]), dataset_tuple[1])
+            assert np.array_equal(np.concatenate([masks for _, masks in received]), dataset_tuple[5])
+
+
+def test_dead_worker_raises(save_synthetic):
+    path = save_synthetic()
+    with BatchIterator(path, batch_size=2, n_workers=1, transform=exit_worker) as batches:
+        with pytest.raises(RuntimeError, match='exit code 3 while assembling batch 0'):
+            next(iter(batches))
+
+
+def test_ragged_store_needs_crop_or_pad_shape(tmp_path):
+    path = save_ragged_store(str(tmp_path / 'ragged'))
+
+    with pytest.raises(ValueError, match='crop_shape or a pad_shape'):
+        BatchIterator(path, batch_size=2)
+    with pytest.raises(ValueError, match='smaller than the crop_shape'):
+        BatchIterator(path, batch_size=2, crop_shape=(9, 9, 7))
+    with BatchIterator(path, batch_size=3, n_workers=1, crop_shape=(6, 6, 6)) as batches:
+        assert [batch['ct_inputs'].shape for batch in batches] == [(3, 6, 6, 6, 4)] * 2
+    with BatchIterator(path, batch_size=3, n_workers=1, pad_shape='max') as batches:
+        assert [batch['ct_inputs'].shape for batch in batches] == [(3, 10, 9, 8, 4)] * 2
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.data_loader import load_and_save_data, load_saved_data, load_saved_data_at_index
+from gsd_pipeline.dataset_store.dataset import resolve_channels
+from conftest import save_nifti_subjects, CT_SEQUENCES
+
+
+@pytest.fixture
+def sharded_store(tmp_path):
+    main_dir = str(tmp_path / 'main')
+    subjects = save_nifti_subjects(main_dir, [(8, 9, 7)] * 3)
+    load_and_save_data(str(tmp_path / 'out'), main_dir, 'data_set', store_format='store', channel_shards=True,
+                       dtype_policy='int16_quantized')
+    return str(tmp_path / 'out'), subjects
+
+
+def test_resolve_channels():
+    params = {'ct_sequences': CT_SEQUENCES}
+    assert resolve_channels(['wcoreg_MTT', 0], params) == [2, 0]
+    with pytest.raises(ValueError):
+        resolve_channels(['wcoreg_Tmax_RAPID'], params)
+
+
+@pytest.mark.parametrize('channels', [None, [1], ['wcoreg_CBV', 'wcoreg_Tmax']])
+def test_channels_of_sharded_store(sharded_store, channels):
+    data_dir, subjects = sharded_store
+    dataset = load_saved_data(data_dir, 'data_set', channels=channels)
+    indices = list(range(4)) if channels is None else resolve_channels(channels, dataset[7].item())
+    assert dataset[1].shape == (3, 8, 9, 7, len(indices))
+    expected = np.array([subjects[id][0][..., indices] for id in dataset[6]])
+    # int16 quantization of images in [0, 10]
+    assert np.max(np.abs(np.asarray(dataset[1]) - expected)) < 10 / 2 ** 16
+    subject = load_saved_data_at_index(1, data_dir, 'data_set', channels=channels)
+    assert np.allclose(subject[1], expected[1], atol=10 / 2 ** 16)
+
+
+def test_only_selected_channel_shards_are_read(sharded_store, monkeypatch):
+    data_dir, _ = sharded_store
+    read_paths = []
+    load = np.load
+
+    def recording_load(path, *args, **kwargs):
+        read_paths.append(str(path))
+        return load(path, *args, **kwargs)
+
+    monkeypatch.setattr(np, 'load', recording_load)
+    np.asarray(load_saved_data(data_dir, 'data_set', channels=['wcoreg_MTT'])[1])
+    ct_shards = [path for path in read_paths if path.startswith(os.path.join(data_dir, 'data_set', 'ct_inputs'))]
+    assert len(ct_shards) == 3 and all(os.path.basename(path) == '2.npy' for path in ct_shards)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.codecs import encode_subject, decode_subject, apply_dtype_policy, decode_array, \
+    policy_dtypes
+from conftest import load
+
+
+@pytest.mark.parametrize('dtype', [bool, np.uint8, np.float64])
+@pytest.mark.parametrize('shape', [(8, 9, 7), (5, 3, 1), (2, 2, 2)])
+def test_packbits_round_trip(dtype, shape):
+    subject_data = (np.random.default_rng(0).random(shape) > 0.5).astype(dtype)
+    encoded_data, parameters = encode_subject(subject_data, 'packbits')
+    assert parameters is None and encoded_data.nbytes == -(-subject_data.size // 8)
+    decoded_data = decode_subject(encoded_data, 'packbits', shape, dtype)
+    assert decoded_data.dtype == dtype and np.array_equal(decoded_data, subject_data)
+
+    out = np.full(shape, 7, dtype=dtype)
+    decode_subject(encoded_data, 'packbits', shape, dtype, out=out)
+    assert np.array_equal(out, subject_data)
+
+
+def test_packbits_rejects_non_binary_data():
+    with pytest.raises(ValueError, match='Only binary arrays'):
+        encode_subject(np.array([[[0, 1, 2]]]), 'packbits')
+
+
+@pytest.mark.parametrize('dtype_policy', ['float32_packed', 'float16_packed'])
+def test_packed_policy_round_trip(dataset_tuple, dtype_policy):
+    image_arrays = {'ct_inputs': dataset_tuple[1], 'ct_lesion_GT': dataset_tuple[2], 'brain_masks': dataset_tuple[5]}
+    saved_arrays, array_codecs = apply_dtype_policy(image_arrays, dtype_policy)
+    assert sorted(array_codecs) == ['brain_masks', 'ct_lesion_GT']
+    dtypes = policy_dtypes(dtype_policy)
+    for array_name in ['ct_lesion_GT', 'brain_masks']:
+        decoded_array = decode_array(saved_arrays[array_name], array_codecs[array_name])
+        assert decoded_array.dtype == dtypes[array_name]
+        assert np.array_equal(decoded_array, image_arrays[array_name])
+    assert np.array_equal(saved_arrays['ct_inputs'], dataset_tuple[1].astype(dtypes['ct_inputs']))
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+def test_packed_dataset_round_trip(save_synthetic, dataset_tuple, name):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store',
+                          dtype_policy='float16_packed')
+    loaded = load(path)
+    assert loaded[7].item()['dtype_policy'] == 'float16_packed'
+    assert np.array_equal(np.asarray(loaded[1]), dataset_tuple[1].astype(np.float16))
+    for array_index in [2, 5]:
+        assert np.array_equal(np.asarray(loaded[array_index]), dataset_tuple[array_index])
+
+
+@pytest.mark.parametrize('codec, levels', [('quantize_int16', 2 ** 16 - 1), ('quantize_uint8', 2 ** 8 - 1)])
+def test_quantize_round_trip(codec, levels):
+    rng = np.random.default_rng(0)
+    subject_data = (rng.random((8, 9, 7, 4)) * [1, 10, 100, 1000]).astype(np.float32)
+    # constant channel
+    subject_data[..., 2] = 5
+    encoded_data, parameters = encode_subject(subject_data, codec)
+    assert encoded_data.shape == subject_data.shape and len(parameters['scale']) == 4
+    decoded_data = decode_subject(encoded_data, codec, subject_data.shape, np.float32, parameters)
+    assert decoded_data.dtype == np.float32
+
+    channel_ranges = np.ptp(subject_data, axis=(0, 1, 2))
+    errors = np.max(np.abs(decoded_data - subject_data), axis=(0, 1, 2))
+    # rounding error of half a quantization step (and float32 precision)
+    assert np.all(errors <= channel_ranges / levels / 2 + 1e-6 * np.max(subject_data, axis=(0, 1, 2)))
+    assert np.all(decoded_data[..., 2] == 5)
+    assert parameters['max_error'] >= np.max(errors) - 1e-3
+
+    out = np.zeros_like(subject_data)
+    decode_subject(encoded_data, codec, subject_data.shape, np.float32, parameters, out=out)
+    assert np.array_equal(out, decoded_data)
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+@pytest.mark.parametrize('channels', [None, [3, 1]])
+def test_quantized_dataset_round_trip(save_synthetic, dataset_tuple, name, channels):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store',
+                          dtype_policy='int16_quantized')
+    ct_inputs = np.asarray(load(path, channels=channels)[1])
+    expected = dataset_tuple[1] if channels is None else dataset_tuple[1][..., channels]
+    assert ct_inputs.dtype == np.float32 and ct_inputs.shape == expected.shape
+    # images of the synthetic dataset are in [0, 10]
+    assert np.max(np.abs(ct_inputs - expected)) < 10 / (2 ** 16 - 1)
+
+
+@pytest.mark.parametrize('density', [0, 0.2, 1])
+def test_sparse_round_trip(density):
+    subject_data = (np.random.default_rng(0).random((8, 9, 7)) < density).astype(np.uint8)
+    encoded_data, parameters = encode_subject(subject_data, 'sparse')
+    assert parameters == {'count': np.count_nonzero(subject_data)} and len(encoded_data) == parameters['count']
+    assert np.array_equal(decode_subject(encoded_data, 'sparse', subject_data.shape, np.uint8), subject_data)
+
+    # decoding into a (non contiguous) entry of a batch clears the previous subject
+    batch = np.ones((2, 9, 8, 7), dtype=np.uint8).transpose(0, 2, 1, 3)
+    decode_subject(encoded_data, 'sparse', subject_data.shape, np.uint8, out=batch[1])
+    assert np.array_equal(batch[1], subject_data) and np.all(batch[0] == 1)
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+def test_sparse_dataset_round_trip(save_synthetic, dataset_tuple, name):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store',
+                          dtype_policy='float32_sparse')
+    loaded = load(path)
+    for array_index in [2, 5]:
+        assert np.array_equal(np.asarray(loaded[array_index]), dataset_tuple[array_index])
+    with GSDDataset(path) as dataset:
+        assert np.array_equal(dataset.voxel_counts(), np.count_nonzero(dataset_tuple[2], axis=(1, 2, 3)))
+        assert all(np.array_equal(subject_data, expected)
+                   for subject_data, expected in zip(dataset.iter_subjects('ct_lesion_GT'), dataset_tuple[2]))
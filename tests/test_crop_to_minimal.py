@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.data_loader import load_saved_data
+from gsd_pipeline.dataset_tools.crop_to_minimal import crop_to_minimal
+from gsd_pipeline.utils.utils import bounding_box, pad_to_shape
+from conftest import synthetic_dataset, member_bytes, included_dataset, save_archive_with_exclusions
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+@pytest.mark.parametrize('margin', [0, 1])
+def test_crop_to_minimal_matches_reference(save_synthetic, dataset_tuple, name, margin):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store')
+    crop_to_minimal(os.path.dirname(path), name, margin=margin)
+    cropped = load_saved_data(os.path.dirname(path), 'comMin_' + name)
+
+    brain_masks = dataset_tuple[5]
+    boxes = [bounding_box(mask, margin) for mask in brain_masks]
+    shape = tuple(np.max([[box.stop - box.start for box in subject_box] for subject_box in boxes], axis=0))
+    for array_index in [1, 2, 5]:
+        expected = np.array([pad_to_shape(subject_data[box], shape)
+                             for subject_data, box in zip(dataset_tuple[array_index], boxes)])
+        assert np.array_equal(np.asarray(cropped[array_index]), expected)
+
+
+def test_crop_to_minimal_streams_compressed_archive(save_synthetic, inflated_bytes):
+    path = save_synthetic(dataset=synthetic_dataset(n_subjects=30))
+    inflated_bytes['bytes'] = 0
+    crop_to_minimal(os.path.dirname(path), 'data_set.npz')
+    # the brain masks are read twice: for the bounding boxes and to be cropped
+    assert inflated_bytes['bytes'] < 2 * 1.5 * member_bytes(path)
+
+
+def test_crop_to_minimal_on_archive_with_exclusions(tmp_path):
+    path = save_archive_with_exclusions(str(tmp_path / 'data_set.npz'))
+    crop_to_minimal(str(tmp_path), 'data_set.npz')
+    cropped = load_saved_data(str(tmp_path), 'comMin_data_set.npz')
+    expected = included_dataset(synthetic_dataset())
+    assert list(cropped[6]) == list(expected[6]) and np.array_equal(cropped[0], expected[0])
+    boxes = [bounding_box(mask, 1) for mask in expected[5]]
+    shape = tuple(np.max([[box.stop - box.start for box in subject_box] for subject_box in boxes], axis=0))
+    expected_lesions = np.array([pad_to_shape(lesion[box], shape) for lesion, box in zip(expected[2], boxes)])
+    assert np.array_equal(cropped[2], expected_lesions)
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.views import save_view
+from conftest import synthetic_dataset, member_bytes, included_dataset, save_archive_with_exclusions, load, \
+    INCLUDED_SUBJECTS
+
+
+def assert_subjects_equal(subject, other_subject):
+    assert subject.keys() == other_subject.keys()
+    for key in subject:
+        assert np.array_equal(np.asarray(subject[key]), np.asarray(other_subject[key])), key
+
+
+@pytest.mark.parametrize('save_kwargs', [{}, {'compress': False}, {'dtype_policy': 'float16_packed'},
+                                         {'dtype_policy': 'int16_quantized_sparse'}, {'store_format': 'store'}])
+def test_iteration_equals_random_access(save_synthetic, save_kwargs):
+    name = 'data_set' if save_kwargs.get('store_format') == 'store' else 'data_set.npz'
+    path = save_synthetic(name, **save_kwargs)
+    for channels in [None, [2, 0]]:
+        with GSDDataset(path, channels=channels) as dataset:
+            subjects = list(dataset)
+            assert len(subjects) == len(dataset)
+            for index, subject in enumerate(subjects):
+                assert_subjects_equal(subject, dataset[index])
+            for key in dataset.subject_arrays():
+                for index, subject_data in enumerate(dataset.iter_subjects(key)):
+                    assert np.array_equal(subject_data, dataset.subject_array(key, index))
+
+
+@pytest.mark.parametrize('dtype_policy', [None, 'float32_sparse'])
+def test_view_iteration_follows_view_order(save_synthetic, tmp_path, dtype_policy):
+    path = save_synthetic(dtype_policy=dtype_policy)
+    view_ids = ['subj4', 'subj1', 'subj5', 'subj2']
+    view = save_view(str(tmp_path / 'shuffled'), path, view_ids)
+    with GSDDataset(view) as dataset:
+        subjects = list(dataset)
+        assert [str(subject['id']) for subject in subjects] == view_ids
+        for index, subject in enumerate(subjects):
+            assert_subjects_equal(subject, dataset[index])
+
+
+@pytest.mark.parametrize('dtype_policy', [None, 'int16_quantized_sparse'])
+def test_iteration_inflates_compressed_members_once(save_synthetic, inflated_bytes, dtype_policy):
+    path = save_synthetic(dataset=synthetic_dataset(n_subjects=30), dtype_policy=dtype_policy)
+    with GSDDataset(path) as dataset:
+        inflated_bytes['bytes'] = 0
+        for _ in dataset:
+            pass
+    # random access to every subject would inflate the members about n_subjects / 2 times
+    assert inflated_bytes['bytes'] < 1.5 * member_bytes(path)
+
+
+def test_archive_with_exclusions_holds_included_subjects(tmp_path):
+    path = save_archive_with_exclusions(str(tmp_path / 'data_set.npz'))
+    expected = included_dataset(synthetic_dataset())
+    with GSDDataset(path) as dataset:
+        assert len(dataset) == np.count_nonzero(INCLUDED_SUBJECTS) and dataset.n_excluded == 2
+        assert list(dataset.ids) == list(expected[6])
+        assert dataset.index_of('subj3') == 2
+        with pytest.raises(KeyError):
+            dataset.index_of('subj1')
+        for index, subject in enumerate(dataset):
+            assert_subjects_equal(subject, dataset[index])
+            assert subject['id'] == expected[6][index]
+            assert np.array_equal(subject['clinical_inputs'], expected[0][index])
+            assert np.array_equal(subject['ct_inputs'], expected[1][index])
+        assert np.array_equal(list(dataset.iter_subjects('clinical_inputs')), expected[0])
+        assert dataset.load_at_index(1)[6] == 'subj2'
+    loaded = load(path)
+    for array_index in [0, 1, 2, 5, 6]:
+        assert np.array_equal(loaded[array_index], expected[array_index])
+
+
+def test_included_subjects_saved_as_ids_do_not_exclude(tmp_path, dataset_tuple):
+    # the ISLES loader saves the ids in place of the included_subjects mask
+    path = str(tmp_path / 'data_set.npz')
+    np.savez_compressed(path, params=dataset_tuple[7], ids=dataset_tuple[6], included_subjects=dataset_tuple[6],
+                        clinical_inputs=dataset_tuple[0], ct_inputs=dataset_tuple[1], ct_lesion_GT=dataset_tuple[2],
+                        brain_masks=dataset_tuple[5])
+    with GSDDataset(path) as dataset:
+        assert len(dataset) == len(dataset_tuple[6]) and dataset.n_excluded == 0
+        assert np.array_equal(dataset.array('clinical_inputs'), dataset_tuple[0])
@@ -0,0 +1,101 @@
+import os
+import json
+import numpy as np
+import nibabel as nib
+from gsd_pipeline.data_loader import get_paths_and_ids
+from gsd_pipeline.utils.directory_manifest import DirectoryManifest, directory_manifest_path, list_subdirectories, \
+    list_files, image_shape
+from conftest import save_nifti_subjects, CT_SEQUENCES
+
+
+def test_listing_matches_directory(tmp_path):
+    main_dir = str(tmp_path)
+    save_nifti_subjects(main_dir, [(8, 9, 7)] * 3)
+    manifest = DirectoryManifest(main_dir)
+    assert sorted(list_subdirectories(main_dir, manifest)) == sorted(list_subdirectories(main_dir))
+    subject_dir = os.path.join(main_dir, 'subj1', 'pCT')
+    assert sorted(list_files(subject_dir, manifest)) == sorted(list_files(subject_dir))
+    image_path = os.path.join(subject_dir, 'brain_mask.nii')
+    assert image_shape(image_path, manifest) == image_shape(image_path) == (8, 9, 7)
+
+    # the same paths are found with and without the manifest
+    with_manifest = get_paths_and_ids(main_dir, CT_SEQUENCES, ['masked_wcoreg_VOI'], [], [], 'brain_mask.nii', True)
+    without_manifest = get_paths_and_ids(main_dir, CT_SEQUENCES, ['masked_wcoreg_VOI'], [], [], 'brain_mask.nii')
+    assert [sorted(map(str, paths)) for paths in with_manifest] == \
+        [sorted(map(str, paths)) for paths in without_manifest]
+
+
+def test_saved_manifest_is_reused(tmp_path, monkeypatch):
+    main_dir = str(tmp_path)
+    save_nifti_subjects(main_dir, [(8, 9, 7)] * 2)
+    image_path = os.path.join(main_dir, 'subj0', 'pCT', 'brain_mask.nii')
+    manifest = DirectoryManifest(main_dir)
+    manifest.image_header(image_path)
+    manifest.save()
+    assert os.path.exists(directory_manifest_path(main_dir))
+
+    # cached headers are not read again
+    def no_load(path):
+        raise AssertionError('Header of ' + path + ' read again')
+    monkeypatch.setattr(nib, 'load', no_load)
+    assert DirectoryManifest(main_dir).image_header(image_path)['shape'] == [8, 9, 7]
+
+
+def test_changes_invalidate_manifest(tmp_path):
+    main_dir = str(tmp_path)
+    save_nifti_subjects(main_dir, [(8, 9, 7)] * 2)
+    image_path = os.path.join(main_dir, 'subj0', 'pCT', 'brain_mask.nii')
+    manifest = DirectoryManifest(main_dir)
+    assert manifest.image_header(image_path)['shape'] == [8, 9, 7]
+    manifest.save()
+
+    # a rewritten image (same directory mtime) and a new subject
+    nib.save(nib.Nifti1Image(np.zeros((5, 6, 7), dtype=np.uint8), np.eye(4)), image_path)
+    os.utime(image_path, (os.path.getmtime(image_path) + 10,) * 2)
+    directory_mtime = os.path.getmtime(main_dir)
+    os.makedirs(os.path.join(main_dir, 'subj2'))
+    os.utime(main_dir, (directory_mtime + 10,) * 2)
+
+    manifest = DirectoryManifest(main_dir)
+    assert manifest.image_header(image_path)['shape'] == [5, 6, 7]
+    assert sorted(manifest.subdirectories(main_dir)) == ['subj0', 'subj1', 'subj2']
+
+
+def test_corrupted_manifest_is_rebuilt(tmp_path):
+    main_dir = str(tmp_path)
+    save_nifti_subjects(main_dir, [(8, 9, 7)])
+    os.makedirs(os.path.dirname(directory_manifest_path(main_dir)), exist_ok=True)
+    with open(directory_manifest_path(main_dir), 'w') as f:
+        f.write('{"directories"')
+    manifest = DirectoryManifest(main_dir)
+    assert manifest.subdirectories(main_dir) == ['subj0']
+    manifest.save()
+    with open(directory_manifest_path(main_dir)) as f:
+        assert '.' in json.load(f)['directories']
+
+
+def test_saving_manifest_keeps_listings_valid(tmp_path, monkeypatch):
+    main_dir = str(tmp_path / 'main')
+    save_nifti_subjects(main_dir, [(8, 9, 7)] * 2)
+    manifest = DirectoryManifest(main_dir)
+    manifest.subdirectories(main_dir)
+    directory_mtime = os.path.getmtime(main_dir)
+    manifest.save()
+    # the manifest is saved outside of the directory it indexes
+    assert os.listdir(main_dir) == manifest.entries(main_dir) and os.path.getmtime(main_dir) == directory_mtime
+
+    # the saved top level listing is reused without listing the directory again
+    def no_scandir(path):
+        raise AssertionError(path + ' listed again')
+    monkeypatch.setattr(os, 'scandir', no_scandir)
+    assert sorted(DirectoryManifest(main_dir).subdirectories(main_dir)) == ['subj0', 'subj1']
+
+
+def test_manifest_of_another_directory_is_not_used(tmp_path):
+    main_dir = str(tmp_path / 'main')
+    save_nifti_subjects(main_dir, [(8, 9, 7)])
+    manifest = DirectoryManifest(main_dir)
+    manifest.subdirectories(main_dir)
+    manifest.save()
+    # listings are relative to the directory of the manifest
+    assert DirectoryManifest(str(tmp_path / 'other'), directory_manifest_path(main_dir)).directories == {}
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+from gsd_pipeline.data_loader import load_and_save_data, load_saved_data, append_subjects, update_subjects
+from gsd_pipeline.dataset_store.store import shard_path
+from conftest import save_nifti_subjects
+
+
+@pytest.fixture
+def main_dir(tmp_path):
+    main_dir = str(tmp_path / 'main')
+    return main_dir, save_nifti_subjects(main_dir, [(8, 9, 7)] * 5)
+
+
+def build(tmp_path, main_dir, filename, **kwargs):
+    load_and_save_data(str(tmp_path / 'out'), main_dir[0], filename, **kwargs)
+    return load_saved_data(str(tmp_path / 'out'), filename, mmap_mode=None)
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+@pytest.mark.parametrize('dtype_policy', [None, 'float16_sparse'])
+def test_store_equals_npz(tmp_path, main_dir, n_workers, dtype_policy):
+    npz_dataset = build(tmp_path, main_dir, 'data_set.npz', dtype_policy=dtype_policy)
+    store_dataset = build(tmp_path, main_dir, 'data_set', store_format='store', n_workers=n_workers,
+                          dtype_policy=dtype_policy)
+    assert list(store_dataset[6]) == list(npz_dataset[6])
+    for array_index in [1, 2, 5]:
+        assert store_dataset[array_index].dtype == npz_dataset[array_index].dtype
+        assert np.array_equal(store_dataset[array_index], npz_dataset[array_index])
+    assert store_dataset[7].item() == npz_dataset[7].item()
+
+    subjects = main_dir[1]
+    for array_index, source_index in [(1, 0), (2, 1), (5, 2)]:
+        expected = np.array([subjects[id][source_index] for id in npz_dataset[6]])
+        assert np.allclose(npz_dataset[array_index], expected, atol=1e-2 if dtype_policy is not None else 0)
+
+
+def test_parallel_loading_equals_serial_loading(tmp_path, main_dir):
+    serial_dataset = build(tmp_path, main_dir, 'serial.npz')
+    parallel_dataset = build(tmp_path, main_dir, 'parallel.npz', n_workers=3)
+    for array_index in [1, 2, 5, 6]:
+        assert np.array_equal(parallel_dataset[array_index], serial_dataset[array_index])
+
+
+def test_append_and_update_subjects(tmp_path, main_dir):
+    main_dir, subjects = main_dir
+    staging_dir = str(tmp_path / 'staging')
+    os.makedirs(staging_dir)
+    for id in ['subj3', 'subj4']:
+        os.rename(os.path.join(main_dir, id), os.path.join(staging_dir, id))
+    store_dir = str(tmp_path / 'out' / 'data_set')
+    load_and_save_data(str(tmp_path / 'out'), main_dir, 'data_set', store_format='store')
+    # subjects are listed in directory order
+    assert sorted(load_saved_data(str(tmp_path / 'out'), 'data_set')[6]) == ['subj0', 'subj1', 'subj2']
+
+    for id in ['subj3', 'subj4']:
+        os.rename(os.path.join(staging_dir, id), os.path.join(main_dir, id))
+    assert sorted(append_subjects(store_dir)) == ['subj3', 'subj4']
+    assert update_subjects(store_dir) == ([], [])
+
+    # a new lesion map for subj1
+    lesion_path = os.path.join(main_dir, 'subj1', 'pCT', 'masked_wcoreg_VOI_subj1.nii.gz')
+    new_lesion = 1 - subjects['subj1'][1]
+    nib.save(nib.Nifti1Image(new_lesion, np.eye(4)), lesion_path)
+    os.utime(lesion_path, (os.path.getmtime(lesion_path) + 10,) * 2)
+    unchanged_shard = shard_path(store_dir, 'ct_lesion_GT', 'subj0')
+    unchanged_mtime = os.path.getmtime(unchanged_shard)
+    assert update_subjects(store_dir) == ([], ['subj1'])
+    assert os.path.getmtime(unchanged_shard) == unchanged_mtime
+
+    dataset = load_saved_data(str(tmp_path / 'out'), 'data_set', mmap_mode=None)
+    assert sorted(dataset[6]) == ['subj0', 'subj1', 'subj2', 'subj3', 'subj4']
+    expected_lesions = [new_lesion if id == 'subj1' else subjects[id][1] for id in dataset[6]]
+    assert np.array_equal(dataset[2], np.array(expected_lesions))
+    assert np.array_equal(dataset[1], np.array([subjects[id][0] for id in dataset[6]]))
+
+
+def test_update_store_built_from_relative_main_dir(tmp_path, main_dir, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    load_and_save_data('out', 'main', 'data_set', store_format='store')
+    assert update_subjects(os.path.join('out', 'data_set')) == ([], [])
+    assert update_subjects(os.path.join('out', 'data_set'), 'main') == ([], [])
+
+    lesion_path = os.path.join('main', 'subj2', 'pCT', 'masked_wcoreg_VOI_subj2.nii.gz')
+    os.utime(lesion_path, (os.path.getmtime(lesion_path) + 10,) * 2)
+    assert update_subjects(os.path.join('out', 'data_set'), 'main') == ([], ['subj2'])
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.migrate_npz import migrate_npz
+from gsd_pipeline.dataset_store.store import load_manifest, channel_shard_path
+from conftest import load, synthetic_dataset, included_dataset, save_archive_with_exclusions
+
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_migrated_store_equals_archive(save_synthetic, compress):
+    path = save_synthetic(compress=compress)
+    store_dir = migrate_npz(path)
+    assert store_dir == os.path.splitext(path)[0]
+    archive, store = load(path), load(store_dir)
+    for array_index in [0, 1, 2, 5]:
+        assert np.array_equal(np.asarray(store[array_index]), archive[array_index])
+    assert list(store[6]) == list(archive[6]) and store[7].item() == archive[7].item()
+    with pytest.raises(FileExistsError):
+        migrate_npz(path)
+
+
+def test_migration_with_dtype_policy_and_channel_shards(save_synthetic, dataset_tuple, tmp_path):
+    path = save_synthetic(dtype_policy='float16_sparse')
+    store_dir = migrate_npz(path, str(tmp_path / 'sharded'), dtype_policy='int16_quantized_packed',
+                            channel_shards=True)
+    manifest = load_manifest(store_dir)
+    assert manifest['params']['dtype_policy'] == 'int16_quantized_packed'
+    assert os.path.exists(channel_shard_path(store_dir, 'ct_inputs', 'subj0', 3))
+    store = load(store_dir)
+    assert np.max(np.abs(np.asarray(store[1]) - dataset_tuple[1].astype(np.float16))) < 1e-2
+    for array_index in [2, 5]:
+        assert np.array_equal(np.asarray(store[array_index]), dataset_tuple[array_index])
+
+
+def test_migration_of_legacy_lesion_key(dataset_tuple, tmp_path):
+    # older archives saved the CT lesion labels as lesion_GT
+    path = str(tmp_path / 'legacy.npz')
+    np.savez_compressed(path, params=dataset_tuple[7], ids=dataset_tuple[6], clinical_inputs=dataset_tuple[0],
+                        ct_inputs=dataset_tuple[1], lesion_GT=dataset_tuple[2], brain_masks=dataset_tuple[5])
+    store = load(migrate_npz(path))
+    assert np.array_equal(np.asarray(store[2]), dataset_tuple[2])
+    assert np.array_equal(np.asarray(store[1]), dataset_tuple[1])
+
+
+def test_migration_of_archive_with_exclusions(tmp_path):
+    path = save_archive_with_exclusions(str(tmp_path / 'data_set.npz'))
+    store_dir = migrate_npz(path)
+    assert load_manifest(store_dir)['ids'] == ['subj0', 'subj2', 'subj3', 'subj5']
+    expected, store = included_dataset(synthetic_dataset()), load(store_dir)
+    for array_index in [0, 1, 2, 5]:
+        assert np.array_equal(np.asarray(store[array_index]), expected[array_index])
+    assert list(store[6]) == list(expected[6])
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from scipy.ndimage import rotate, shift
+from gsprep.tools.perfusion_maps_tools.normalisation import normalise_by_contralateral_median, find_midline, \
+    nonzero_median, midline_distances
+
+
+def reference_normalisation(data):
+    # baseline: sides split in the middle of the x axis, the middle voxel line of uneven widths is divided by the
+    # mean of the mean non zero values of its neighbouring lines
+    normalised_data = np.empty(data.shape)
+    for subj in range(data.shape[0]):
+        subj_data = data[subj]
+        x_center = subj_data.shape[0] // 2
+        high_start = x_center + subj_data.shape[0] % 2
+        low_side, high_side = subj_data[:x_center], subj_data[high_start:]
+        normalised_data[subj, :x_center] = low_side / np.median(high_side[np.nonzero(high_side)])
+        normalised_data[subj, high_start:] = high_side / np.median(low_side[np.nonzero(low_side)])
+        if subj_data.shape[0] % 2 != 0:
+            neighbours_mean = np.mean([np.mean(subj_data[x_center - 1][np.nonzero(subj_data[x_center - 1])]),
+                                       np.mean(subj_data[x_center + 1][np.nonzero(subj_data[x_center + 1])])])
+            normalised_data[subj, x_center] = subj_data[x_center] / neighbours_mean
+    return normalised_data
+
+
+def test_nonzero_median():
+    rng = np.random.default_rng(0)
+    for size in [5, 6, 7, 10]:
+        values = rng.random(size)
+        values[rng.random(size) < 0.3] = 0
+        assert np.isclose(nonzero_median(values.copy()), np.median(values[values != 0]))
+    assert np.isnan(nonzero_median(np.zeros(4)))
+
+
+@pytest.mark.parametrize('width', [20, 21])
+def test_normalisation_matches_reference(width):
+    data = np.random.default_rng(0).random((3, width, 24, 6, 2))
+    data[data < 0.2] = 0
+    expected = reference_normalisation(data)
+    np.testing.assert_allclose(normalise_by_contralateral_median(data), expected, rtol=1e-12)
+    np.testing.assert_allclose(normalise_by_contralateral_median(data, n_workers=3), expected, rtol=1e-12)
+    np.testing.assert_allclose(normalise_by_contralateral_median(data.astype(np.float32)), expected, rtol=1e-5)
+    np.testing.assert_allclose(normalise_by_contralateral_median(data[..., 0]), reference_normalisation(data[..., 0]),
+                               rtol=1e-12)
+
+    in_place_data = data.copy()
+    assert normalise_by_contralateral_median(in_place_data, in_place=True) is in_place_data
+    np.testing.assert_allclose(in_place_data, expected, rtol=1e-12)
+    with pytest.raises(ValueError, match='in place'):
+        normalise_by_contralateral_median(data.astype(np.int16), in_place=True)
+
+
+def symmetric_phantom(shape=(96, 112)):
+    # ellipse symmetric about the middle of the x axis, with left-right symmetric structures
+    x, y = np.meshgrid(np.arange(shape[0]) - (shape[0] - 1) / 2, np.arange(shape[1]) - (shape[1] - 1) / 2,
+                       indexing='ij')
+    return ((x / 40) ** 2 + (y / 50) ** 2 < 1) * (1 + 0.5 * np.cos(y / 7) + 0.3 * (np.abs(x) < 10)
+                                                  + 0.4 * (np.abs(x) > 25) * (y > 0))
+
+
+def test_midline_of_symmetric_phantom():
+    subject_data = np.repeat(symmetric_phantom()[..., None, None], 2, axis=2)
+    angle, midline_shift = find_midline(subject_data)
+    assert abs(angle) <= 1 and abs(midline_shift) <= 0.5
+    # the detected midline of a centred subject splits it like the middle of the x axis
+    np.testing.assert_allclose(normalise_by_contralateral_median(subject_data[None], detect_midline=True),
+                               reference_normalisation(subject_data[None]), rtol=1e-6)
+
+
+def test_midline_of_tilted_and_shifted_phantom():
+    tilted_image = shift(rotate(symmetric_phantom(), 8, reshape=False, order=1), (3, 0), order=1)
+    angle, midline_shift = find_midline(np.repeat(tilted_image[..., None, None], 4, axis=2))
+    assert abs(abs(angle) - 8) <= 1.5 and abs(abs(midline_shift) - 3) <= 1.5
+
+    # the detected plane splits the phantom into mirrored halves of the same area
+    distances = midline_distances(tilted_image.shape, angle, midline_shift)
+    low_area, high_area = np.count_nonzero(tilted_image[distances < 0]), np.count_nonzero(tilted_image[distances > 0])
+    assert abs(low_area - high_area) / (low_area + high_area) < 0.02
@@ -0,0 +1,61 @@
+import os
+import numpy as np
+from gsd_pipeline.data_loader import load_saved_data, rescale_store_outliers
+from gsd_pipeline.dataset_tools.transforms import RescaleOutliers
+from gsd_pipeline.dataset_tools.transform_pipeline import run_pipeline
+from gsd_pipeline.utils.utils import rescale_outliers, outlier_medians
+from conftest import synthetic_dataset
+
+# channels of subjects scaled x10 (as some RAPID maps)
+OUTLIERS = [(2, 1), (4, 3), (4, 0)]
+
+
+def dataset_with_outliers():
+    dataset = list(synthetic_dataset())
+    dataset[1] = dataset[1] + 1
+    for subject, channel in OUTLIERS:
+        dataset[1][subject, ..., channel] *= 10
+    return tuple(dataset)
+
+
+def expected_rescaled_inputs(ct_inputs):
+    expected = ct_inputs.copy()
+    for subject, channel in OUTLIERS:
+        expected[subject, ..., channel] /= 10
+    return expected
+
+
+def test_outlier_medians_match_numpy():
+    dataset = dataset_with_outliers()
+    subject_medians, cohort_medians = outlier_medians(zip(dataset[1], dataset[5]))
+    expected = [np.median(subject_data[mask], axis=0) for subject_data, mask in zip(dataset[1], dataset[5])]
+    np.testing.assert_allclose(subject_medians, expected)
+    masked_voxels = dataset[1][dataset[5]]
+    widths = np.ptp(masked_voxels, axis=0) / 1000
+    assert np.all(np.abs(cohort_medians - np.median(masked_voxels, axis=0)) <= widths)
+
+
+def test_rescale_outliers():
+    dataset = dataset_with_outliers()
+    ct_inputs = dataset[1].copy()
+    assert rescale_outliers(ct_inputs, dataset[5]) is ct_inputs
+    np.testing.assert_allclose(ct_inputs, expected_rescaled_inputs(dataset[1]), rtol=1e-6)
+
+
+def test_rescale_store_outliers(save_synthetic):
+    dataset = dataset_with_outliers()
+    path = save_synthetic('data_set', store_format='store', dataset=dataset)
+    assert rescale_store_outliers(path) == {'subj2': [1], 'subj4': [0, 3]}
+    ct_inputs = np.asarray(load_saved_data(os.path.dirname(path), 'data_set')[1])
+    np.testing.assert_allclose(ct_inputs, expected_rescaled_inputs(dataset[1]), rtol=1e-6)
+    # rescaled subjects are not outliers anymore
+    assert rescale_store_outliers(path) == {}
+
+
+def test_rescale_outliers_transform(save_synthetic, tmp_path):
+    dataset = dataset_with_outliers()
+    path = save_synthetic(dataset=dataset)
+    out_path = run_pipeline(path, [RescaleOutliers()], 'rescaled.npz', str(tmp_path))
+    rescaled = load_saved_data(os.path.dirname(out_path), 'rescaled.npz')
+    np.testing.assert_allclose(rescaled[1], expected_rescaled_inputs(dataset[1]), rtol=1e-6)
+    assert rescaled[7].item()['transforms'][0]['outliers'] == {'subj2': [1], 'subj4': [0, 3]}
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from gsd_pipeline.data_loader import load_and_save_data, load_saved_data, load_saved_data_at_index
+from gsd_pipeline.dataset_store.store import pad_subject
+from gsd_pipeline.utils.utils import bounding_box
+from conftest import save_nifti_subjects
+
+SHAPES = [(8, 9, 7), (10, 9, 8), (8, 11, 6), (10, 9, 8)]
+
+
+@pytest.fixture
+def ragged_sources(tmp_path):
+    main_dir = str(tmp_path / 'main')
+    subjects = save_nifti_subjects(main_dir, SHAPES)
+    return main_dir, subjects
+
+
+def build_store(tmp_path, main_dir, filename='data_set', **kwargs):
+    load_and_save_data(str(tmp_path / 'out'), main_dir, filename, store_format='store', **kwargs)
+    return str(tmp_path / 'out'), filename
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_ragged_store_round_trip(tmp_path, ragged_sources, n_workers):
+    main_dir, subjects = ragged_sources
+    store = build_store(tmp_path, main_dir, ragged=True, n_workers=n_workers)
+    dataset = load_saved_data(*store)
+    ids = list(dataset[6])
+    assert sorted(ids) == sorted(subjects)
+    # subjects do not have a common shape
+    assert dataset[1].shape == (len(SHAPES),)
+    with pytest.raises(ValueError, match='pad_shape'):
+        np.asarray(dataset[1])
+    for array_index, source_index in [(1, 0), (2, 1), (5, 2)]:
+        for index, id in enumerate(ids):
+            assert np.array_equal(dataset[array_index][index], subjects[id][source_index])
+        assert [subject_data.shape for subject_data in dataset[array_index][1:3]] == \
+            [subjects[id][source_index].shape for id in ids[1:3]]
+
+    subject = load_saved_data_at_index(2, *store)
+    assert np.array_equal(subject[1], subjects[ids[2]][0])
+
+
+@pytest.mark.parametrize('pad_shape', ['max', (12, 11, 9)])
+def test_ragged_store_padding(tmp_path, ragged_sources, pad_shape):
+    main_dir, subjects = ragged_sources
+    store = build_store(tmp_path, main_dir, ragged=True)
+    dataset = load_saved_data(*store, pad_shape=pad_shape, mmap_mode=None)
+    expected_shape = (10, 11, 8) if pad_shape == 'max' else pad_shape
+    assert dataset[1].shape == (len(SHAPES),) + expected_shape + (4,)
+    for index, id in enumerate(dataset[6]):
+        assert np.array_equal(dataset[1][index], pad_subject(subjects[id][0], expected_shape))
+        assert np.array_equal(dataset[5][index], pad_subject(subjects[id][2], expected_shape))
+    # missing z layers are prepended, as for high resolution datasets
+    assert np.array_equal(pad_subject(np.ones((1, 1, 1)), (2, 1, 2)), [[[0, 1]], [[0, 0]]])
+
+
+def test_ragged_store_smaller_pad_shape(tmp_path, ragged_sources):
+    main_dir, _ = ragged_sources
+    store = build_store(tmp_path, main_dir, ragged=True)
+    with pytest.raises(ValueError, match='larger than the padding shape'):
+        np.asarray(load_saved_data(*store, pad_shape=(9, 9, 8))[1])
+
+
+@pytest.mark.parametrize('crop_margin', [0, 2])
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_cropped_store_round_trip(tmp_path, ragged_sources, crop_margin, n_workers):
+    main_dir, subjects = ragged_sources
+    store = build_store(tmp_path, main_dir, crop_margin=crop_margin, n_workers=n_workers)
+    dataset = load_saved_data(*store)
+    cropped_dataset = load_saved_data(*store, uncrop=False)
+    for index, id in enumerate(dataset[6]):
+        ct_input, ct_lesion, brain_mask = subjects[id]
+        box = bounding_box(brain_mask, crop_margin)
+        inside_box = np.zeros(brain_mask.shape, dtype=bool)
+        inside_box[box] = True
+        # uncropped subjects are zero outside of the saved block
+        assert np.array_equal(dataset[1][index], ct_input * inside_box[..., None])
+        assert np.array_equal(dataset[2][index], ct_lesion * inside_box)
+        assert np.array_equal(dataset[5][index], brain_mask)
+        assert np.array_equal(cropped_dataset[1][index], ct_input[box])
+        assert np.array_equal(cropped_dataset[5][index], brain_mask[box])
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import pytest
+from skimage.transform import rescale
+from gsd_pipeline.data_loader import load_saved_data
+from gsd_pipeline.dataset_tools.downsample import downsample_dataset, downsample_dataset_to_shape, \
+    downsample_dataset_to_spacing
+from gsd_pipeline.utils.resampling import resample, area_resample, area_weights, scaled_shape
+from conftest import synthetic_dataset
+
+
+def test_area_resample():
+    subject_data = np.random.default_rng(0).random((16, 18, 12, 3)).astype(np.float32)
+    # block means for integer factors
+    np.testing.assert_allclose(area_resample(subject_data, (8, 9, 6)),
+                               subject_data.reshape(8, 2, 9, 2, 6, 2, 3).mean(axis=(1, 3, 5)), rtol=1e-6)
+    # overlap weights otherwise, which keep the mean of the image
+    assert np.allclose(area_weights(18, 7).sum(axis=1), 1)
+    resampled_data = area_resample(subject_data, (10, 7, 5))
+    assert resampled_data.shape == (10, 7, 5, 3)
+    np.testing.assert_allclose(resampled_data.mean(axis=(0, 1, 2)), subject_data.mean(axis=(0, 1, 2)), rtol=1e-5)
+
+
+def test_linear_resample_matches_rescale():
+    subject_data = np.random.default_rng(0).random((16, 18, 12, 3)).astype(np.float32)
+    resampled_data = resample(subject_data, scaled_shape(subject_data.shape, 0.5), 'linear')
+    assert resampled_data.dtype == np.float32
+    assert np.array_equal(resampled_data, rescale(subject_data, (0.5, 0.5, 0.5, 1)))
+
+
+@pytest.mark.parametrize('interpolation', ['nearest', 'majority'])
+@pytest.mark.parametrize('dtype', [bool, np.uint8, np.float32])
+def test_labels_stay_labels(interpolation, dtype):
+    labels = (np.random.default_rng(0).random((16, 18, 12)) > 0.5).astype(dtype)
+    for out_shape in [(8, 9, 6), (10, 7, 5), (32, 36, 24)]:
+        resampled_labels = resample(labels, out_shape, interpolation)
+        assert resampled_labels.shape == out_shape and resampled_labels.dtype == dtype
+        assert set(np.unique(resampled_labels)) <= {0, 1}
+    if interpolation == 'majority':
+        # foreground where it covers at least half of the output voxel
+        assert np.array_equal(resample(labels, (8, 9, 6), interpolation) > 0,
+                              labels.reshape(8, 2, 9, 2, 6, 2).mean(axis=(1, 3, 5)) >= 0.5)
+    # upsampling by an integer factor repeats the voxels
+    assert np.array_equal(resample(labels, (32, 36, 24), interpolation),
+                          labels.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2))
+
+
+def test_majority_of_multiple_labels():
+    labels = np.random.default_rng(0).integers(0, 4, (16, 18, 12)).astype(np.int16)
+    resampled_labels = resample(labels, (5, 5, 5), 'majority')
+    assert resampled_labels.dtype == np.int16 and set(np.unique(resampled_labels)) <= {0, 1, 2, 3}
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_downsample_dataset(save_synthetic, n_workers):
+    path = save_synthetic(dataset=synthetic_dataset(shape=(8, 10, 6)))
+    data_dir = os.path.dirname(path)
+    dataset = load_saved_data(data_dir, 'data_set.npz')
+    downsample_dataset(data_dir, 0.5, n_workers=n_workers)
+    downsampled = load_saved_data(data_dir, 'scale0.5_data_set.npz')
+    assert downsampled[1].shape == (6, 4, 5, 3, 4) and downsampled[5].dtype == bool
+    assert list(downsampled[6]) == list(dataset[6])
+    for index in range(len(dataset[6])):
+        assert np.array_equal(downsampled[1][index], resample(dataset[1][index], (4, 5, 3)))
+        assert np.array_equal(downsampled[2][index], resample(dataset[2][index], (4, 5, 3), 'majority'))
+
+
+def test_downsample_dataset_to_shape_and_spacing(save_synthetic):
+    path = save_synthetic('data_set', store_format='store')
+    data_dir = os.path.dirname(path)
+    downsample_dataset_to_shape(data_dir, (5, 5, 5), 'data_set', n_workers=2)
+    assert load_saved_data(data_dir, 'shape5x5x5_data_set')[1].shape == (6, 5, 5, 5, 4)
+
+    with pytest.raises(ValueError, match='voxel spacing'):
+        downsample_dataset_to_spacing(data_dir, (2, 1, 3), filename='data_set')
+    downsample_dataset_to_spacing(data_dir, (2, 1, 3), (1, 1, 1), 'data_set')
+    resampled = load_saved_data(data_dir, 'spacing2x1x3_data_set')
+    assert resampled[1].shape == (6, 4, 9, 2, 4)
+    assert resampled[7].item()['voxel_spacing'] == [2., 1., 3.]
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.shared_memory_server import SharedDatasetServer, attach_dataset
+from conftest import synthetic_dataset, save_ragged_store
+
+
+def shared_memory_segments():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def test_attached_dataset_equals_saved_dataset(save_synthetic):
+    dataset = list(synthetic_dataset())
+    # numpy values in params are served as python values
+    dataset[7] = dict(dataset[7], voxel_spacing=np.array([2., 2., 5.]), n_bins=np.int64(10))
+    path = save_synthetic(dataset=tuple(dataset))
+    with SharedDatasetServer(path):
+        attached = attach_dataset(path)
+        for array_index in [1, 2, 5]:
+            assert np.array_equal(attached[array_index], dataset[array_index])
+        assert not attached[1].flags.writeable
+        assert list(attached[6]) == list(dataset[6])
+        assert attached[7].item()['voxel_spacing'] == [2., 2., 5.] and attached[7].item()['n_bins'] == 10
+
+
+def test_invalid_params_do_not_leak_shared_memory(save_synthetic):
+    dataset = list(synthetic_dataset())
+    dataset[7] = dict(dataset[7], sequences_set={'wcoreg_Tmax'})
+    path = save_synthetic(dataset=tuple(dataset))
+    segments = shared_memory_segments()
+    with pytest.raises(ValueError, match='can not be saved'):
+        SharedDatasetServer(path)
+    assert shared_memory_segments() == segments
+
+
+def test_ragged_store_needs_pad_shape(tmp_path):
+    path = save_ragged_store(str(tmp_path / 'ragged'))
+    segments = shared_memory_segments()
+    with pytest.raises(ValueError, match='give a pad_shape'):
+        SharedDatasetServer(path)
+    assert shared_memory_segments() == segments
+
+    with SharedDatasetServer(path, pad_shape='max'):
+        assert attach_dataset(path)[1].shape == (6, 10, 9, 8, 4)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+from gsprep.utils.smoothing import gaussian_smoothing
+
+
+def reference_smoothing(data, kernel_width=5, threeD=False):
+    # baseline: one 2D gaussian filter per plane and channel (or one 3D filter per channel)
+    sigma = kernel_width / 3
+    truncate = ((kernel_width - 1) / 2 - 0.5) / sigma
+    smoothed_data = np.empty(data.shape)
+    for i in range(data.shape[0]):
+        for c in range(data.shape[4]):
+            if threeD:
+                smoothed_data[i, ..., c] = gaussian_filter(data[i, ..., c], sigma, truncate=truncate)
+                continue
+            for z in range(data.shape[3]):
+                smoothed_data[i, :, :, z, c] = gaussian_filter(data[i, :, :, z, c], sigma, truncate=truncate)
+    return smoothed_data
+
+
+@pytest.mark.parametrize('kernel_width', [2, 3, 5])
+@pytest.mark.parametrize('threeD', [False, True])
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_smoothing_matches_reference(kernel_width, threeD, n_workers):
+    data = np.random.default_rng(0).random((3, 20, 24, 10, 2))
+    expected = reference_smoothing(data, kernel_width, threeD)
+    np.testing.assert_allclose(gaussian_smoothing(data, kernel_width, threeD, n_workers=n_workers), expected,
+                               atol=1e-12)
+
+    float32_data = data.astype(np.float32)
+    smoothed_data = gaussian_smoothing(float32_data, kernel_width, threeD)
+    assert smoothed_data.dtype == np.float32
+    np.testing.assert_allclose(smoothed_data, expected, atol=1e-5)
+    assert gaussian_smoothing(float32_data, kernel_width, threeD, in_place=True, n_workers=n_workers) \
+        is float32_data
+    assert np.array_equal(float32_data, smoothed_data)
+
+
+def test_smoothing_of_integer_and_non_contiguous_data():
+    data = np.random.default_rng(0).random((2, 20, 24, 10, 3))
+    integer_data = (data * 100).astype(np.int16)
+    smoothed_data = gaussian_smoothing(integer_data, 3)
+    assert smoothed_data.dtype == np.float64
+    np.testing.assert_allclose(smoothed_data, reference_smoothing(integer_data.astype(np.float64), 3), atol=1e-10)
+    with pytest.raises(ValueError, match='in place'):
+        gaussian_smoothing(integer_data, 3, in_place=True)
+
+    # a single channel view, as smoothed by add_core_map
+    view = data[0][None, ..., 1, None]
+    np.testing.assert_allclose(gaussian_smoothing(view, 2), reference_smoothing(view, 2), atol=1e-12)
+    with pytest.raises(ValueError, match='should be'):
+        gaussian_smoothing(data[0], 3)
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.data_loader import get_subset
+from gsd_pipeline.dataset_store.splits import stratified_folds, stratified_split, quantile_bins, create_kfold_views, \
+    create_split_views
+from gsd_pipeline.dataset_store.views import save_view, load_view
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from conftest import synthetic_dataset, load, included_dataset, save_archive_with_exclusions
+
+
+def test_quantile_bins():
+    bins = quantile_bins([5, np.nan, 1, 3, 2, 4], 2)
+    assert bins[1] == -1 and list(bins[[2, 4, 3]]) == [0, 0, 1] and list(bins[[0, 5]]) == [1, 1]
+
+
+def test_every_stratum_is_spread_over_the_folds():
+    strata = np.repeat([0, 1, 2], [10, 7, 3])
+    folds = stratified_folds(strata, 3, seed=0)
+    for stratum in range(3):
+        counts = np.bincount(folds[strata == stratum], minlength=3)
+        assert counts.max() - counts.min() <= 1
+    assert np.bincount(folds).max() - np.bincount(folds).min() <= 1
+    assert np.array_equal(stratified_folds(strata, 3, seed=0), folds)
+
+
+def test_split_follows_fractions():
+    strata = np.repeat([0, 1], [60, 40])
+    parts = stratified_split(strata, (0.7, 0.2, 0.1), seed=0)
+    for stratum, size in [(0, 60), (1, 40)]:
+        counts = np.bincount(parts[strata == stratum], minlength=3)
+        assert np.all(np.abs(counts - np.array([0.7, 0.2, 0.1]) * size) <= 1)
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+def test_kfold_views(save_synthetic, name):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store',
+                          dataset=synthetic_dataset(n_subjects=10))
+    dataset = load(path)
+    view_paths = create_kfold_views(path, n_folds=3, seed=1)
+    validation_ids = []
+    for train_path, val_path in view_paths:
+        train, val = load(train_path), load(val_path)
+        assert sorted(set(train[6]) | set(val[6])) == sorted(dataset[6]) and not set(train[6]) & set(val[6])
+        validation_ids += list(val[6])
+        # views read their subjects from the parent dataset
+        indices = [list(dataset[6]).index(id) for id in val[6]]
+        assert np.array_equal(np.asarray(val[1]), np.asarray(dataset[1])[indices])
+        assert np.array_equal(val[0], dataset[0][indices])
+        assert load_view(val_path)['split']['part'] == 'val'
+    assert sorted(validation_ids) == sorted(dataset[6])
+
+
+def test_split_views_and_views_on_views(save_synthetic, tmp_path):
+    path = save_synthetic(dataset=synthetic_dataset(n_subjects=10))
+    train_path, val_path, test_path = create_split_views(path, seed=0)
+    ids = [list(load(view)[6]) for view in (train_path, val_path, test_path)]
+    assert sorted(sum(ids, [])) == sorted(load(path)[6])
+
+    # views on views reference the dataset, and are read relative to their own location
+    sub_view = save_view(str(tmp_path / 'first_train'), train_path, ids[0][:2])
+    assert load_view(sub_view)['parent'] == os.path.abspath(path)
+    assert list(load(sub_view)[6]) == ids[0][:2]
+
+    subset = get_subset(os.path.dirname(path), 3, view=True)
+    assert list(load(subset)[6]) == list(load(path)[6][:3])
+
+
+def test_views_on_archive_with_exclusions(tmp_path):
+    path = save_archive_with_exclusions(str(tmp_path / 'data_set.npz'))
+    expected = included_dataset(synthetic_dataset())
+    view = load(save_view(str(tmp_path / 'view'), path, ['subj5', 'subj0']))
+    assert list(view[6]) == ['subj5', 'subj0']
+    for array_index in [0, 1, 2, 5]:
+        assert np.array_equal(np.asarray(view[array_index]), expected[array_index][[3, 0]])
+    # excluded subjects are not part of the dataset
+    with pytest.raises(KeyError):
+        GSDDataset(save_view(str(tmp_path / 'excluded'), path, ['subj1']))
+
+    view_ids = [list(load(train_path)[6]) + list(load(val_path)[6])
+                for train_path, val_path in create_kfold_views(path, n_folds=2, seed=0)]
+    assert all(sorted(ids) == sorted(expected[6]) for ids in view_ids)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+from gsd_pipeline.dataset_store.statistics import compute_channel_statistics, channel_percentiles, RunningHistogram
+
+
+def random_subjects(n_subjects=5, seed=0):
+    # channels of different scales and offsets, subjects of different ranges (the histograms have to grow)
+    rng = np.random.default_rng(seed)
+    return [(rng.normal(size=(6, 7, 5, 3)) * [1, 100, 0.01] + [0, -50, 1000]) * (subject + 1)
+            for subject in range(n_subjects)]
+
+
+@pytest.mark.parametrize('masked', [False, True])
+def test_statistics_match_numpy(masked):
+    subjects = random_subjects()
+    masks = [subject_data[..., 0] > 0 for subject_data in subjects] if masked else None
+    statistics = compute_channel_statistics(subjects, masks)
+    if masked:
+        voxels = np.concatenate([subject_data[mask] for subject_data, mask in zip(subjects, masks)])
+    else:
+        voxels = np.concatenate([subject_data.reshape(-1, 3) for subject_data in subjects])
+
+    assert statistics['count'] == [len(voxels)] * 3
+    np.testing.assert_allclose(statistics['mean'], np.mean(voxels, axis=0), rtol=1e-10)
+    np.testing.assert_allclose(statistics['std'], np.std(voxels, axis=0), rtol=1e-10)
+    assert statistics['min'] == list(np.min(voxels, axis=0)) and statistics['max'] == list(np.max(voxels, axis=0))
+
+    q = [0, 1, 25, 50, 75, 99, 100]
+    percentiles = channel_percentiles(statistics, q)
+    bin_widths = np.array([histogram['width'] for histogram in statistics['histogram']])
+    # percentiles are exact up to the width of a bin (the voxel of rank q / 100 * count is in the bin)
+    expected = np.percentile(voxels, q, axis=0, method='inverted_cdf').T
+    assert np.all(np.abs(percentiles - expected) <= bin_widths[:, None] * (1 + 1e-6))
+
+
+def test_single_channel_and_constant_subjects():
+    subjects = [np.full((4, 4, 4), 3.), np.full((4, 4, 4), 3.), np.arange(64.).reshape(4, 4, 4)]
+    statistics = compute_channel_statistics(subjects)
+    voxels = np.concatenate([subject_data.ravel() for subject_data in subjects])
+    np.testing.assert_allclose(statistics['mean'], [np.mean(voxels)])
+    np.testing.assert_allclose(statistics['std'], [np.std(voxels)])
+    assert np.abs(channel_percentiles(statistics, 50)[0] - np.percentile(voxels, 50, method='inverted_cdf')) <= \
+        statistics['histogram'][0]['width'] * (1 + 1e-6)
+
+
+def test_histogram_grows_in_both_directions():
+    histogram = RunningHistogram(n_bins=8)
+    histogram.add(np.array([0., 1.]))
+    histogram.add(np.array([-3., 5.]))
+    assert histogram.low <= -3 and histogram.high >= 5
+    assert histogram.counts.sum() == 4
+    assert RunningHistogram.from_dict(histogram.to_dict()).counts.tolist() == histogram.counts.tolist()
+    with pytest.raises(ValueError, match='even'):
+        RunningHistogram(n_bins=7)
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+def test_dataset_statistics(save_synthetic, dataset_tuple, name):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store')
+    ct_inputs, brain_masks = dataset_tuple[1].astype(np.float64), dataset_tuple[5]
+    with GSDDataset(path) as dataset:
+        statistics = dataset.channel_statistics()
+        masked_statistics = dataset.channel_statistics(masked=True)
+    np.testing.assert_allclose(statistics['mean'], np.mean(ct_inputs, axis=(0, 1, 2, 3)), rtol=1e-6)
+    np.testing.assert_allclose(masked_statistics['std'], np.std(ct_inputs[brain_masks], axis=0), rtol=1e-6)
+
+    # statistics of stores are cached in the manifest, also for datasets opened with channels
+    with GSDDataset(path, channels=[2, 0]) as dataset:
+        assert dataset.channel_statistics(masked=True)['mean'] == \
+            [masked_statistics['mean'][2], masked_statistics['mean'][0]]
@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_store.store import ShardedArray, load_manifest
+from gsd_pipeline.dataset_tools.add_noise_to_channel import add_noise_to_channel
+from conftest import load
+
+
+def test_store_round_trip(save_synthetic, dataset_tuple):
+    path = save_synthetic('data_set', store_format='store')
+    manifest = load_manifest(path)
+    assert manifest['ids'] == list(dataset_tuple[6])
+    assert all(os.path.exists(os.path.join(path, 'ct_inputs', id + '.npy')) for id in manifest['ids'])
+
+    loaded = load(path)
+    for array_index in [0, 1, 2, 5]:
+        assert np.array_equal(np.asarray(loaded[array_index]), dataset_tuple[array_index])
+    assert np.array_equal(loaded[6], dataset_tuple[6])
+    assert loaded[7].item() == dataset_tuple[7]
+    assert loaded[1][2:4, ..., 1].shape == (2, 8, 9, 7)
+
+
+def test_store_arrays_are_read_only_unless_loaded_in_memory(save_synthetic, dataset_tuple):
+    path = save_synthetic('data_set', store_format='store')
+    ct_inputs = load(path)[1]
+    assert isinstance(ct_inputs, ShardedArray)
+    with pytest.raises(TypeError, match='mmap_mode=None'):
+        ct_inputs[..., 0] += 1
+
+    ct_inputs = load(path, mmap_mode=None)[1]
+    assert isinstance(ct_inputs, np.ndarray)
+    ct_inputs[..., 0] += 1
+    assert np.allclose(ct_inputs[..., 0], dataset_tuple[1][..., 0] + 1)
+
+
+def test_in_place_tool_on_store(save_synthetic, dataset_tuple):
+    path = save_synthetic('data_set', store_format='store')
+    noised_ct_inputs = add_noise_to_channel(path, channel_index=3, outfile='noisy.npz')
+    assert noised_ct_inputs.shape == dataset_tuple[1].shape
+    assert np.array_equal(noised_ct_inputs[..., :3], dataset_tuple[1][..., :3])
+    assert os.path.exists(os.path.join(os.path.dirname(path), 'noisy.npz'))
@@ -0,0 +1,85 @@
+import os
+import numpy as np
+import pytest
+from gsd_pipeline.dataset_tools.pad_dataset_to_shape import pad_dataset_to_shape
+from gsd_pipeline.dataset_tools.standardisation import standardize_data
+from gsd_pipeline.dataset_tools.transforms import PadToShape, BinarizeMasks
+from gsd_pipeline.dataset_tools.transform_pipeline import run_pipeline, parse_transform
+from gsd_pipeline.utils.utils import pad_to_shape
+from conftest import synthetic_dataset, member_bytes, load, included_dataset, save_archive_with_exclusions
+
+
+@pytest.mark.parametrize('name', ['data_set.npz', 'data_set'])
+def test_pad_dataset_to_shape_matches_baseline(save_synthetic, dataset_tuple, name):
+    path = save_synthetic(name, store_format='npz' if name.endswith('.npz') else 'store')
+    pad_dataset_to_shape(path, (10, 12, 9))
+    padded = load(os.path.join(os.path.dirname(path), 'padded_' + name))
+    # baseline: every subject padded with pad_to_shape
+    for array_index in [1, 2, 5]:
+        expected = np.array([pad_to_shape(subject_data, (10, 12, 9)) for subject_data in dataset_tuple[array_index]])
+        assert np.array_equal(np.asarray(padded[array_index]), expected)
+    assert np.array_equal(np.asarray(padded[6]), dataset_tuple[6])
+
+
+@pytest.mark.parametrize('min_max_scaling', [True, False])
+def test_standardize_data_matches_baseline(save_synthetic, dataset_tuple, min_max_scaling):
+    path = save_synthetic()
+    standardize_data(os.path.dirname(path), 'data_set.npz', channels_to_leave_out=[3],
+                     min_max_scaling=min_max_scaling)
+    standardized = load(os.path.join(os.path.dirname(path), 'standardized_data_set.npz'))[1]
+    # baseline: statistics of every channel over the whole cohort (the synthetic subjects have no outliers)
+    ct_inputs = dataset_tuple[1].astype(np.float64)
+    for channel in range(ct_inputs.shape[-1]):
+        expected = ct_inputs[..., channel]
+        if channel != 3:
+            expected = (expected - np.mean(expected)) / np.std(expected)
+            if min_max_scaling:
+                expected = (expected - np.min(expected)) / (np.max(expected) - np.min(expected))
+        np.testing.assert_allclose(standardized[..., channel], expected, rtol=1e-5, atol=1e-5)
+
+
+def test_pipeline_chain_saves_once(save_synthetic, dataset_tuple, tmp_path):
+    path = save_synthetic()
+    out_path = run_pipeline(path, [parse_transform('binarize_masks:threshold=0.5'), PadToShape((10, 10, 8))],
+                            'chain.npz', str(tmp_path), n_workers=2)
+    chained = load(out_path)
+    expected = np.array([pad_to_shape(subject_data, (10, 10, 8)) for subject_data in dataset_tuple[2]]) >= 0.5
+    assert np.array_equal(np.asarray(chained[2]) > 0, expected)
+    assert [transform['name'] for transform in chained[7].item()['transforms']] == \
+        [BinarizeMasks.name, PadToShape.name]
+
+
+def test_pipeline_streams_compressed_archive(save_synthetic, inflated_bytes):
+    path = save_synthetic(dataset=synthetic_dataset(n_subjects=30))
+    archive_bytes = member_bytes(path)
+
+    inflated_bytes['bytes'] = 0
+    pad_dataset_to_shape(path, (10, 10, 8))
+    assert inflated_bytes['bytes'] < 1.5 * archive_bytes
+
+    # outlier rescaling and standardisation are fitted first, ie. three passes over the archive
+    inflated_bytes['bytes'] = 0
+    standardize_data(os.path.dirname(path), 'data_set.npz')
+    assert inflated_bytes['bytes'] < 3 * 1.5 * archive_bytes
+
+
+@pytest.mark.parametrize('store_format', ['npz', 'store'])
+def test_pipeline_on_archive_with_exclusions(tmp_path, store_format):
+    path = save_archive_with_exclusions(str(tmp_path / 'data_set.npz'))
+    expected = included_dataset(synthetic_dataset())
+    out_path = run_pipeline(path, [PadToShape((10, 10, 8))], 'padded' + ('.npz' if store_format == 'npz' else ''),
+                            str(tmp_path), store_format=store_format, n_workers=2)
+    padded = load(out_path)
+    assert list(padded[6]) == list(expected[6])
+    assert np.array_equal(padded[0], expected[0])
+    for array_index in [1, 2, 5]:
+        expected_array = np.array([pad_to_shape(subject_data, (10, 10, 8)) for subject_data in expected[array_index]])
+        assert np.array_equal(np.asarray(padded[array_index]), expected_array)
+
+
+def test_pad_dataset_to_shape_on_archive_with_exclusions(tmp_path):
+    path = save_archive_with_exclusions(str(tmp_path / 'data_set.npz'))
+    pad_dataset_to_shape(path, (10, 12, 9))
+    padded = load(str(tmp_path / 'padded_data_set.npz'))
+    expected = included_dataset(synthetic_dataset())
+    assert list(padded[6]) == list(expected[6]) and np.asarray(padded[1]).shape[0] == len(expected[6])
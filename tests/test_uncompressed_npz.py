@@ -0,0 +1,38 @@
+import os
+import zipfile
+import numpy as np
+from gsd_pipeline.data_loader import load_saved_data, save_dataset
+from gsd_pipeline.dataset_store.dataset import GSDDataset
+
+
+def stored_members(path):
+    with zipfile.ZipFile(path) as zip_file:
+        return all(info.compress_type == zipfile.ZIP_STORED for info in zip_file.infolist())
+
+
+def test_uncompressed_members_are_memory_mapped(save_synthetic, dataset_tuple):
+    path = save_synthetic(compress=False)
+    assert stored_members(path)
+    dataset = load_saved_data(os.path.dirname(path), 'data_set.npz')
+    assert isinstance(dataset[1], np.memmap) and dataset[7].item()['compress'] is False
+    for array_index in [0, 1, 2, 5]:
+        assert np.array_equal(dataset[array_index], dataset_tuple[array_index])
+    # copy-on-write: the archive is not modified
+    dataset[1][0] = 0
+    assert np.array_equal(load_saved_data(os.path.dirname(path), 'data_set.npz')[1], dataset_tuple[1])
+
+    in_memory = load_saved_data(os.path.dirname(path), 'data_set.npz', mmap_mode=None)[1]
+    assert not isinstance(in_memory, np.memmap) and np.array_equal(in_memory, dataset_tuple[1])
+
+    # copies of the dataset stay uncompressed
+    save_dataset(dataset, os.path.dirname(path), 'copy.npz')
+    assert stored_members(os.path.join(os.path.dirname(path), 'copy.npz'))
+
+
+def test_uncompressed_encoded_members(save_synthetic, dataset_tuple):
+    path = save_synthetic(compress=False, dtype_policy='float32_sparse')
+    with GSDDataset(path) as dataset:
+        for index in [4, 1]:
+            assert np.array_equal(dataset[index]['ct_lesion_GT'], dataset_tuple[2][index])
+            assert np.array_equal(dataset[index]['brain_masks'], dataset_tuple[5][index])
+        assert np.array_equal(dataset.array('ct_inputs'), dataset_tuple[1])